@@ -0,0 +1,154 @@
+from common.io_utils import read_jsonl_generator, JsonlWriter, loads, dumps
+
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
+	pq = None
+
+
+# fields used by the preprocessing and training pipeline, everything else in a tweet is
+# stored as an opaque json payload which is only decoded when the full tweet is requested
+CORPUS_FIELDS = ['id', 'full_text', 'urls', 'candidates', 'misinfo']
+JSON_FIELDS = {'urls', 'candidates', 'misinfo'}
+PAYLOAD_FIELD = 'payload'
+
+
+def is_corpus_path(path):
+	return path.endswith('.parquet') or path.endswith('.arrow')
+
+
+def _check_pyarrow(path):
+	if pa is None:
+		raise ImportError(f'pyarrow is required to read or write {path}')
+
+
+def corpus_schema():
+	return pa.schema(
+		[(field, pa.string()) for field in CORPUS_FIELDS] + [(PAYLOAD_FIELD, pa.binary())]
+	)
+
+
+def _iter_batches(path, columns, batch_size):
+	if path.endswith('.parquet'):
+		parquet_file = pq.ParquetFile(path, memory_map=True)
+		for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+			yield batch
+	else:
+		# arrow ipc files are memory-mapped, batches reference the mapped file without copying
+		with pa.memory_map(path, 'r') as source:
+			reader = pa.ipc.open_file(source)
+			for b_idx in range(reader.num_record_batches):
+				yield reader.get_batch(b_idx)
+
+
+def read_corpus(path, columns=None, batch_size=10000):
+	"""Reads tweets from a columnar corpus file, only decoding the requested columns.
+	Args:
+		path (str): Path of a .parquet or .arrow corpus file.
+		columns (list): Subset of CORPUS_FIELDS to load, None loads full tweets including the payload.
+		batch_size (int): Number of rows decoded at a time for parquet files.
+	Yields:
+		dict: Tweet with the requested fields, fields which are missing for a tweet are omitted.
+	"""
+	_check_pyarrow(path)
+	if columns is None:
+		columns = CORPUS_FIELDS + [PAYLOAD_FIELD]
+	for column in columns:
+		if column not in CORPUS_FIELDS and column != PAYLOAD_FIELD:
+			raise ValueError(f'Unknown corpus column: {column}')
+	for batch in _iter_batches(path, columns, batch_size):
+		column_values = [batch.column(batch.schema.get_field_index(c)).to_pylist() for c in columns]
+		for row in zip(*column_values):
+			tweet = {}
+			for column, value in zip(columns, row):
+				if value is None:
+					continue
+				if column == PAYLOAD_FIELD:
+					tweet.update(loads(value))
+				elif column in JSON_FIELDS:
+					tweet[column] = loads(value)
+				else:
+					tweet[column] = value
+			yield tweet
+
+
+class CorpusWriter:
+	def __init__(self, path, batch_size=10000):
+		_check_pyarrow(path)
+		self.path = path
+		self.batch_size = batch_size
+		self.schema = corpus_schema()
+		if path.endswith('.parquet'):
+			self.writer = pq.ParquetWriter(path, self.schema)
+			self.sink = None
+		else:
+			self.sink = pa.OSFile(path, 'wb')
+			self.writer = pa.ipc.new_file(self.sink, self.schema)
+		self.buffer = {field: [] for field in self.schema.names}
+
+	def write(self, tweet):
+		payload = {}
+		for key, value in tweet.items():
+			if key not in CORPUS_FIELDS:
+				payload[key] = value
+		for field in CORPUS_FIELDS:
+			value = tweet.get(field)
+			if value is not None and field in JSON_FIELDS:
+				value = dumps(value).decode('utf-8')
+			elif value is not None:
+				value = str(value)
+			self.buffer[field].append(value)
+		self.buffer[PAYLOAD_FIELD].append(dumps(payload))
+		if len(self.buffer[PAYLOAD_FIELD]) >= self.batch_size:
+			self.flush()
+
+	def write_all(self, tweets):
+		for tweet in tweets:
+			self.write(tweet)
+
+	def flush(self):
+		if not self.buffer[PAYLOAD_FIELD]:
+			return
+		batch = pa.RecordBatch.from_arrays(
+			[pa.array(self.buffer[field], type=self.schema.field(field).type) for field in self.schema.names],
+			schema=self.schema
+		)
+		if self.sink is None:
+			self.writer.write_table(pa.Table.from_batches([batch]))
+		else:
+			self.writer.write_batch(batch)
+		self.buffer = {field: [] for field in self.schema.names}
+
+	def close(self):
+		self.flush()
+		self.writer.close()
+		if self.sink is not None:
+			self.sink.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+
+def read_tweets(path, columns=None, skip_errors=False):
+	"""Reads tweets from either a columnar corpus or a (compressed) jsonl file.
+	Column selection only applies to corpus files, jsonl files always yield full tweets.
+	"""
+	if is_corpus_path(path):
+		return read_corpus(path, columns=columns)
+	return read_jsonl_generator(path, skip_errors=skip_errors)
+
+
+def open_tweet_writer(path):
+	if is_corpus_path(path):
+		return CorpusWriter(path)
+	return JsonlWriter(path)
+
+
+def write_tweets(tweets, path):
+	with open_tweet_writer(path) as writer:
+		writer.write_all(tweets)
@@ -0,0 +1,110 @@
+import time
+
+import torch
+from torch import nn
+
+try:
+	import onnxruntime
+except ImportError:
+	onnxruntime = None
+
+ONNX_INPUT_NAMES = ['input_ids', 'attention_mask', 'token_type_ids']
+# highest opset the exporter of the pinned torch 1.7.1 supports, 13 needs torch>=1.8
+ONNX_OPSET_VERSION = 12
+
+
+def quantize_dynamic_int8(model):
+	"""Returns a copy of model with every nn.Linear dynamically quantized to int8 weights for CPU inference.
+	Activations are quantized per batch at run time, so no calibration data is needed.
+	"""
+	return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+class BertEncoder(nn.Module):
+	"""Last hidden states of a BertModel as a single tensor output, the graph exported for a drop-in bert."""
+	def __init__(self, bert):
+		super().__init__()
+		self.bert = bert
+
+	def forward(self, input_ids, attention_mask, token_type_ids):
+		return self.bert(input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)[0]
+
+
+def export_onnx(module, path, output_dims=1, seq_len=16, opset_version=ONNX_OPSET_VERSION):
+	"""Exports module(input_ids, attention_mask, token_type_ids) -> tensor with dynamic batch and sequence axes.
+	Args:
+		output_dims (int): 1 for [batch, ...] outputs, 2 for [batch, seq, ...] outputs.
+	"""
+	module.eval()
+	inputs = tuple(torch.ones([2, seq_len], dtype=torch.long) for _ in ONNX_INPUT_NAMES)
+	dynamic_axes = {name: {0: 'batch', 1: 'seq'} for name in ONNX_INPUT_NAMES}
+	dynamic_axes['output'] = {0: 'batch', 1: 'seq'} if output_dims == 2 else {0: 'batch'}
+	with torch.no_grad():
+		torch.onnx.export(
+			module,
+			inputs,
+			path,
+			input_names=ONNX_INPUT_NAMES,
+			output_names=['output'],
+			dynamic_axes=dynamic_axes,
+			opset_version=opset_version,
+		)
+
+
+def quantize_onnx(path, output_path):
+	# int8 weights for MatMul / Gemm nodes of an exported graph
+	if onnxruntime is None:
+		raise ImportError('onnxruntime is required to quantize onnx graphs')
+	from onnxruntime.quantization import quantize_dynamic, QuantType
+	quantize_dynamic(path, output_path, weight_type=QuantType.QInt8)
+
+
+class OnnxModule(nn.Module):
+	"""Runs an exported graph with onnxruntime on CPU, called like the exported torch module."""
+	def __init__(self, path, num_threads=None):
+		super().__init__()
+		if onnxruntime is None:
+			raise ImportError('onnxruntime is required to run onnx graphs')
+		options = onnxruntime.SessionOptions()
+		if num_threads is not None:
+			options.intra_op_num_threads = num_threads
+		self.path = path
+		self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+	def forward(self, input_ids, attention_mask=None, token_type_ids=None):
+		if attention_mask is None:
+			attention_mask = torch.ones_like(input_ids)
+		if token_type_ids is None:
+			token_type_ids = torch.zeros_like(input_ids)
+		inputs = {
+			name: value.detach().cpu().numpy()
+			for name, value in zip(ONNX_INPUT_NAMES, [input_ids, attention_mask, token_type_ids])
+		}
+		output = self.session.run(None, inputs)[0]
+		return torch.from_numpy(output).to(input_ids.device)
+
+
+class OnnxBertModel(OnnxModule):
+	# BertModel outputs are indexed, [0] is the last hidden state
+	def forward(self, input_ids, attention_mask=None, token_type_ids=None):
+		return (super().forward(input_ids, attention_mask, token_type_ids),)
+
+
+def benchmark(func, batches, warmup=2):
+	"""Times func over batches of (input_ids, attention_mask, token_type_ids).
+	Returns:
+		dict: mean latency per batch in ms and throughput in sequences per second.
+	"""
+	with torch.no_grad():
+		for inputs in batches[:warmup]:
+			func(*inputs)
+		num_sequences = 0
+		start = time.perf_counter()
+		for inputs in batches:
+			func(*inputs)
+			num_sequences += inputs[0].shape[0]
+		seconds = time.perf_counter() - start
+	return {
+		'latency_ms': 1000.0 * seconds / max(len(batches), 1),
+		'throughput': num_sequences / max(seconds, 1e-9),
+	}
@@ -0,0 +1,186 @@
+import os
+import io
+import gzip
+import json
+import hashlib
+from itertools import islice
+from multiprocessing import Pool
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+
+def loads(line):
+	if orjson is not None:
+		return orjson.loads(line)
+	return json.loads(line)
+
+
+def dumps(example):
+	# always returns utf-8 encoded bytes, non-ascii characters are kept as-is
+	if orjson is not None:
+		return orjson.dumps(example)
+	return json.dumps(example, ensure_ascii=False).encode('utf-8')
+
+
+def is_compressed(path):
+	return path.endswith('.gz') or path.endswith('.zst')
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+	# content hash used as a cache key, independent of file names and modification times
+	h = hashlib.blake2b(digest_size=16)
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(chunk_size), b''):
+			h.update(chunk)
+	return h.hexdigest()
+
+
+def open_file(path, mode='r'):
+	"""Opens a file in binary mode, transparently (de)compressing .gz and .zst files.
+	Args:
+		path (str): Path of the file, compression is inferred from the extension.
+		mode (str): One of 'r', 'w' or 'a'.
+	Returns:
+		Binary file object.
+	"""
+	if mode not in ['r', 'w', 'a']:
+		raise ValueError(f'Unknown file mode: {mode}')
+	if path.endswith('.gz'):
+		return gzip.open(path, mode + 'b')
+	if path.endswith('.zst'):
+		if zstandard is None:
+			raise ImportError(f'zstandard is required to read or write {path}')
+		if mode == 'r':
+			# decompression readers do not support line iteration by themselves
+			return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True))
+		return zstandard.ZstdCompressor().stream_writer(open(path, mode + 'b'), closefd=True)
+	return open(path, mode + 'b')
+
+
+def _parse_line(line, skip_errors):
+	line = line.strip()
+	if not line:
+		return None
+	try:
+		return loads(line)
+	except Exception as e:
+		if not skip_errors:
+			raise
+		print(e)
+		return None
+
+
+def read_jsonl_generator(path, skip_errors=False):
+	with open_file(path, 'r') as f:
+		for line in f:
+			ex = _parse_line(line, skip_errors)
+			if ex is not None:
+				yield ex
+
+
+def read_jsonl(path, skip_errors=False):
+	return list(read_jsonl_generator(path, skip_errors))
+
+
+def _read_chunk(args):
+	path, start, end, skip_errors = args
+	examples = []
+	with open(path, 'rb') as f:
+		f.seek(start)
+		# chunks which do not start at a line boundary skip the partial line,
+		# it is read by the previous chunk instead
+		if start > 0:
+			f.seek(start - 1)
+			f.readline()
+		while f.tell() < end:
+			line = f.readline()
+			if not line:
+				break
+			ex = _parse_line(line, skip_errors)
+			if ex is not None:
+				examples.append(ex)
+	return examples
+
+
+def _parse_lines(args):
+	lines, skip_errors = args
+	examples = []
+	for line in lines:
+		ex = _parse_line(line, skip_errors)
+		if ex is not None:
+			examples.append(ex)
+	return examples
+
+
+def _line_chunks(path, chunk_lines, skip_errors):
+	with open_file(path, 'r') as f:
+		while True:
+			lines = list(islice(f, chunk_lines))
+			if not lines:
+				break
+			yield lines, skip_errors
+
+
+def read_jsonl_parallel(path, processes=8, chunk_size=64 * 1024 * 1024, chunk_lines=10000, skip_errors=False):
+	"""Parses a jsonl file with a pool of worker processes, yielding examples in file order.
+	Uncompressed files are split into byte ranges of chunk_size which every worker reads independently,
+	compressed files are decompressed sequentially and handed to the workers in batches of chunk_lines.
+	"""
+	with Pool(processes=processes) as p:
+		if is_compressed(path):
+			chunks = p.imap(_parse_lines, _line_chunks(path, chunk_lines, skip_errors))
+		else:
+			file_size = os.path.getsize(path)
+			chunks = p.imap(
+				_read_chunk,
+				[(path, start, min(start + chunk_size, file_size), skip_errors) for start in range(0, file_size, chunk_size)]
+			)
+		for examples in chunks:
+			for ex in examples:
+				yield ex
+
+
+class JsonlWriter:
+	def __init__(self, path, mode='w', batch_size=1024):
+		self.path = path
+		self.batch_size = batch_size
+		self.f = open_file(path, mode)
+		self.buffer = []
+
+	def write(self, example):
+		self.buffer.append(dumps(example))
+		if len(self.buffer) >= self.batch_size:
+			self.flush()
+
+	def write_all(self, examples):
+		for example in examples:
+			self.write(example)
+
+	def flush(self):
+		if self.buffer:
+			self.buffer.append(b'')
+			self.f.write(b'\n'.join(self.buffer))
+			self.buffer = []
+
+	def close(self):
+		self.flush()
+		self.f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+
+def write_jsonl(data, path, batch_size=1024):
+	with JsonlWriter(path, batch_size=batch_size) as writer:
+		writer.write_all(data)
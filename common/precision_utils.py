@@ -0,0 +1,46 @@
+import contextlib
+
+import torch
+
+# 32: fp32, 16: fp16 autocast with loss scaling (GPU only), bf16: bf16 autocast on CPU or GPU
+PRECISIONS = ['32', '16', 'bf16']
+
+
+def trainer_precision(precision, use_tpus=False):
+	# pl.Trainer precision, 16 on TPUs is XLA bf16, 16 on GPUs adds the native AMP gradient scaler.
+	# bf16 needs no loss scaling, so its Trainer runs in 32 and the model enters the autocast itself.
+	if use_tpus:
+		return 16
+	return 16 if precision == '16' else 32
+
+
+def encoder_autocast(precision, device):
+	"""Autocast context the encoder forward runs under for the given precision, a no-op for 32."""
+	if precision == '16':
+		return torch.cuda.amp.autocast(enabled=device.type == 'cuda')
+	if precision == 'bf16':
+		if not hasattr(torch, 'autocast'):
+			raise RuntimeError('bf16 autocast needs torch>=1.10, use precision 16 or 32')
+		return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+	return contextlib.nullcontext()
+
+
+def full_precision(device):
+	"""Disables any active autocast, so heads, energies and losses run in fp32 under reduced precision."""
+	if hasattr(torch, 'autocast'):
+		return torch.autocast(device_type=device.type, enabled=False)
+	return torch.cuda.amp.autocast(enabled=False)
+
+
+def bert_hidden_states(bert, precision, input_ids, attention_mask, token_type_ids):
+	"""Last hidden states of bert computed under the encoder autocast, returned in fp32.
+	Returns:
+		[bsize, seq_len, hidden_size] float32 tensor.
+	"""
+	with encoder_autocast(precision, input_ids.device):
+		contextualized_embeddings = bert(
+			input_ids,
+			attention_mask=attention_mask,
+			token_type_ids=token_type_ids
+		)[0]
+	return contextualized_embeddings.float()
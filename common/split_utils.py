@@ -0,0 +1,100 @@
+import os
+import hashlib
+
+from common.io_utils import JsonlWriter
+
+
+def hash_unit(key, seed):
+	"""Maps a key to a float in [0, 1) which only depends on the key and the seed,
+	independent of load order, process or python hash randomization."""
+	digest = hashlib.blake2b(f'{seed}:{key}'.encode('utf-8'), digest_size=8).digest()
+	return int.from_bytes(digest, 'big') / 2 ** 64
+
+
+def assign_split(tweet_id, seed, test_size, dev_size):
+	# dev_size is a fraction of the non-test tweets, same as splitting twice with train_test_split
+	u = hash_unit(tweet_id, seed)
+	if u < test_size:
+		return 'test'
+	if u < test_size + (1.0 - test_size) * dev_size:
+		return 'dev'
+	return 'train'
+
+
+def assign_fold(tweet_id, seed, num_splits):
+	return int(hash_unit(tweet_id, seed) * num_splits)
+
+
+def assign_fold_split(tweet_id, seed, num_splits, dev_size):
+	"""Assigns a tweet to a split for each of the num_splits folds.
+	Every tweet is in the test set of exactly one fold, the dev set of each fold is
+	drawn independently from the remaining tweets.
+	Returns:
+		list: Split name of the tweet for folds 1 to num_splits.
+	"""
+	test_fold = assign_fold(tweet_id, seed, num_splits)
+	splits = []
+	for fold in range(num_splits):
+		if fold == test_fold:
+			splits.append('test')
+		elif hash_unit(tweet_id, f'{seed}-dev-{fold}') < dev_size:
+			splits.append('dev')
+		else:
+			splits.append('train')
+	return splits
+
+
+class SplitWriter:
+	"""Writes tweets to a set of split files in a single pass, keeping a count per file."""
+	def __init__(self, output_path, names=()):
+		self.output_path = output_path
+		self.writers = {}
+		self.counts = {}
+		# create expected split files up front so empty splits still produce a file
+		for name in names:
+			self._open(name)
+
+	def _open(self, name):
+		file_path = os.path.join(self.output_path, f'{name}.jsonl')
+		file_dir = os.path.dirname(file_path)
+		if not os.path.exists(file_dir):
+			os.makedirs(file_dir)
+		self.writers[name] = JsonlWriter(file_path)
+		self.counts[name] = 0
+
+	def write(self, name, tweet):
+		if name not in self.writers:
+			self._open(name)
+		self.writers[name].write(tweet)
+		self.counts[name] += 1
+
+	def close(self):
+		for writer in self.writers.values():
+			writer.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+
+def assign_zero_split(tweet, dev_mids, test_mids):
+	# tweets annotated for any held-out misinfo target are held out with it
+	for m_id in tweet['misinfo']:
+		if m_id in test_mids:
+			return 'test'
+		elif m_id in dev_mids:
+			return 'dev'
+	return 'train'
+
+
+def zero_split_misinfo(misinfo, dev_mids, test_mids):
+	train_misinfo = {m_id: m for m_id, m in misinfo.items() if m_id not in dev_mids and m_id not in test_mids}
+	dev_misinfo = {m_id: m for m_id, m in misinfo.items() if m_id not in test_mids}
+	test_misinfo = {m_id: m for m_id, m in misinfo.items()}
+	return {
+		'train': train_misinfo,
+		'dev': dev_misinfo,
+		'test': test_misinfo
+	}
@@ -0,0 +1,211 @@
+import os
+import gzip
+import json
+import mmap
+
+import numpy as np
+
+from common.io_utils import loads, dumps, zstandard
+from common.corpus_utils import read_tweets
+
+
+def index_path(path):
+	return path + '.idx'
+
+
+def index_meta_path(path):
+	return path + '.idx.json'
+
+
+def _data_stat(path):
+	stat = os.stat(path)
+	return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def is_current_index(path):
+	# the index records the size and mtime of the data file it was built for, a data file rewritten
+	# since, e.g. by write_tweets to the same path, no longer matches and its offsets are stale
+	if not os.path.exists(path) or not os.path.exists(index_path(path)):
+		return False
+	if not os.path.exists(index_meta_path(path)):
+		return False
+	with open(index_meta_path(path), 'r') as f:
+		meta = json.load(f)
+	return meta == _data_stat(path)
+
+
+def is_tweet_store(path):
+	return is_current_index(path)
+
+
+def get_key(example, key):
+	# keys are field names, nested fields use dots, e.g. data.id for raw tweets
+	value = example
+	for field in key.split('.'):
+		value = value[field]
+	return str(value)
+
+
+def _compress(record, path):
+	# every record is its own gzip member / zstd frame, so the data file is still a valid
+	# compressed jsonl file while each record can be decompressed on its own
+	if path.endswith('.gz'):
+		return gzip.compress(record)
+	if path.endswith('.zst'):
+		if zstandard is None:
+			raise ImportError(f'zstandard is required to read or write {path}')
+		return zstandard.ZstdCompressor().compress(record)
+	return record
+
+
+def _decompress(record, path):
+	if path.endswith('.gz'):
+		return gzip.decompress(record)
+	if path.endswith('.zst'):
+		return zstandard.ZstdDecompressor().decompress(record)
+	return record
+
+
+def build_tweet_store(examples, path, key='id'):
+	"""Writes examples to a data file at path along with a sorted key -> byte offset index.
+	Duplicate keys keep the last example, the same as building a {key: example} dict.
+	Args:
+		examples (iterable): Tweets (or other json examples) to store.
+		path (str): Data file path, .gz or .zst compress every record individually.
+		key (str): Field used as lookup key, nested fields use dots.
+	Returns:
+		int: Number of unique keys in the store.
+	"""
+	keys = []
+	offsets = []
+	lengths = []
+	offset = 0
+	with open(path, 'wb') as f:
+		for ex in examples:
+			record = _compress(dumps(ex) + b'\n', path)
+			f.write(record)
+			keys.append(get_key(ex, key).encode('utf-8'))
+			offsets.append(offset)
+			lengths.append(len(record))
+			offset += len(record)
+
+	key_width = max([len(k) for k in keys], default=1)
+	index = np.zeros(len(keys), dtype=[('key', f'S{key_width}'), ('offset', '<u8'), ('length', '<u8')])
+	index['key'] = keys
+	index['offset'] = offsets
+	index['length'] = lengths
+	index = index[np.argsort(index['key'], kind='stable')]
+	if len(index) > 0:
+		# stable sort keeps duplicates in file order, keep the last of every run of equal keys
+		last_mask = np.append(index['key'][1:] != index['key'][:-1], True)
+		index = index[last_mask]
+	with open(index_path(path), 'wb') as f:
+		np.save(f, index)
+	with open(index_meta_path(path), 'w') as f:
+		json.dump(_data_stat(path), f)
+	return len(index)
+
+
+class TweetStore:
+	"""Read-only mapping of key -> tweet backed by a memory-mapped data file and index."""
+	def __init__(self, path):
+		self.path = path
+		if not is_current_index(path):
+			raise ValueError(f'Index of {path} is missing or out of date, rebuild it with build_tweet_store')
+		self.index = np.load(index_path(path), mmap_mode='r')
+		self.keys_array = self.index['key']
+		self.f = open(path, 'rb')
+		if os.path.getsize(path) > 0:
+			self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+		else:
+			self.data = b''
+
+	def _find(self, keys):
+		keys = [str(k).encode('utf-8') for k in keys]
+		# keys longer than the index key width would be truncated and could match a stored prefix
+		fits = np.array([len(k) <= self.keys_array.dtype.itemsize for k in keys], dtype=bool)
+		keys = np.array(keys, dtype=self.keys_array.dtype)
+		positions = np.searchsorted(self.keys_array, keys)
+		positions = np.minimum(positions, max(len(self.keys_array) - 1, 0))
+		if len(self.keys_array) == 0:
+			found = np.zeros(len(keys), dtype=bool)
+		else:
+			found = (self.keys_array[positions] == keys) & fits
+		return positions, found
+
+	def _read(self, position):
+		offset = int(self.index['offset'][position])
+		length = int(self.index['length'][position])
+		record = self.data[offset:offset + length]
+		return loads(_decompress(record, self.path))
+
+	def get(self, key, default=None):
+		positions, found = self._find([key])
+		if not found[0]:
+			return default
+		return self._read(positions[0])
+
+	def get_many(self, keys):
+		"""Looks up many keys at once, reading records in file order.
+		Returns:
+			dict: key -> tweet for every key found in the store.
+		"""
+		keys = list(keys)
+		positions, found = self._find(keys)
+		results = {}
+		order = sorted(
+			[(int(self.index['offset'][p]), k, p) for k, p, k_found in zip(keys, positions, found) if k_found]
+		)
+		for _, key, position in order:
+			results[key] = self._read(position)
+		return results
+
+	def __getitem__(self, key):
+		ex = self.get(key)
+		if ex is None:
+			raise KeyError(key)
+		return ex
+
+	def __contains__(self, key):
+		_, found = self._find([key])
+		return bool(found[0])
+
+	def __len__(self):
+		return len(self.index)
+
+	def keys(self):
+		for key in self.keys_array:
+			yield key.decode('utf-8')
+
+	def items(self):
+		# file order is sequential on disk
+		for position in np.argsort(self.index['offset']):
+			yield self.keys_array[position].decode('utf-8'), self._read(position)
+
+	def values(self):
+		for _, ex in self.items():
+			yield ex
+
+	def close(self):
+		if isinstance(self.data, mmap.mmap):
+			self.data.close()
+		self.f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+
+def load_tweet_lookup(path, key='id', skip_errors=False):
+	"""Opens path as a TweetStore if it has an up to date index, otherwise loads a {key: tweet} dict."""
+	if is_tweet_store(path):
+		return TweetStore(path)
+	return {get_key(ex, key): ex for ex in read_tweets(path, skip_errors=skip_errors)}
+
+
+def get_many(lookup, keys):
+	if isinstance(lookup, TweetStore):
+		return lookup.get_many(keys)
+	return {key: lookup[key] for key in keys if key in lookup}
@@ -0,0 +1,133 @@
+#!/usr/bin/env bash
+
+filename=$(basename -- "$0")
+# run names
+RUN_ID=${filename::-3}
+RUN_NAME=HLTRI_COVID_MISINFO
+
+# collection
+DATASET=v1
+
+# trains the same model on a fixed seed in each precision and checks test F1 stays within
+# MISINFO_F1_TOLERANCE of the fp32 run
+MISINFO_PRE_MODEL_NAME=digitalepidemiologylab/covid-twitter-bert-v2
+# bf16 autocast needs torch>=1.10, requirements.txt pins 1.7.1, add bf16 on a newer torch
+MISINFO_PRECISIONS="32 16"
+MISINFO_F1_TOLERANCE=0.01
+MISINFO_SEED=0
+
+MISINFO_BATCH_SIZE=8
+MISINFO_MAX_SEQ_LEN=96
+MISINFO_EMB_SIZE=8
+MISINFO_EMB_MODEL=transd
+MISINFO_EMB_LOSS_NORM=2
+MISINFO_LEARNING_RATE=5e-5
+MISINFO_GAMMA=1.0
+MISINFO_TRAIN_EPOCHS=10
+MISINFO_EVAL_BATCH_SIZE=8
+
+MISINFO_NUM_GPUS=1
+MISINFO_EVAL_MODE=centroid
+
+export TOKENIZERS_PARALLELISM=true
+
+if [[ " ${MISINFO_PRECISIONS} " == *" bf16 "* ]] && ! python -c "import torch, sys; sys.exit(0 if hasattr(torch, 'autocast') else 1)"; then
+    echo "torch has no bf16 autocast, skipping bf16"
+    MISINFO_PRECISIONS=$(echo ${MISINFO_PRECISIONS} | sed 's/bf16//')
+fi
+
+echo "Starting experiment ${RUN_NAME}_${RUN_ID}"
+echo "Reserving ${MISINFO_NUM_GPUS} GPU(s)..."
+MISINFO_GPUS=`python gpu/request_gpus.py -r ${MISINFO_NUM_GPUS}`
+if [[ ${MISINFO_GPUS} -eq -1 ]]; then
+    echo "Unable to reserve ${MISINFO_NUM_GPUS} GPU(s), exiting."
+    exit -1
+fi
+echo "Reserved ${MISINFO_NUM_GPUS} GPUs: ${MISINFO_GPUS}"
+
+DATASET_PATH=data/${DATASET}
+
+# trap ctrl+c to free GPUs
+handler()
+{
+    echo "Experiment aborted."
+    echo "Freeing ${MISINFO_NUM_GPUS} GPUs: ${MISINFO_GPUS}"
+    python gpu/free_gpus.py -i ${MISINFO_GPUS}
+    exit -1
+}
+trap handler SIGINT
+
+for MISINFO_PRECISION in ${MISINFO_PRECISIONS}; do
+    MISINFO_MODEL_NAME=MISINFO-${DATASET}-${MISINFO_PRE_MODEL_NAME}_${RUN_ID}-${MISINFO_PRECISION}
+    echo "Training misinfo model with precision ${MISINFO_PRECISION}..."
+    python rel/train.py \
+      --precision ${MISINFO_PRECISION} \
+      --seed ${MISINFO_SEED} \
+      --emb_size ${MISINFO_EMB_SIZE} \
+      --emb_model ${MISINFO_EMB_MODEL} \
+      --emb_loss_norm ${MISINFO_EMB_LOSS_NORM} \
+      --train_misinfo_path ${DATASET_PATH}/misinfo.json \
+      --val_misinfo_path ${DATASET_PATH}/misinfo.json \
+      --train_path ${DATASET_PATH}/train.jsonl \
+      --val_path ${DATASET_PATH}/dev.jsonl \
+      --pre_model_name ${MISINFO_PRE_MODEL_NAME} \
+      --model_name ${MISINFO_MODEL_NAME} \
+      --max_seq_len ${MISINFO_MAX_SEQ_LEN} \
+      --batch_size ${MISINFO_BATCH_SIZE} \
+      --eval_batch_size ${MISINFO_EVAL_BATCH_SIZE} \
+      --learning_rate ${MISINFO_LEARNING_RATE} \
+      --gamma ${MISINFO_GAMMA} \
+      --epochs ${MISINFO_TRAIN_EPOCHS} \
+      --gpus ${MISINFO_GPUS}
+
+    echo "Evaluating misinfo model with precision ${MISINFO_PRECISION}..."
+    python rel/evaluate.py \
+      --seed ${MISINFO_SEED} \
+      --emb_size ${MISINFO_EMB_SIZE} \
+      --emb_model ${MISINFO_EMB_MODEL} \
+      --emb_loss_norm ${MISINFO_EMB_LOSS_NORM} \
+      --eval_mode ${MISINFO_EVAL_MODE} \
+      --misinfo_path ${DATASET_PATH}/misinfo.json \
+      --val_path ${DATASET_PATH}/dev.jsonl \
+      --test_path ${DATASET_PATH}/test.jsonl \
+      --pre_model_name ${MISINFO_PRE_MODEL_NAME} \
+      --model_name ${MISINFO_MODEL_NAME} \
+      --max_seq_len ${MISINFO_MAX_SEQ_LEN} \
+      --eval_batch_size ${MISINFO_EVAL_BATCH_SIZE} \
+      --gpus ${MISINFO_GPUS}
+done
+
+echo "Freeing ${MISINFO_NUM_GPUS} GPUs: ${MISINFO_GPUS}"
+python gpu/free_gpus.py -i ${MISINFO_GPUS}
+
+echo "Comparing test F1 against fp32..."
+python - <<EOF
+import json
+import sys
+
+def test_f1(precision):
+    # None when the run of this precision failed and wrote no results
+    path = 'models/MISINFO-${DATASET}-${MISINFO_PRE_MODEL_NAME}_${RUN_ID}-' + precision + '/results.json'
+    try:
+        with open(path) as f:
+            return json.load(f)[0]['test_f1']
+    except (OSError, ValueError, LookupError):
+        return None
+
+base_f1 = test_f1('32')
+if base_f1 is None:
+    print('32\tmissing\tFAIL')
+    sys.exit(1)
+passed = True
+for precision in '${MISINFO_PRECISIONS}'.split():
+    f1 = test_f1(precision)
+    if f1 is None:
+        passed = False
+        print(f'{precision}\tmissing\tFAIL')
+        continue
+    delta = f1 - base_f1
+    ok = abs(delta) <= ${MISINFO_F1_TOLERANCE}
+    passed = passed and ok
+    print(f'{precision}\t{f1:.4f}\t{delta:+.4f}\t{"ok" if ok else "FAIL"}')
+sys.exit(0 if passed else 1)
+EOF
@@ -14,24 +14,10 @@ import string
 import spacy
 import pickle
 import zlib
+import sys
 
-
-def read_jsonl(path):
-	examples = []
-	with open(path, 'r') as f:
-		for line in f:
-			line = line.strip()
-			if line:
-				ex = json.loads(line)
-				examples.append(ex)
-	return examples
-
-
-def write_jsonl(data, path):
-	with open(path, 'w') as f:
-		for example in data:
-			json_data = json.dumps(example, ensure_ascii=False)
-			f.write(json_data + '\n')
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.io_utils import read_jsonl, read_jsonl_generator, write_jsonl
 
 
 def load_dataset(split_path, dataset_args, name):
@@ -7,10 +7,15 @@ from torch.nn.parameter import Parameter
 import torch.nn.functional as F
 import torch
 import torch.distributed as dist
-import numpy as np
 import os
 import math
 import logging
+import sys
+
+from metric_utils import compute_best_threshold_f1
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.precision_utils import bert_hidden_states, full_precision
 
 
 class CovidTwitterPairwiseGenerator(nn.Module):
@@ -92,7 +97,7 @@ class CovidTwitterPairwiseDiscriminator(nn.Module):
 class CovidTwitterPairwiseGanMisinfoModel(pl.LightningModule):
 	def __init__(
 			self, pre_model_name, learning_rate, weight_decay, lr_warmup, updates_total, losses, threshold=None,
-			torch_cache_dir=None, predict_mode=False, predict_path=None, load_pretrained=False
+			torch_cache_dir=None, predict_mode=False, predict_path=None, load_pretrained=False, precision='32'
 	):
 		super().__init__()
 		self.pre_model_name = pre_model_name
@@ -105,6 +110,8 @@ class CovidTwitterPairwiseGanMisinfoModel(pl.LightningModule):
 		self.threshold = threshold
 		self.predict_mode = predict_mode
 		self.predict_path = predict_path
+		# 32, 16 or bf16 autocast of bert, generator, discriminator and losses always run in fp32
+		self.precision = precision
 		if self.predict_mode:
 			if not os.path.exists(self.predict_path):
 				os.mkdir(self.predict_path)
@@ -133,13 +140,18 @@ class CovidTwitterPairwiseGanMisinfoModel(pl.LightningModule):
 		self.d_ema = 0.99
 
 	def training_step(self, batch, batch_idx, optimizer_idx):
+		with full_precision(batch['input_ids'].device):
+			return self._training_step(batch, optimizer_idx)
+
+	def _training_step(self, batch, optimizer_idx):
 		# [bsize], [bsize]
-		outputs = self.bert(
+		contextualized_embeddings = bert_hidden_states(
+			self.bert,
+			self.precision,
 			batch['input_ids'],
-			attention_mask=batch['attention_mask'],
-			token_type_ids=batch['token_type_ids']
+			batch['attention_mask'],
+			batch['token_type_ids']
 		)
-		contextualized_embeddings = outputs[0]
 
 		logits, scores = self.generator(contextualized_embeddings)
 		d_logits, d_probs = self.discriminator(contextualized_embeddings)
@@ -202,11 +214,13 @@ class CovidTwitterPairwiseGanMisinfoModel(pl.LightningModule):
 		return self._eval_step(batch, batch_nb, 'val')
 
 	def _eval_step(self, batch, batch_nb, name):
-		logits, scores = self(batch)
+		with full_precision(batch['input_ids'].device):
+			logits, scores = self(batch)
 
 		if not self.predict_mode:
 			labels = batch['labels']
-			loss = self.generator.loss(logits, labels)
+			with full_precision(batch['input_ids'].device):
+				loss = self.generator.loss(logits, labels)
 			loss = loss.detach()
 			result = {
 				f'{name}_loss': loss,
@@ -281,9 +295,10 @@ class CovidTwitterPairwiseGanMisinfoModel(pl.LightningModule):
 
 	def _get_max_metrics(self, scores, labels, name, threshold=None):
 		if threshold is None:
-			# cosine similarities between -1 and 1
-			threshold_range = self._get_threshold_range()
-		elif isinstance(threshold, list):
+			# exact best threshold over every distinct score, same F1 clamp as _get_metrics
+			_, _, _, threshold, _ = compute_best_threshold_f1(scores, labels, min_f1_denominator=1.0)
+			return self._get_metrics(scores, labels, threshold, name)
+		if isinstance(threshold, list):
 			threshold_range = threshold
 		else:
 			threshold_range = [threshold]
@@ -318,22 +333,16 @@ class CovidTwitterPairwiseGanMisinfoModel(pl.LightningModule):
 		self._eval_epoch_end(outputs, 'test')
 
 	def forward(self, batch):
-		outputs = self.bert(
+		contextualized_embeddings = bert_hidden_states(
+			self.bert,
+			self.precision,
 			batch['input_ids'],
-			attention_mask=batch['attention_mask'],
-			token_type_ids=batch['token_type_ids']
+			batch['attention_mask'],
+			batch['token_type_ids']
 		)
-		contextualized_embeddings = outputs[0]
 
 		return self.generator(contextualized_embeddings)
 
-	def _get_threshold_range(self):
-		return np.arange(
-			start=0.00,
-			stop=1.00,
-			step=0.001
-		)
-
 	def configure_optimizers(self):
 		g_params = self._get_optimizer_params(self.weight_decay, modules=[self.bert, self.generator])
 		g_optimizer = AdamW(
@@ -0,0 +1,69 @@
+import os
+import sys
+
+import torch
+
+from metric_utils import compute_best_threshold_f1
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.export_utils import quantize_dynamic_int8, OnnxBertModel
+from common.precision_utils import full_precision
+
+INFERENCE_MODES = ['fp32', 'int8', 'onnx', 'onnx-int8']
+
+
+def onnx_bert_path(onnx_dir, quantized=False):
+	return os.path.join(onnx_dir, 'bert-int8.onnx' if quantized else 'bert.onnx')
+
+
+def prepare_inference_model(model, inference_mode, onnx_dir=None):
+	"""Switches a loaded fp32 model to a CPU inference mode.
+	int8 dynamically quantizes every nn.Linear, onnx modes replace bert with the graph exported by
+	identify/predict.py --export_onnx, misinfo heads stay in torch.
+	"""
+	if inference_mode == 'fp32':
+		return model
+	if inference_mode == 'int8':
+		return quantize_dynamic_int8(model)
+	if inference_mode in {'onnx', 'onnx-int8'}:
+		if onnx_dir is None:
+			raise ValueError(f'{inference_mode} inference needs an onnx_dir')
+		model.bert = OnnxBertModel(onnx_bert_path(onnx_dir, quantized=inference_mode == 'onnx-int8'))
+		return model
+	raise ValueError(f'Unknown inference mode: {inference_mode}')
+
+
+def batch_scores(model, batch):
+	# misinfo scores of a collated batch, without writing predictions
+	if hasattr(model, '_forward_step'):
+		# (loss, scores) or in predict mode (ex_embs, m_embs, scores)
+		return model._forward_step(batch, 0)[-1]
+	with full_precision(batch['input_ids'].device):
+		_, scores = model(batch)
+	return scores
+
+
+def evaluate_scores(model, data_loader):
+	"""F1 of the model over a labeled data loader, with the threshold rule of the model's eval epoch end.
+	Returns:
+		dict: f1, p, r and threshold.
+	"""
+	scores = []
+	labels = []
+	with torch.no_grad():
+		for batch in data_loader:
+			scores.append(batch_scores(model, batch).detach().float().flatten().cpu())
+			labels.append(batch['labels'].flatten())
+	scores = torch.cat(scores, dim=0)
+	labels = torch.cat(labels, dim=0)
+	if model.threshold is None:
+		_, _, _, threshold, _ = compute_best_threshold_f1(scores, labels, min_f1_denominator=1.0)
+	else:
+		threshold = model.threshold
+	metrics = model._get_metrics(scores, labels, threshold, 'val')
+	return {
+		'f1': float(metrics['val_f1']),
+		'p': float(metrics['val_p']),
+		'r': float(metrics['val_r']),
+		'threshold': float(threshold),
+	}
@@ -54,6 +54,50 @@ def compute_threshold_f1(
 	return max_vals
 
 
+def compute_best_threshold_f1(scores, labels, min_f1_denominator=0.0001):
+	"""Finds the threshold with the best F1 exactly by evaluating every distinct score as a cut point.
+	Scores are sorted once and true positive counts come from a cumulative sum, so the search is O(n log n)
+	instead of recomputing the confusion counts for every threshold of a grid.
+	Returns:
+		f1, p, r, threshold, preds: Same as compute_threshold_f1, preds are scores.gt(threshold).
+	"""
+	flat_scores = scores.flatten()
+	flat_positives = labels.flatten().eq(1)
+	if flat_scores.shape[0] == 0:
+		zero = torch.tensor(0.0, device=scores.device)
+		return zero, zero, zero, 0.0, get_predictions(scores, 0.0)
+	sorted_scores, sort_idxs = torch.sort(flat_scores, descending=True)
+	# [num_examples]
+	cum_tp = torch.cumsum(flat_positives[sort_idxs].float(), dim=0)
+	# last index of every run of equal scores, predicting all scores >= that value as positive
+	is_last = torch.ones_like(sorted_scores, dtype=torch.bool)
+	is_last[:-1] = sorted_scores[:-1].ne(sorted_scores[1:])
+	cut_idxs = torch.nonzero(is_last, as_tuple=False).flatten()
+	cut_scores = sorted_scores[cut_idxs]
+	# thresholds sit halfway to the next lower distinct score, or just below the minimum score
+	next_scores = torch.cat([cut_scores[1:], cut_scores[-1:] - 1.0])
+	thresholds = next_scores + (cut_scores - next_scores) / 2.0
+	# halfway may round onto the cut score for adjacent floats, the next score is still exact
+	thresholds = torch.where(thresholds.lt(cut_scores), thresholds, next_scores)
+	tp = cum_tp[cut_idxs]
+	num_pred = (cut_idxs + 1).float()
+	num_pos = flat_positives.float().sum()
+	# predicting no positives at all, threshold at the maximum score, keeps thresholds in descending order
+	tp = torch.cat([tp.new_zeros(1), tp])
+	num_pred = torch.cat([num_pred.new_zeros(1), num_pred])
+	thresholds = torch.cat([sorted_scores[:1], thresholds])
+	fp = num_pred - tp
+	fn = num_pos - tp
+	precision = tp / torch.clamp(tp + fp, 1.0)
+	recall = tp / torch.clamp(tp + fn, 1.0)
+	f1 = 2.0 * (precision * recall) / (torch.clamp(precision + recall, min_f1_denominator))
+	# cut points are in descending threshold order, ties keep the lowest threshold like an ascending sweep
+	t_idx = len(f1) - 1 - torch.argmax(f1.flip(dims=[0])).item()
+	threshold = thresholds[t_idx].item()
+	preds = get_predictions(scores, threshold)
+	return f1[t_idx], precision[t_idx], recall[t_idx], threshold, preds
+
+
 def find_m_thresholds(emb_model, entities, relations, m_examples, m_entities, t_labels):
 	m_energies = defaultdict(list)
 	m_labels = defaultdict(list)
@@ -82,17 +126,9 @@ def find_m_thresholds(emb_model, entities, relations, m_examples, m_entities, t_
 	m_thresholds = {}
 	for m_id, m_es in m_f_energies.items():
 		scores = -m_es
-		min_score = torch.min(scores).item()
-		max_score = torch.max(scores).item()
-		threshold_range = np.round(np.linspace(
-			min_score,
-			max_score,
-			num=100
-		), 4)
-		f1, p, r, threshold, m_preds = compute_threshold_f1(
+		f1, p, r, threshold, m_preds = compute_best_threshold_f1(
 			scores,
 			m_f_labels[m_id],
-			threshold_range=threshold_range,
 		)
 
 		m_thresholds[m_id] = threshold
@@ -127,17 +163,9 @@ def find_mr_thresholds(emb_model, entities, relations, m_examples, m_entities, t
 	mr_thresholds = {}
 	for m_id, m_es in m_f_energies.items():
 		scores = -m_es
-		min_score = torch.min(scores).item()
-		max_score = torch.max(scores).item()
-		threshold_range = np.round(np.linspace(
-			min_score,
-			max_score,
-			num=100
-		), 4)
-		f1, p, r, threshold, m_preds = compute_threshold_f1(
+		f1, p, r, threshold, m_preds = compute_best_threshold_f1(
 			scores,
 			m_f_labels[m_id],
-			threshold_range=threshold_range,
 		)
 
 		mr_thresholds[m_id] = threshold
@@ -173,17 +201,9 @@ def find_mc_thresholds(emb_model, entities, relations, m_examples, m_entities, t
 	mc_thresholds = {}
 	for m_id, m_es in m_f_energies.items():
 		scores = m_es
-		min_score = torch.min(scores).item()
-		max_score = torch.max(scores).item()
-		threshold_range = np.round(np.linspace(
-			min_score,
-			max_score,
-			num=100
-		), 4)
-		f1, p, r, threshold, m_preds = compute_threshold_f1(
+		f1, p, r, threshold, m_preds = compute_best_threshold_f1(
 			scores,
 			m_f_labels[m_id],
-			threshold_range=threshold_range,
 		)
 
 		mc_thresholds[m_id] = threshold
@@ -215,18 +235,12 @@ def evaluate_m_thresholds(emb_model, entities, relations, m_examples, m_entities
 	scores = torch.tensor(scores, dtype=torch.float)
 	labels = torch.tensor(labels, dtype=torch.long)
 
-	min_score = torch.min(scores).item()
-	max_score = torch.max(scores).item()
-	threshold_range = np.round(np.linspace(
-		min_score,
-		max_score,
-		num=100
-	), 4)
 	# TODO compute f1 for each misinfo target
+	# scores are the binary decisions of the dev-tuned thresholds, so they are scored as is
 	f1, p, r, threshold, preds = compute_threshold_f1(
 		scores,
 		labels,
-		threshold_range=threshold_range,
+		threshold=0.5
 	)
 	return f1, p, r, threshold, preds
 
@@ -256,17 +270,11 @@ def evaluate_mc_thresholds(emb_model, entities, relations, m_examples, m_entitie
 	scores = torch.tensor(scores, dtype=torch.float)
 	labels = torch.tensor(labels, dtype=torch.long)
 
-	min_score = torch.min(scores).item()
-	max_score = torch.max(scores).item()
-	threshold_range = np.round(np.linspace(
-		min_score,
-		max_score,
-		num=100
-	), 4)
 	# TODO compute f1 for each misinfo target
+	# scores are the binary decisions of the dev-tuned thresholds, so they are scored as is
 	f1, p, r, threshold, preds = compute_threshold_f1(
 		scores,
 		labels,
-		threshold_range=threshold_range,
+		threshold=0.5
 	)
 	return f1, p, r, threshold, preds
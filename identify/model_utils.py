@@ -7,16 +7,21 @@ from torch.nn.parameter import Parameter
 import torch.nn.functional as F
 import torch
 import torch.distributed as dist
-import numpy as np
 import os
 import math
 import logging
+import sys
+
+from metric_utils import compute_best_threshold_f1
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.precision_utils import bert_hidden_states, full_precision
 
 
 class BaseCovidTwitterMisinfoModel(pl.LightningModule):
 	def __init__(
 			self, pre_model_name, learning_rate, weight_decay, lr_warmup, updates_total, losses, threshold=None,
-			torch_cache_dir=None, predict_mode=False, predict_path=None, load_pretrained=False
+			torch_cache_dir=None, predict_mode=False, predict_path=None, load_pretrained=False, precision='32'
 	):
 		super().__init__()
 		self.pre_model_name = pre_model_name
@@ -29,6 +34,8 @@ class BaseCovidTwitterMisinfoModel(pl.LightningModule):
 		self.threshold = threshold
 		self.predict_mode = predict_mode
 		self.predict_path = predict_path
+		# 32, 16 or bf16 autocast of bert, heads, logits and losses always run in fp32
+		self.precision = precision
 		if self.predict_mode:
 			if not os.path.exists(self.predict_path):
 				os.mkdir(self.predict_path)
@@ -64,10 +71,13 @@ class BaseCovidTwitterMisinfoModel(pl.LightningModule):
 		eps = 1e-6
 		# [ex_count, m_count]
 		pos_loss = (-pos_logits) * labels_mask
+		# log(sum(exp(neg_logits)) + exp(pos_logits) + eps) in log space, exp of logits up to the
+		# temperature clamp of 100 overflows fp32 and fp16
 		# [ex_count, m_count]
-		norm_loss = torch.log(
+		norm_loss = torch.logaddexp(
 			# [ex_count, 1] * [ex_count, m_count] -> [ex_count, m_count]
-			torch.exp(neg_logits).sum(dim=dim, keepdim=True) + torch.exp(pos_logits) + eps
+			torch.logaddexp(torch.logsumexp(neg_logits, dim=dim, keepdim=True), pos_logits),
+			torch.full_like(pos_logits, math.log(eps))
 		) * labels_mask
 		# [ex_count, m_count]
 		loss = pos_loss + norm_loss
@@ -112,21 +122,22 @@ class BaseCovidTwitterMisinfoModel(pl.LightningModule):
 		return loss
 
 	def _forward_step(self, batch, batch_nb):
-		ex_embs, m_embs, logits, scores = self(
-			input_ids=batch['input_ids'],
-			attention_mask=batch['attention_mask'],
-			token_type_ids=batch['token_type_ids'],
-			batch=batch
-		)
-		if not self.predict_mode:
-			# [ex_count, m_count]
-			labels = batch['labels']
+		with full_precision(batch['input_ids'].device):
+			ex_embs, m_embs, logits, scores = self(
+				input_ids=batch['input_ids'],
+				attention_mask=batch['attention_mask'],
+				token_type_ids=batch['token_type_ids'],
+				batch=batch
+			)
+			if not self.predict_mode:
+				# [ex_count, m_count]
+				labels = batch['labels']
 
-			loss = self._loss(logits, labels)
+				loss = self._loss(logits, labels)
 
-			return loss, scores
-		else:
-			return ex_embs, m_embs, scores
+				return loss, scores
+			else:
+				return ex_embs, m_embs, scores
 
 	def training_step(self, batch, batch_nb):
 		loss, scores = self._forward_step(batch, batch_nb)
@@ -226,18 +237,11 @@ class BaseCovidTwitterMisinfoModel(pl.LightningModule):
 			labels = torch.cat([x[f'{name}_batch_labels'].flatten() for x in outputs], dim=0)
 
 			if self.threshold is None:
-				# cosine similarities between -1 and 1
-				threshold_range = self._get_threshold_range()
+				# exact best threshold over every distinct score, same F1 clamp as _get_metrics
+				_, _, _, threshold, _ = compute_best_threshold_f1(scores, labels, min_f1_denominator=1.0)
 			else:
-				threshold_range = [self.threshold]
-			max_metric = float('-inf')
-			max_metrics = {}
-			for threshold in threshold_range:
-				t_metrics = self._get_metrics(scores, labels, threshold, name)
-				m = t_metrics[f'{name}_f1']
-				if m > max_metric:
-					max_metric = m
-					max_metrics = t_metrics
+				threshold = self.threshold
+			max_metrics = self._get_metrics(scores, labels, threshold, name)
 
 			for metric, value in max_metrics.items():
 				self.log(metric, value)
@@ -277,13 +281,6 @@ class BaseCovidTwitterMisinfoModel(pl.LightningModule):
 
 		return optimizer_params
 
-	def _get_threshold_range(self):
-		return np.arange(
-			start=-1.00,
-			stop=1.00,
-			step=0.05
-		)
-
 
 class CovidTwitterMisinfoModel(BaseCovidTwitterMisinfoModel):
 	def __init__(
@@ -311,12 +308,13 @@ class CovidTwitterMisinfoModel(BaseCovidTwitterMisinfoModel):
 
 	def forward(self, input_ids, attention_mask, token_type_ids, batch):
 		# [num_misinfo + bsize, seq_len, hidden_size]
-		outputs = self.bert(
+		contextualized_embeddings = bert_hidden_states(
+			self.bert,
+			self.precision,
 			input_ids,
-			attention_mask=attention_mask,
-			token_type_ids=token_type_ids
+			attention_mask,
+			token_type_ids
 		)
-		contextualized_embeddings = outputs[0]
 		# [num_misinfo + bsize, hidden_size]
 		lm_output = self._get_lm_output(contextualized_embeddings, attention_mask)
 		lm_output = self.f_dropout(lm_output)
@@ -367,12 +365,13 @@ class CovidTwitterStaticMisinfoModel(BaseCovidTwitterMisinfoModel):
 	def forward(self, input_ids, attention_mask, token_type_ids, batch):
 		num_misinfo = batch['num_misinfo']
 		# [bsize, seq_len, hidden_size]
-		outputs = self.bert(
+		contextualized_embeddings = bert_hidden_states(
+			self.bert,
+			self.precision,
 			input_ids[num_misinfo:],
-			attention_mask=attention_mask[num_misinfo:],
-			token_type_ids=token_type_ids[num_misinfo:]
+			attention_mask[num_misinfo:],
+			token_type_ids[num_misinfo:]
 		)
-		contextualized_embeddings = outputs[0]
 		# [bsize, hidden_size]
 		lm_output = self._get_lm_output(contextualized_embeddings, attention_mask)
 		lm_output = self.f_dropout(lm_output)
@@ -388,13 +387,6 @@ class CovidTwitterStaticMisinfoModel(BaseCovidTwitterMisinfoModel):
 		cls_output = contextualized_embeddings[:, 0]
 		return cls_output
 
-	def _get_threshold_range(self):
-		return np.arange(
-			start=0.00,
-			stop=1.00,
-			step=0.0005
-		)
-
 
 class CovidTwitterMisinfoAvgModel(CovidTwitterMisinfoModel):
 	def __init__(
@@ -436,12 +428,13 @@ class CovidTwitterPairwiseMisinfoModel(BaseCovidTwitterMisinfoModel):
 
 	def forward(self, input_ids, attention_mask, token_type_ids, batch):
 		# [num_misinfo + bsize, seq_len, hidden_size]
-		outputs = self.bert(
+		contextualized_embeddings = bert_hidden_states(
+			self.bert,
+			self.precision,
 			input_ids,
-			attention_mask=attention_mask,
-			token_type_ids=token_type_ids
+			attention_mask,
+			token_type_ids
 		)
-		contextualized_embeddings = outputs[0]
 		# [num_misinfo + bsize, hidden_size]
 		lm_output = self._get_lm_output(contextualized_embeddings, attention_mask)
 		lm_output = self.f_dropout(lm_output)
@@ -457,13 +450,6 @@ class CovidTwitterPairwiseMisinfoModel(BaseCovidTwitterMisinfoModel):
 		cls_output = contextualized_embeddings[:, 0]
 		return cls_output
 
-	def _get_threshold_range(self):
-		return np.arange(
-			start=0.00,
-			stop=1.00,
-			step=0.0001
-		)
-
 
 class CovidTwitterPairwiseEmbMisinfoModel(CovidTwitterMisinfoModel):
 	def __init__(
@@ -475,12 +461,13 @@ class CovidTwitterPairwiseEmbMisinfoModel(CovidTwitterMisinfoModel):
 
 	def forward(self, input_ids, attention_mask, token_type_ids, batch):
 		# [2 * bsize, seq_len, hidden_size]
-		outputs = self.bert(
+		contextualized_embeddings = bert_hidden_states(
+			self.bert,
+			self.precision,
 			input_ids,
-			attention_mask=attention_mask,
-			token_type_ids=token_type_ids
+			attention_mask,
+			token_type_ids
 		)
-		contextualized_embeddings = outputs[0]
 		# [2 * bsize, hidden_size]
 		lm_output = self._get_lm_output(contextualized_embeddings, attention_mask)
 		lm_output = self.f_dropout(lm_output)
@@ -1,20 +1,14 @@
 
+import os
+import sys
 import argparse
 import json
 import torch
 
 from metric_utils import compute_f1
 
-
-def read_jsonl(path):
-	examples = []
-	with open(path, 'r') as f:
-		for line in f:
-			line = line.strip()
-			if line:
-				ex = json.loads(line)
-				examples.append(ex)
-	return examples
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.io_utils import read_jsonl
 
 
 if __name__ == '__main__':
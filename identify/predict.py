@@ -3,6 +3,7 @@ import os
 import json
 import argparse
 import logging
+import copy
 import pytorch_lightning as pl
 from transformers import BertTokenizerFast
 from torch.utils.data import DataLoader
@@ -11,6 +12,10 @@ from pytorch_lightning import loggers as pl_loggers
 from model_utils import *
 from gan_utils import *
 from data_utils import *
+from inference_utils import INFERENCE_MODES, onnx_bert_path, prepare_inference_model, evaluate_scores
+
+from common.export_utils import BertEncoder, export_onnx, quantize_onnx, benchmark, onnxruntime, \
+	ONNX_OPSET_VERSION
 
 import torch
 
@@ -33,10 +38,22 @@ if __name__ == '__main__':
 	parser.add_argument('-mip', '--misinfo_path', default=None)
 	parser.add_argument('-mt', '--model_type', default='lm')
 	parser.add_argument('-es', '--emb_size', default=100, type=int)
-
+	# CPU inference: int8 dynamically quantizes the model, onnx modes run bert as an onnxruntime graph
+	parser.add_argument('-im', '--inference_mode', default='fp32', choices=INFERENCE_MODES)
+	parser.add_argument('-od', '--onnx_dir', default=None)
+	# exports bert.onnx and bert-int8.onnx to onnx_dir from the fp32 checkpoint before predicting
+	parser.add_argument('-eo', '--export_onnx', default=False, action='store_true')
+	parser.add_argument('-ops', '--opset_version', default=ONNX_OPSET_VERSION, type=int)
+	# times bert in every inference mode and reports the val F1 delta to fp32 in export_results.json,
+	# latency and throughput over the first num_benchmark_batches val batches
+	parser.add_argument('-bm', '--benchmark', default=False, action='store_true')
+	parser.add_argument('-nbb', '--num_benchmark_batches', default=32, type=int)
+	parser.add_argument('-nt', '--num_threads', default=None, type=int)
 	args = parser.parse_args()
 
 	pl.seed_everything(args.seed)
+	if args.num_threads is not None:
+		torch.set_num_threads(args.num_threads)
 
 	save_directory = os.path.join(args.save_directory, args.model_name)
 	checkpoint_path = os.path.join(save_directory, 'pytorch_model.bin')
@@ -45,11 +62,16 @@ if __name__ == '__main__':
 		os.makedirs(save_directory)
 
 	checkpoint_path = os.path.join(save_directory, 'pytorch_model.bin')
+	results_path = os.path.join(save_directory, 'export_results.json')
+	onnx_dir = args.onnx_dir if args.onnx_dir is not None else os.path.join(save_directory, 'onnx')
 
 	# export TPU_IP_ADDRESS=10.155.6.34
 	# export XRT_TPU_CONFIG="tpu_worker;0;$TPU_IP_ADDRESS:8470"
 	gpus = [int(x) for x in args.gpus.split(',')]
-	is_distributed = len(gpus) > 1
+	if args.inference_mode != 'fp32':
+		# quantized and onnx models only run on CPU
+		gpus = None
+	is_distributed = gpus is not None and len(gpus) > 1
 	precision = 16 if args.use_tpus else 32
 	# precision = 32
 	tpu_cores = 8
@@ -193,7 +215,69 @@ if __name__ == '__main__':
 
 	# load checkpoint
 	logging.warning(f'Loading weights from trained checkpoint: {checkpoint_path}...')
-	model.load_state_dict(torch.load(checkpoint_path))
+	model.load_state_dict(torch.load(checkpoint_path, map_location='cpu'))
+
+	model.eval()
+	bert_onnx_path = onnx_bert_path(onnx_dir)
+	bert_int8_onnx_path = onnx_bert_path(onnx_dir, quantized=True)
+	if args.export_onnx:
+		if not os.path.exists(onnx_dir):
+			os.makedirs(onnx_dir)
+		# misinfo heads depend on the batch layout, so only the bert encoder is exported
+		logging.info(f'Exporting bert encoder: {bert_onnx_path}')
+		export_onnx(
+			BertEncoder(model.bert),
+			bert_onnx_path,
+			output_dims=2,
+			seq_len=args.max_seq_len,
+			opset_version=args.opset_version
+		)
+		logging.info(f'Quantizing bert encoder: {bert_int8_onnx_path}')
+		quantize_onnx(bert_onnx_path, bert_int8_onnx_path)
+
+	if args.benchmark:
+		modes = ['fp32', 'int8']
+		if onnxruntime is not None and os.path.exists(bert_onnx_path) and os.path.exists(bert_int8_onnx_path):
+			modes.extend(['onnx', 'onnx-int8'])
+		else:
+			logging.warning('onnxruntime or exported bert graphs missing, onnx modes are not benchmarked.')
+		benchmark_batches = []
+		for batch in val_data_loader:
+			if len(benchmark_batches) >= args.num_benchmark_batches:
+				break
+			benchmark_batches.append((batch['input_ids'], batch['attention_mask'], batch['token_type_ids']))
+
+		results = {}
+		for mode in modes:
+			logging.info(f'Benchmarking {mode}...')
+			# int8 quantization and onnx replace modules, so every mode starts from the fp32 weights
+			mode_model = prepare_inference_model(copy.deepcopy(model), mode, onnx_dir)
+			mode_model.eval()
+
+			def encode_batch(input_ids, attention_mask, token_type_ids):
+				return mode_model.bert(input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
+
+			mode_results = benchmark(encode_batch, benchmark_batches)
+			# thresholds tuned and evaluated on val, the same rule for every mode
+			val_metrics = evaluate_scores(mode_model, val_data_loader)
+			mode_results['val_f1'] = val_metrics['f1']
+			mode_results['val_p'] = val_metrics['p']
+			mode_results['val_r'] = val_metrics['r']
+			mode_results['val_f1_delta'] = mode_results['val_f1'] - results['fp32']['val_f1'] if mode != 'fp32' else 0.0
+			results[mode] = mode_results
+
+		logging.info('mode\tlatency_ms\tthroughput\tval_f1\tval_f1_delta')
+		for mode, mode_results in results.items():
+			logging.info(
+				f'{mode}\t{mode_results["latency_ms"]:.2f}\t{mode_results["throughput"]:.1f}'
+				f'\t{mode_results["val_f1"]:.4f}\t{mode_results["val_f1_delta"]:+.4f}'
+			)
+		with open(results_path, 'w') as f:
+			json.dump(results, f, indent=2)
+		logging.info(f'Wrote export results: {results_path}')
+
+	model = prepare_inference_model(model, args.inference_mode, onnx_dir)
+	logging.info(f'inference_mode={args.inference_mode}')
 
 	logger = pl_loggers.TensorBoardLogger(
 		save_dir=save_directory,
@@ -213,7 +297,7 @@ if __name__ == '__main__':
 			checkpoint_callback=False,
 		)
 	else:
-		if len(gpus) > 1:
+		if gpus is not None and len(gpus) > 1:
 			backend = 'ddp' if is_distributed else 'dp'
 		else:
 			backend = None
@@ -12,6 +12,8 @@ from model_utils import *
 from gan_utils import *
 from data_utils import *
 
+from common.precision_utils import PRECISIONS, trainer_precision
+
 import torch
 
 
@@ -41,6 +43,8 @@ if __name__ == '__main__':
 	parser.add_argument('-wd', '--weight_decay', default=0.0, type=float)
 	parser.add_argument('-gcv', '--gradient_clip_val', default=1.0, type=float)
 	parser.add_argument('-th', '--threshold', default=None, type=float)
+	# 16: fp16 autocast with gradient scaling on GPUs, bf16: bf16 autocast (torch>=1.10), TPUs always use XLA bf16
+	parser.add_argument('-pr', '--precision', default='32', choices=PRECISIONS)
 
 	args = parser.parse_args()
 
@@ -56,8 +60,9 @@ if __name__ == '__main__':
 	# export XRT_TPU_CONFIG="tpu_worker;0;$TPU_IP_ADDRESS:8470"
 	gpus = [int(x) for x in args.gpus.split(',')]
 	is_distributed = len(gpus) > 1
-	precision = 16 if args.use_tpus else 32
-	# precision = 32
+	precision = trainer_precision(args.precision, args.use_tpus)
+	# model autocast, XLA handles reduced precision on TPUs
+	model_precision = '32' if args.use_tpus else args.precision
 	tpu_cores = 8
 	num_workers = 4
 	deterministic = True
@@ -317,7 +322,8 @@ if __name__ == '__main__':
 		threshold=args.threshold,
 		losses=args.losses.split(','),
 		torch_cache_dir=args.torch_cache_dir,
-		load_pretrained=args.load_checkpoint is not None
+		load_pretrained=args.load_checkpoint is not None,
+		precision=model_precision
 	)
 
 	model_type = args.model_type.lower()
@@ -1,4 +1,5 @@
 
+import sys
 import argparse
 import random
 import os
@@ -9,26 +10,9 @@ import re
 
 import numpy as np
 
-
-def read_jsonl(path):
-	examples = []
-	with open(path, 'r') as f:
-		for line in f:
-			line = line.strip()
-			if line:
-				try:
-					ex = json.loads(line)
-					examples.append(ex)
-				except Exception as e:
-					print(e)
-	return examples
-
-
-def write_jsonl(data, path):
-	with open(path, 'w') as f:
-		for example in data:
-			json_data = json.dumps(example, ensure_ascii=False)
-			f.write(json_data + '\n')
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.corpus_utils import open_tweet_writer
+from common.tweet_store import load_tweet_lookup
 
 
 if __name__ == '__main__':
@@ -43,29 +27,22 @@ if __name__ == '__main__':
 	random.seed(args.seed)
 
 	print(f'reading {args.input_path}')
-	tweets = {}
-	tweet_list = read_jsonl(args.input_path)
-	for tweet in tweet_list:
-		tweet_id = tweet['data']['id']
-		tweets[tweet_id] = tweet
+	tweets = load_tweet_lookup(args.input_path, key='data.id', skip_errors=True)
 	print(f'Total tweets read: {len(tweets)}')
 
 	print(f'reading {args.articles_path}')
-	articles = {}
-	article_list = read_jsonl(args.articles_path)
-	for article in article_list:
-		url = article['url']
-		articles[url] = article
+	# article stores built with --key url are looked up per tweet url instead of loaded in full
+	articles = load_tweet_lookup(args.articles_path, key='url', skip_errors=True)
 
 	print(f'adding articles to tweets...')
 	transl_table = dict([(ord(x), ord(y)) for x, y in zip(u"‘’´“”–-\n\t", u"'''\"\"--  ")])
-	with open(args.output_path, 'w') as f:
+	with open_tweet_writer(args.output_path) as writer:
 		for tweet_id, tweet in tqdm(tweets.items(), total=len(tweets)):
 			tweet_text = tweet['full_text']
 			for t_url, t_url_info in tweet['urls'].items():
 				t_replace_text = 'URL'
-				if t_url in articles:
-					t_article = articles[t_url]
+				t_article = articles.get(t_url)
+				if t_article is not None:
 					a_text = t_article['title'].translate(transl_table)
 					a_check = a_text.lower().translate(str.maketrans('', '', string.punctuation))
 					t_check = tweet_text.lower().translate(str.maketrans('', '', string.punctuation))
@@ -73,5 +50,5 @@ if __name__ == '__main__':
 						t_replace_text += f': \"{a_text}\"'
 				tweet_text = tweet_text.replace(t_url, t_replace_text)
 			tweet['full_text'] = tweet_text
-			f.write(json.dumps(tweet) + '\n', ensure_ascii=False)
+			writer.write(tweet)
 	print('Done!')
@@ -1,4 +1,5 @@
 
+import sys
 import argparse
 import random
 import os
@@ -11,6 +12,10 @@ import requests
 import time
 
 import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.corpus_utils import open_tweet_writer
+from common.tweet_store import load_tweet_lookup
 # from newspaper import Article, Config
 
 
@@ -71,27 +76,6 @@ def parse_tweet(t):
 	return tweet_id, tweet
 
 
-def read_jsonl(path):
-	examples = []
-	with open(path, 'r') as f:
-		for line in f:
-			line = line.strip()
-			if line:
-				try:
-					ex = json.loads(line)
-					examples.append(ex)
-				except Exception as e:
-					print(e)
-	return examples
-
-
-def write_jsonl(data, path):
-	with open(path, 'w') as f:
-		for example in data:
-			json_data = json.dumps(example, ensure_ascii=False)
-			f.write(json_data + '\n')
-
-
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-i', '--input_path', required=True)
@@ -104,17 +88,13 @@ if __name__ == '__main__':
 	random.seed(args.seed)
 
 	print(f'reading {args.input_path}')
-	tweets = {}
-	tweet_list = read_jsonl(args.input_path)
-	for tweet in tweet_list:
-		tweet_id = tweet['data']['id']
-		tweets[tweet_id] = tweet
+	tweets = load_tweet_lookup(args.input_path, key='data.id', skip_errors=True)
 	print(f'Total tweets read: {len(tweets)}')
 
 	print('Adding tweet references...')
-	with open(args.output_path, 'w') as f:
+	with open_tweet_writer(args.output_path) as writer:
 		with Pool(processes=8) as p:
 			for tweet_id, tweet in tqdm(p.imap_unordered(parse_tweet, tweets.items()), total=len(tweets)):
-				f.write(json.dumps(tweet) + '\n', ensure_ascii=False)
+				writer.write(tweet)
 
 	print('Done!')
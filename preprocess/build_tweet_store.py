@@ -0,0 +1,28 @@
+import os
+import sys
+import argparse
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.corpus_utils import read_tweets
+from common.tweet_store import build_tweet_store, index_path, index_meta_path
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-i', '--input_path', required=True)
+	# .jsonl for plain records, .jsonl.gz or .jsonl.zst compress each record separately
+	parser.add_argument('-o', '--output_path', required=True)
+	# id for processed tweets, data.id for raw tweets and url for articles
+	parser.add_argument('-k', '--key', default='id')
+	args = parser.parse_args()
+
+	print(f'Building store {args.output_path} from {args.input_path}...')
+	num_keys = build_tweet_store(
+		tqdm(read_tweets(args.input_path, skip_errors=True)),
+		args.output_path,
+		key=args.key
+	)
+	print(f'Total keys indexed: {num_keys}')
+	print(f'Index written to {index_path(args.output_path)} and {index_meta_path(args.output_path)}')
+	print('Done!')
@@ -0,0 +1,25 @@
+
+import os
+import sys
+import argparse
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.corpus_utils import read_tweets, open_tweet_writer
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	# formats are picked by extension: .jsonl(.gz/.zst), .parquet or .arrow
+	parser.add_argument('-i', '--input_path', required=True)
+	parser.add_argument('-o', '--output_path', required=True)
+	args = parser.parse_args()
+
+	print(f'Converting {args.input_path} to {args.output_path}...')
+	num_tweets = 0
+	with open_tweet_writer(args.output_path) as writer:
+		for tweet in tqdm(read_tweets(args.input_path, skip_errors=True)):
+			writer.write(tweet)
+			num_tweets += 1
+	print(f'Total tweets converted: {num_tweets}')
+	print('Done!')
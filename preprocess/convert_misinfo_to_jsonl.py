@@ -1,13 +1,11 @@
 
+import os
+import sys
 import json
 import argparse
 
-
-def write_jsonl(data, path):
-	with open(path, 'w') as f:
-		for example in data:
-			json_data = json.dumps(example, ensure_ascii=False)
-			f.write(json_data + '\n')
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.io_utils import write_jsonl
 
 
 if __name__ == '__main__':
@@ -1,27 +1,12 @@
 
+import os
+import sys
 import json
 import argparse
 
-
-def read_jsonl(path):
-	examples = []
-	with open(path, 'r') as f:
-		for line in f:
-			line = line.strip()
-			if line:
-				try:
-					ex = json.loads(line)
-					examples.append(ex)
-				except Exception as e:
-					print(e)
-	return examples
-
-
-def write_jsonl(data, path):
-	with open(path, 'w') as f:
-		for example in data:
-			json_data = json.dumps(example, ensure_ascii=False)
-			f.write(json_data + '\n')
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.io_utils import write_jsonl
+from common.corpus_utils import read_tweets
 
 
 if __name__ == '__main__':
@@ -32,18 +17,18 @@ if __name__ == '__main__':
 	args = parser.parse_args()
 
 	print('Loading tweets...')
-	tweets = read_jsonl(args.input_path)
+	tweets = read_tweets(args.input_path, columns=['id', 'full_text'], skip_errors=True)
 
-	formatted_tweets = []
-	for tweet in tweets:
-		formatted_tweets.append(
+	print('Writing jsonl tweets...')
+	write_jsonl(
+		(
 			{
 				'id': tweet['id'],
 				'contents': tweet['full_text'],
 			}
-		)
-
-	print('Writing jsonl tweets...')
-	write_jsonl(formatted_tweets, args.output_path)
+			for tweet in tweets
+		),
+		args.output_path
+	)
 
 	print('Done!')
@@ -0,0 +1,127 @@
+
+import os
+import sys
+import json
+import random
+import argparse
+from collections import defaultdict
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.corpus_utils import read_tweets
+from common.split_utils import assign_zero_split, zero_split_misinfo, SplitWriter
+
+
+def positive_mids(tweet):
+	return [m_id for m_id, m_label in tweet['misinfo'].items() if m_label != 'not_relevant']
+
+
+def stratify_tweets(tweets):
+	# multi-label tweets are stratified by their rarest positive target so rare targets
+	# are spread over all folds, tweets without a positive target form their own stratum
+	m_counts = defaultdict(int)
+	for tweet in tweets:
+		for m_id in positive_mids(tweet):
+			m_counts[m_id] += 1
+	strata = defaultdict(list)
+	for t_idx, tweet in enumerate(tweets):
+		t_mids = positive_mids(tweet)
+		if len(t_mids) > 0:
+			stratum = min(t_mids, key=lambda m_id: (m_counts[m_id], m_id))
+		else:
+			stratum = 'not_relevant'
+		strata[stratum].append(t_idx)
+	return strata
+
+
+def create_stratified_folds(tweets, num_splits, dev_size, seed):
+	"""Assigns every tweet to train, dev or test for each fold with folds stratified by misinfo target.
+	Returns:
+		list: For each tweet, list of split names for folds 1 to num_splits.
+	"""
+	rng = random.Random(seed)
+	assignments = [['train'] * num_splits for _ in range(len(tweets))]
+	fold_offset = 0
+	for stratum, t_idxs in sorted(stratify_tweets(tweets).items()):
+		rng.shuffle(t_idxs)
+		# continue round robin across strata so small strata do not all land in the first folds
+		t_folds = [(fold_offset + i) % num_splits for i in range(len(t_idxs))]
+		fold_offset = (fold_offset + len(t_idxs)) % num_splits
+		for t_idx, t_fold in zip(t_idxs, t_folds):
+			assignments[t_idx][t_fold] = 'test'
+		for fold in range(num_splits):
+			train_idxs = [t_idx for t_idx, t_fold in zip(t_idxs, t_folds) if t_fold != fold]
+			num_dev = int(round(len(train_idxs) * dev_size))
+			# rotate dev selection so folds do not share the same dev tweets
+			start = (fold * num_dev) % max(len(train_idxs), 1)
+			for i in range(num_dev):
+				t_idx = train_idxs[(start + i) % len(train_idxs)]
+				assignments[t_idx][fold] = 'dev'
+	return assignments
+
+
+def create_zero_folds(misinfo, num_splits, seed):
+	# each misinfo target is held out for testing in exactly one fold, the next fold's targets are used for dev
+	m_ids = sorted(misinfo.keys())
+	random.Random(seed).shuffle(m_ids)
+	m_groups = [set(m_ids[i::num_splits]) for i in range(num_splits)]
+	folds = []
+	for fold in range(num_splits):
+		test_mids = m_groups[fold]
+		dev_mids = m_groups[(fold + 1) % num_splits]
+		folds.append((dev_mids, test_mids))
+	return folds
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-i', '--input_path', required=True)
+	parser.add_argument('-o', '--output_path', required=True)
+	parser.add_argument('-m', '--misinfo_path', default=None)
+	parser.add_argument('-ns', '--num_splits', default=5, type=int)
+	parser.add_argument('-ds', '--dev_size', default=0.1, type=float)
+	# zero-shot folds hold out misinfo targets instead of tweets, like create_zero_split.py
+	parser.add_argument('-z', '--zero_shot', default=False, action='store_true')
+	parser.add_argument('-s', '--seed', default=0, type=int)
+	args = parser.parse_args()
+
+	np.random.seed(args.seed)
+	random.seed(args.seed)
+
+	if not os.path.exists(args.output_path):
+		os.mkdir(args.output_path)
+
+	folds = range(1, args.num_splits + 1)
+	if args.zero_shot:
+		if args.misinfo_path is None:
+			raise ValueError('Zero-shot folds require --misinfo_path')
+		with open(args.misinfo_path) as f:
+			misinfo = json.load(f)
+		zero_folds = create_zero_folds(misinfo, args.num_splits, args.seed)
+		# writes s{k}/{train,dev,test}.jsonl and s{k}/{train,dev,test}_misinfo.json
+		with SplitWriter(args.output_path, [f's{fold}/{split}' for fold in folds for split in ['train', 'dev', 'test']]) as writer:
+			for tweet in read_tweets(args.input_path):
+				for fold, (dev_mids, test_mids) in zip(folds, zero_folds):
+					writer.write(f's{fold}/{assign_zero_split(tweet, dev_mids, test_mids)}', tweet)
+		for fold, (dev_mids, test_mids) in zip(folds, zero_folds):
+			print(f'Split {fold} - Dev targets: {",".join(sorted(dev_mids))}, Test targets: {",".join(sorted(test_mids))}')
+			for split, split_misinfo in zero_split_misinfo(misinfo, dev_mids, test_mids).items():
+				with open(os.path.join(args.output_path, f's{fold}', f'{split}_misinfo.json'), 'w') as f:
+					json.dump(split_misinfo, f, indent=4)
+		split_names = [(fold, f's{fold}/train', f's{fold}/dev', f's{fold}/test') for fold in folds]
+	else:
+		tweets = list(read_tweets(args.input_path))
+		assignments = create_stratified_folds(tweets, args.num_splits, args.dev_size, args.seed)
+		# writes {train,dev,test}_s{k}.jsonl as expected by the multi-split experiments
+		with SplitWriter(args.output_path, [f'{split}_s{fold}' for fold in folds for split in ['train', 'dev', 'test']]) as writer:
+			for tweet, t_splits in zip(tweets, assignments):
+				for fold, split in zip(folds, t_splits):
+					writer.write(f'{split}_s{fold}', tweet)
+		split_names = [(fold, f'train_s{fold}', f'dev_s{fold}', f'test_s{fold}') for fold in folds]
+
+	for fold, train_name, dev_name, test_name in split_names:
+		print(
+			f'Split {fold} - Train size: {writer.counts[train_name]}, '
+			f'Dev size: {writer.counts[dev_name]}, Test size: {writer.counts[test_name]}'
+		)
@@ -1,4 +1,5 @@
 
+import sys
 import os
 import argparse
 from sklearn.model_selection import train_test_split
@@ -6,23 +7,54 @@ import random
 import numpy as np
 import json
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.io_utils import write_jsonl
+from common.corpus_utils import read_tweets
+from common.split_utils import assign_split, assign_fold_split, SplitWriter
 
-def read_jsonl(path):
-	examples = []
-	with open(path, 'r') as f:
-		for line in f:
-			line = line.strip()
-			if line:
-				ex = json.loads(line)
-				examples.append(ex)
-	return examples
 
+def create_random_split(args):
+	data = list(read_tweets(args.input_path))
 
-def write_jsonl(data, path):
-	with open(path, 'w') as f:
-		for example in data:
-			json_data = json.dumps(example, ensure_ascii=False)
-			f.write(json_data + '\n')
+	all_train_data, test_data = train_test_split(
+		data,
+		test_size=args.test_size
+	)
+	train_data, dev_data = train_test_split(
+		all_train_data,
+		test_size=args.dev_size
+	)
+	print(f'Train size: {len(train_data)}, Dev size: {len(dev_data)}, Test size: {len(test_data)}')
+
+	write_jsonl(train_data, os.path.join(args.output_path, 'train.jsonl'))
+	write_jsonl(dev_data, os.path.join(args.output_path, 'dev.jsonl'))
+	write_jsonl(test_data, os.path.join(args.output_path, 'test.jsonl'))
+
+
+def create_hash_split(args):
+	# streams tweets once, each tweet's split only depends on its id and the seed
+	if args.num_splits > 1:
+		names = [f'{split}_s{fold}' for fold in range(1, args.num_splits + 1) for split in ['train', 'dev', 'test']]
+	else:
+		names = ['train', 'dev', 'test']
+	with SplitWriter(args.output_path, names) as writer:
+		for tweet in read_tweets(args.input_path):
+			if args.num_splits > 1:
+				fold_splits = assign_fold_split(tweet['id'], args.seed, args.num_splits, args.dev_size)
+				for fold, split in enumerate(fold_splits, start=1):
+					writer.write(f'{split}_s{fold}', tweet)
+			else:
+				split = assign_split(tweet['id'], args.seed, args.test_size, args.dev_size)
+				writer.write(split, tweet)
+
+	if args.num_splits > 1:
+		for fold in range(1, args.num_splits + 1):
+			print(
+				f'Split {fold} - Train size: {writer.counts[f"train_s{fold}"]}, '
+				f'Dev size: {writer.counts[f"dev_s{fold}"]}, Test size: {writer.counts[f"test_s{fold}"]}'
+			)
+	else:
+		print(f'Train size: {writer.counts["train"]}, Dev size: {writer.counts["dev"]}, Test size: {writer.counts["test"]}')
 
 
 if __name__ == '__main__':
@@ -32,6 +64,11 @@ if __name__ == '__main__':
 	parser.add_argument('-ts', '--test_size', default=0.2, type=float)
 	parser.add_argument('-ds', '--dev_size', default=0.1, type=float)
 	parser.add_argument('-d', '--seed', default=0, type=int)
+	# random: sklearn train_test_split over the full dataset in memory
+	# hash: streaming assignment by a stable hash of tweet id and seed
+	parser.add_argument('-sm', '--split_mode', default='random')
+	# hash mode only, writes {train,dev,test}_s{1..num_splits}.jsonl where each tweet is in one test fold
+	parser.add_argument('-ns', '--num_splits', default=1, type=int)
 	args = parser.parse_args()
 
 	np.random.seed(args.seed)
@@ -40,20 +77,12 @@ if __name__ == '__main__':
 	if not os.path.exists(args.output_path):
 		os.mkdir(args.output_path)
 
-	data = read_jsonl(args.input_path)
-
-	all_train_data, test_data = train_test_split(
-		data,
-		test_size=args.test_size
-	)
-	train_data, dev_data = train_test_split(
-		all_train_data,
-		test_size=args.dev_size
-	)
-	print(f'Train size: {len(train_data)}, Dev size: {len(dev_data)}, Test size: {len(test_data)}')
-
-	write_jsonl(train_data, os.path.join(args.output_path, 'train.jsonl'))
-	write_jsonl(dev_data, os.path.join(args.output_path, 'dev.jsonl'))
-	write_jsonl(test_data, os.path.join(args.output_path, 'test.jsonl'))
-
-
+	split_mode = args.split_mode.lower()
+	if split_mode == 'random':
+		if args.num_splits > 1:
+			raise ValueError('Multiple splits are only supported with split_mode hash')
+		create_random_split(args)
+	elif split_mode == 'hash':
+		create_hash_split(args)
+	else:
+		raise ValueError(f'Unknown split mode: {args.split_mode}')
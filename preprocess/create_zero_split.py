@@ -1,4 +1,5 @@
 
+import sys
 import os
 import argparse
 from sklearn.model_selection import train_test_split
@@ -6,23 +7,9 @@ import random
 import numpy as np
 import json
 
-
-def read_jsonl(path):
-	examples = []
-	with open(path, 'r') as f:
-		for line in f:
-			line = line.strip()
-			if line:
-				ex = json.loads(line)
-				examples.append(ex)
-	return examples
-
-
-def write_jsonl(data, path):
-	with open(path, 'w') as f:
-		for example in data:
-			json_data = json.dumps(example, ensure_ascii=False)
-			f.write(json_data + '\n')
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.corpus_utils import read_tweets
+from common.split_utils import assign_zero_split, zero_split_misinfo, SplitWriter
 
 
 if __name__ == '__main__':
@@ -41,46 +28,20 @@ if __name__ == '__main__':
 	if not os.path.exists(args.output_path):
 		os.mkdir(args.output_path)
 
-	data = read_jsonl(args.input_path)
-
 	with open(args.misinfo_path) as f:
 		misinfo = json.load(f)
 
 	dev_mids = set(args.dev_mids.split(','))
 	test_mids = set(args.test_mids.split(','))
 
-	train_misinfo = {m_id: m for m_id, m in misinfo.items() if m_id not in dev_mids and m_id not in test_mids}
-	dev_misinfo = {m_id: m for m_id, m in misinfo.items() if m_id not in test_mids}
-	test_misinfo = {m_id: m for m_id, m in misinfo.items()}
-
-	train_data = []
-	dev_data = []
-	test_data = []
-
-	for tweet in data:
-		found_mid = False
-		for m_id, m_label in tweet['misinfo'].items():
-			if m_id in test_mids:
-				test_data.append(tweet)
-				found_mid = True
-				break
-			elif m_id in dev_mids:
-				dev_data.append(tweet)
-				found_mid = True
-				break
-		if not found_mid:
-			train_data.append(tweet)
+	with SplitWriter(args.output_path, ['train', 'dev', 'test']) as writer:
+		for tweet in read_tweets(args.input_path):
+			writer.write(assign_zero_split(tweet, dev_mids, test_mids), tweet)
 
-	print(f'Train size: {len(train_data)}, Dev size: {len(dev_data)}, Test size: {len(test_data)}')
+	print(f'Train size: {writer.counts["train"]}, Dev size: {writer.counts["dev"]}, Test size: {writer.counts["test"]}')
 
-	write_jsonl(train_data, os.path.join(args.output_path, 'train.jsonl'))
-	with open(os.path.join(args.output_path, 'train_misinfo.json'), 'w') as f:
-		json.dump(train_misinfo, f, indent=4)
-	write_jsonl(dev_data, os.path.join(args.output_path, 'dev.jsonl'))
-	with open(os.path.join(args.output_path, 'dev_misinfo.json'), 'w') as f:
-		json.dump(dev_misinfo, f, indent=4)
-	write_jsonl(test_data, os.path.join(args.output_path, 'test.jsonl'))
-	with open(os.path.join(args.output_path, 'test_misinfo.json'), 'w') as f:
-		json.dump(test_misinfo, f, indent=4)
+	for split, split_misinfo in zero_split_misinfo(misinfo, dev_mids, test_mids).items():
+		with open(os.path.join(args.output_path, f'{split}_misinfo.json'), 'w') as f:
+			json.dump(split_misinfo, f, indent=4)
 
 
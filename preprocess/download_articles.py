@@ -1,4 +1,5 @@
 
+import sys
 import argparse
 import random
 import os
@@ -11,6 +12,10 @@ from multiprocessing import Pool
 import numpy as np
 from newspaper import Article, Config
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.io_utils import read_jsonl_generator
+from common.corpus_utils import read_tweets
+
 
 config = Config()
 config.fetch_images = False
@@ -27,39 +32,6 @@ def download_article(url):
 	return url, article_text
 
 
-def read_jsonl(path):
-	examples = []
-	with open(path, 'r') as f:
-		for line in f:
-			line = line.strip()
-			if line:
-				try:
-					ex = json.loads(line)
-					examples.append(ex)
-				except Exception as e:
-					print(e)
-	return examples
-
-
-def read_jsonl_generator(path):
-	with open(path, 'r') as f:
-		for line in f:
-			line = line.strip()
-			if line:
-				try:
-					ex = json.loads(line)
-					yield ex
-				except Exception as e:
-					print(e)
-
-
-def write_jsonl(data, path):
-	with open(path, 'w') as f:
-		for example in data:
-			json_data = json.dumps(example, ensure_ascii=False)
-			f.write(json_data + '\n')
-
-
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-i', '--input_path', required=True)
@@ -72,7 +44,7 @@ if __name__ == '__main__':
 
 	print(f'reading {args.input_path}')
 	external_urls = set()
-	tweets_list = read_jsonl_generator(args.input_path)
+	tweets_list = read_tweets(args.input_path, columns=['urls'], skip_errors=True)
 	for tweet in tweets_list:
 		for t_url, t_url_info in tweet['urls'].items():
 			if t_url_info['type'] == 'external' and not t_url_info['quoted']:
@@ -81,7 +53,7 @@ if __name__ == '__main__':
 	print(f'{len(external_urls)} external URLs')
 	if os.path.exists(args.output_path):
 		read_urls = 0
-		article_lines = read_jsonl_generator(args.output_path)
+		article_lines = read_jsonl_generator(args.output_path, skip_errors=True)
 		for article_line in article_lines:
 			url = article_line['url']
 			if url in external_urls:
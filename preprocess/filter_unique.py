@@ -17,26 +17,9 @@ import heapq
 import numpy as np
 import mmh3
 
-
-def read_jsonl(path):
-	examples = []
-	with open(path, 'r') as f:
-		for line in f:
-			line = line.strip()
-			if line:
-				try:
-					ex = json.loads(line)
-					examples.append(ex)
-				except Exception as e:
-					print(e)
-	return examples
-
-
-def write_jsonl(data, path):
-	with open(path, 'w') as f:
-		for example in data:
-			json_data = json.dumps(example, ensure_ascii=False)
-			f.write(json_data + '\n')
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.io_utils import read_jsonl_parallel
+from common.corpus_utils import write_tweets
 
 
 def thread_multi_hash_packed(args):
@@ -506,7 +489,7 @@ if __name__ == '__main__':
 	for file_name in sorted(os.listdir(args.input_path)):
 		file_path = os.path.join(args.input_path, file_name)
 		print(f'reading {file_path}')
-		tweet_lines = read_jsonl(file_path)
+		tweet_lines = read_jsonl_parallel(file_path, processes=8, skip_errors=True)
 		file_tweets = 0
 		for tweet_line in tweet_lines:
 			if 'data' in tweet_line and 'id' in tweet_line['data']:
@@ -574,7 +557,7 @@ if __name__ == '__main__':
 	print(f'Total unique tweets: {len(unique_tweets)}')
 
 	print('Writing tweets...')
-	write_jsonl(
+	write_tweets(
 		unique_tweets.values(),
 		args.output_path
 	)
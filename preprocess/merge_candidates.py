@@ -1,4 +1,5 @@
 
+import sys
 import os
 import json
 from collections import defaultdict
@@ -6,26 +7,9 @@ from tqdm import tqdm
 import numpy as np
 import argparse
 
-
-def read_jsonl(path):
-	examples = []
-	with open(path, 'r') as f:
-		for line in f:
-			line = line.strip()
-			if line:
-				try:
-					ex = json.loads(line)
-					examples.append(ex)
-				except Exception as e:
-					print(e)
-	return examples
-
-
-def write_jsonl(data, path):
-	with open(path, 'w') as f:
-		for example in data:
-			json_data = json.dumps(example, ensure_ascii=False)
-			f.write(json_data + '\n')
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.corpus_utils import write_tweets
+from common.tweet_store import load_tweet_lookup
 
 
 if __name__ == '__main__':
@@ -35,20 +19,19 @@ if __name__ == '__main__':
 	parser.add_argument('-o', '--output_path', required=True)
 	args = parser.parse_args()
 
-	tweets = read_jsonl(args.input_path)
-	tweets = {t['id']: t for t in tweets}
+	tweets = load_tweet_lookup(args.input_path, skip_errors=True)
 	print(f'Total tweets read: {len(tweets)}')
 
-	alt_tweets = read_jsonl(args.alternate_path)
-	alt_tweets = {t['id']: t for t in alt_tweets}
+	alt_tweets = load_tweet_lookup(args.alternate_path, skip_errors=True)
 	print(f'Total alt tweets read: {len(alt_tweets)}')
-	tweet_ids = set(list(tweets.keys()) + list(alt_tweets.keys()))
+	tweet_ids = set(tweets.keys()) | set(alt_tweets.keys())
 	merged_tweets = []
 	pair_count = 0
 	for tweet_id in tweet_ids:
-		if tweet_id in tweets and tweet_id in alt_tweets:
-			tweet = tweets[tweet_id]
-			alt_tweet = alt_tweets[tweet_id]
+		# lookups return None for missing ids, stores only read the tweets that are needed
+		tweet = tweets.get(tweet_id)
+		alt_tweet = alt_tweets.get(tweet_id)
+		if tweet is not None and alt_tweet is not None:
 			tweet_candidates = tweet['candidates']
 			alt_candidates = alt_tweet['candidates']
 			merged_candidates = {}
@@ -67,14 +50,12 @@ if __name__ == '__main__':
 				else:
 					merged_candidates[m_id] = alt_candidates[m_id]
 			tweet['candidates'] = merged_candidates
-		elif tweet_id in tweets:
-			tweet = tweets[tweet_id]
-		else:
-			tweet = alt_tweets[tweet_id]
+		elif tweet is None:
+			tweet = alt_tweet
 		merged_tweets.append(tweet)
 		pair_count += len(tweet['candidates'])
 
 	print(f'Total merged tweets: {len(merged_tweets)}')
 	print(f'Total merged pairs: {pair_count}')
-	write_jsonl(merged_tweets, args.output_path)
+	write_tweets(merged_tweets, args.output_path)
 
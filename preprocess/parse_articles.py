@@ -1,4 +1,5 @@
 
+import sys
 import argparse
 import random
 import os
@@ -11,6 +12,9 @@ from multiprocessing import Pool
 import numpy as np
 from newspaper import Article, Config
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.io_utils import read_jsonl_generator
+
 
 config = Config()
 config.fetch_images = False
@@ -49,25 +53,6 @@ def parse_article(article_dict):
 	return parsed_article
 
 
-def read_jsonl_generator(path):
-	with open(path, 'r') as f:
-		for line in f:
-			line = line.strip()
-			if line:
-				try:
-					ex = json.loads(line)
-					yield ex
-				except Exception as e:
-					print(e)
-
-
-def write_jsonl(data, path):
-	with open(path, 'w') as f:
-		for example in data:
-			json_data = json.dumps(example, ensure_ascii=False)
-			f.write(json_data + '\n')
-
-
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-i', '--input_path', required=True)
@@ -79,7 +64,7 @@ if __name__ == '__main__':
 	random.seed(args.seed)
 
 	print(f'reading {args.input_path}')
-	articles = read_jsonl_generator(args.input_path)
+	articles = read_jsonl_generator(args.input_path, skip_errors=True)
 	with open(args.output_path, 'w') as f:
 		with Pool(processes=8) as p:
 			for p_article in tqdm(p.imap_unordered(parse_article, articles), total=283832):
@@ -120,3 +120,35 @@ python preprocess/create_zero_split.py \
     --misinfo_path data/misinfo.json \
     --dev_mids 2,10 \
     --test_mids 1,4,5,7
+
+# deterministic streaming alternative, writes {train,dev,test}_s{1..5}.jsonl in one pass
+#python preprocess/create_split.py \
+#    --input_path data/unique-art-v1-annotated-bert-bm25-merged.jsonl \
+#    --output_path data/covid-lies \
+#    --split_mode hash \
+#    --num_splits 5 \
+#    --dev_size 0.1
+
+# stratified 5-fold splits for experiments/covid-lies-rel, reads the annotations once
+#python preprocess/create_kfold_split.py \
+#    --input_path data/unique-art-v1-annotated-bert-bm25-merged.jsonl \
+#    --output_path data/covid-lies \
+#    --num_splits 5
+
+# zero-shot 5-fold splits holding out misinfo targets, writes data/v2-folds/s{1..5}/
+#python preprocess/create_kfold_split.py \
+#    --input_path data/unique-art-v1-annotated-bert-bm25-merged.jsonl \
+#    --output_path data/v2-folds \
+#    --misinfo_path data/misinfo.json \
+#    --num_splits 5 \
+#    --zero_shot
+
+# indexed stores for random access by key, select_candidates.py, merge_candidates.py,
+# add_articles.py and add_references.py use the index when it exists next to the input file
+#python preprocess/build_tweet_store.py \
+#    --input_path data/unique-art-v1.jsonl \
+#    --output_path data/unique-art-v1-store.jsonl
+#python preprocess/build_tweet_store.py \
+#    --input_path data/articles.jsonl \
+#    --output_path data/articles-store.jsonl \
+#    --key url
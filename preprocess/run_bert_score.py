@@ -1,4 +1,6 @@
 
+import os
+import sys
 import json
 import argparse
 import logging
@@ -8,26 +10,15 @@ import numpy as np
 import random
 from tqdm import tqdm
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.corpus_utils import read_tweets
+
 
 def divide_chunks(l, n):
 	for i in range(0, len(l), n):
 		yield l[i:i + n]
 
 
-def read_jsonl(path):
-	examples = []
-	with open(path, 'r') as f:
-		for line in f:
-			line = line.strip()
-			if line:
-				try:
-					ex = json.loads(line)
-					examples.append(ex)
-				except Exception as e:
-					print(e)
-	return examples
-
-
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-i', '--input_path', required=True)
@@ -51,7 +42,7 @@ if __name__ == '__main__':
 	transformers.modeling_utils.logger.setLevel(logging.ERROR)
 
 	print('Loading tweets...')
-	tweets = read_jsonl(args.input_path)
+	tweets = list(read_tweets(args.input_path, columns=['id', 'full_text'], skip_errors=True))
 
 	chunk_size = int(np.ceil((len(tweets) / args.total_chunks)))
 
@@ -1,4 +1,6 @@
 
+import os
+import sys
 import json
 from tqdm import tqdm
 import argparse
@@ -6,19 +8,8 @@ from collections import defaultdict
 
 from pyserini.search import SimpleSearcher
 
-
-def read_jsonl(path):
-	examples = []
-	with open(path, 'r') as f:
-		for line in f:
-			line = line.strip()
-			if line:
-				try:
-					ex = json.loads(line)
-					examples.append(ex)
-				except Exception as e:
-					print(e)
-	return examples
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.corpus_utils import read_tweets
 
 
 if __name__ == '__main__':
@@ -31,14 +22,13 @@ if __name__ == '__main__':
 	parser.add_argument('-bb', '--bm25_b', default=0.68, type=float)
 
 	args = parser.parse_args()
-	tweets = read_jsonl(args.query_path)
 
 	searcher = SimpleSearcher(args.index_path)
 	searcher.set_bm25(args.bm25_k1, args.bm25_b)
 	print(f'Running search...')
 
 	scores = {}
-	for t in tqdm(tweets):
+	for t in tqdm(read_tweets(args.query_path, columns=['id', 'full_text'], skip_errors=True)):
 		t_id = t['id']
 		t_text = t['full_text']
 		scores[t_id] = {}
@@ -1,4 +1,5 @@
 
+import sys
 import os
 import json
 from collections import defaultdict
@@ -6,26 +7,9 @@ from tqdm import tqdm
 import numpy as np
 import argparse
 
-
-def read_jsonl(path):
-	examples = []
-	with open(path, 'r') as f:
-		for line in f:
-			line = line.strip()
-			if line:
-				try:
-					ex = json.loads(line)
-					examples.append(ex)
-				except Exception as e:
-					print(e)
-	return examples
-
-
-def write_jsonl(data, path):
-	with open(path, 'w') as f:
-		for example in data:
-			json_data = json.dumps(example, ensure_ascii=False)
-			f.write(json_data + '\n')
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.corpus_utils import write_tweets
+from common.tweet_store import load_tweet_lookup, get_many
 
 
 if __name__ == '__main__':
@@ -38,8 +22,8 @@ if __name__ == '__main__':
 	parser.add_argument('-k', '--top_k', default=100, type=int)
 	args = parser.parse_args()
 
-	tweets = read_jsonl(args.input_path)
-	tweets = {t['id']: t for t in tweets}
+	# indexed tweet stores are only read for the selected candidates instead of loading every tweet
+	tweets = load_tweet_lookup(args.input_path, skip_errors=True)
 
 	print(f'Total tweets read: {len(tweets)}')
 	with open(args.misinfo_path) as f:
@@ -61,13 +45,19 @@ if __name__ == '__main__':
 			key=lambda x: x[0],
 			reverse=True
 		)
+	top_ids = set()
+	for m_id in misinfo:
+		for _, tweet_id in misinfo_scores[m_id][:args.top_k]:
+			top_ids.add(tweet_id)
+	top_tweets = get_many(tweets, top_ids)
+
 	candidate_ids = set()
 	candidate_tweets = []
 	for m_id, m in misinfo.items():
 		m_rel = misinfo_scores[m_id][:args.top_k]
 		rank = 1
 		for t_score, tweet_id in m_rel:
-			tweet = tweets[tweet_id]
+			tweet = top_tweets[tweet_id]
 			if 'candidates' not in tweet:
 				tweet['candidates'] = {}
 			tweet['candidates'][m_id] = {
@@ -81,5 +71,5 @@ if __name__ == '__main__':
 				candidate_ids.add(tweet_id)
 
 	print(f'Total candidate tweets: {len(candidate_tweets)}')
-	write_jsonl(candidate_tweets, args.output_path)
+	write_tweets(candidate_tweets, args.output_path)
 
@@ -0,0 +1,126 @@
+import argparse
+import logging
+import math
+import time
+
+import torch
+
+from emb_utils import TransDEmbedding, RotatEEmbedding, TransMSEmbedding
+
+
+# unfused energies as implemented before the scripted kernels, kept as the benchmark baseline
+def transd_energy_reference(head, rel, tail, td_emb_size, loss_norm):
+	def project(c, c_proj, r_proj):
+		c_p = c + torch.sum(c * c_proj, dim=-1, keepdim=True) * r_proj
+		c_p_norm = torch.norm(c_p, p=2, dim=-1, keepdim=True)
+		return c_p / c_p_norm
+	h, h_proj = head[..., :td_emb_size], head[..., td_emb_size:]
+	r, r_proj = rel[..., :td_emb_size], rel[..., td_emb_size:]
+	t, t_proj = tail[..., :td_emb_size], tail[..., td_emb_size:]
+	h_r_t_diff = project(h, h_proj, r_proj) + r - project(t, t_proj, r_proj)
+	return reference_norm(h_r_t_diff, loss_norm)
+
+
+def rotate_energy_reference(head, rel, tail, td_emb_size, loss_norm):
+	h_re, h_im = head[..., :td_emb_size], head[..., td_emb_size:]
+	t_re, t_im = tail[..., :td_emb_size], tail[..., td_emb_size:]
+	r_phase = torch.tanh(rel) * math.pi
+	r_re = torch.cos(r_phase)
+	r_im = torch.sin(r_phase)
+	re_score = (h_re * r_re - h_im * r_im) - t_re
+	im_score = (h_re * r_im + h_im * r_re) - t_im
+	h_r_t_diff = torch.cat([re_score, im_score], dim=-1)
+	return reference_norm(h_r_t_diff, loss_norm)
+
+
+def transms_energy_reference(head, rel, tail, emb_size, loss_norm):
+	rel = rel[..., :emb_size]
+	alpha = rel[..., -1]
+	alpha = alpha.unsqueeze(dim=-1)
+	h_p = -torch.tanh(tail * rel) * head
+	r_p = rel + alpha * (head * tail)
+	t_p = torch.tanh(head * rel) * tail
+	h_r_t_diff = h_p + r_p - t_p
+	return reference_norm(h_r_t_diff, loss_norm)
+
+
+def reference_norm(h_r_t_diff, loss_norm):
+	if loss_norm == 1:
+		return torch.norm(h_r_t_diff, p=1, dim=-1, keepdim=False)
+	return (h_r_t_diff * h_r_t_diff).sum(dim=-1)
+
+
+def time_energy(energy_func, head, rel, tail, repeats, warmup):
+	with torch.no_grad():
+		# scripted functions profile and fuse on their first few calls
+		for _ in range(warmup):
+			energy_func(head, rel, tail)
+		start = time.perf_counter()
+		for _ in range(repeats):
+			energy = energy_func(head, rel, tail)
+		seconds = (time.perf_counter() - start) / repeats
+	return seconds, energy
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-es', '--emb_size', default=100, type=int)
+	parser.add_argument('-eln', '--emb_loss_norm', default=2, type=int)
+	parser.add_argument('-bs', '--batch_size', default=4096, type=int)
+	parser.add_argument('-nh', '--num_heads', default=1024, type=int)
+	parser.add_argument('-nt', '--num_tails', default=256, type=int)
+	parser.add_argument('-r', '--repeats', default=20, type=int)
+	parser.add_argument('-w', '--warmup', default=3, type=int)
+	parser.add_argument('-th', '--threads', default=None, type=int)
+	parser.add_argument('-se', '--seed', default=0, type=int)
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.INFO, format='%(message)s')
+	torch.manual_seed(args.seed)
+	if args.threads is not None:
+		torch.set_num_threads(args.threads)
+
+	td_emb_size = args.emb_size // 2
+	models = [
+		(
+			'transd',
+			TransDEmbedding(1, args.emb_size, 1.0, args.emb_loss_norm),
+			lambda h, r, t: transd_energy_reference(h, r, t, td_emb_size, args.emb_loss_norm),
+			args.emb_size,
+			args.emb_size,
+		),
+		(
+			'rotate',
+			RotatEEmbedding(1, args.emb_size, 1.0, args.emb_loss_norm),
+			lambda h, r, t: rotate_energy_reference(h, r, t, td_emb_size, args.emb_loss_norm),
+			2 * td_emb_size,
+			td_emb_size,
+		),
+		(
+			'transms',
+			TransMSEmbedding(1, args.emb_size, 1.0, args.emb_loss_norm),
+			lambda h, r, t: transms_energy_reference(h, r, t, args.emb_size, args.emb_loss_norm),
+			args.emb_size,
+			args.emb_size + 1,
+		),
+	]
+	for name, emb_model, reference_func, e_size, r_size in models:
+		shapes = {
+			# training triplets
+			'batch': ([args.batch_size, e_size], [args.batch_size, r_size], [args.batch_size, e_size]),
+			# one relation per tail, as in centroid evaluation
+			'pairwise': ([args.num_heads, 1, e_size], [1, args.num_tails, r_size], [1, args.num_tails, e_size]),
+			# one shared relation, ranking every head against every tail
+			'ranking': ([args.num_heads, 1, e_size], [1, 1, r_size], [1, args.num_tails, e_size]),
+		}
+		for shape_name, (h_shape, r_shape, t_shape) in shapes.items():
+			head = torch.randn(h_shape)
+			rel = torch.randn(r_shape)
+			tail = torch.randn(t_shape)
+			ref_seconds, ref_energy = time_energy(reference_func, head, rel, tail, args.repeats, args.warmup)
+			fused_seconds, fused_energy = time_energy(emb_model.energy, head, rel, tail, args.repeats, args.warmup)
+			max_diff = (ref_energy - fused_energy).abs().max().item()
+			logging.info(
+				f'{name:<8} {shape_name:<9} reference={1000 * ref_seconds:.3f}ms fused={1000 * fused_seconds:.3f}ms '
+				f'speedup={ref_seconds / fused_seconds:.2f}x max_abs_diff={max_diff:.2e}'
+			)
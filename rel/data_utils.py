@@ -1,29 +1,18 @@
 
+import os
+import sys
 import json
+import math
 from collections import defaultdict
 
 import torch
-from torch.utils.data import Dataset
+import torch.distributed as dist
+from torch.utils.data import Dataset, Sampler
 from tqdm import tqdm
 import numpy as np
 
-
-def read_jsonl(path):
-	examples = []
-	with open(path, 'r') as f:
-		for line in f:
-			line = line.strip()
-			if line:
-				ex = json.loads(line)
-				examples.append(ex)
-	return examples
-
-
-def write_jsonl(data, path):
-	with open(path, 'w') as f:
-		for example in data:
-			json_data = json.dumps(example, ensure_ascii=False)
-			f.write(json_data + '\n')
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.io_utils import read_jsonl, read_jsonl_generator, write_jsonl, file_hash
 
 
 def label_text_to_stance_id(label):
@@ -197,6 +186,110 @@ def get_token_features(token):
 	return token_data
 
 
+class TokenTable:
+	"""Tokenized sequences stored as one flat int32 array of input ids with row offsets."""
+	def __init__(self, input_ids, offsets):
+		self.input_ids = input_ids
+		self.offsets = offsets
+
+	@classmethod
+	def from_sequences(cls, sequences):
+		lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+		offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+		offsets[1:] = np.cumsum(lengths)
+		if len(sequences) > 0:
+			input_ids = np.concatenate([np.asarray(seq, dtype=np.int32) for seq in sequences])
+		else:
+			input_ids = np.zeros(0, dtype=np.int32)
+		return cls(input_ids, offsets)
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def lengths(self):
+		return self.offsets[1:] - self.offsets[:-1]
+
+	def __getitem__(self, idx):
+		return self.input_ids[self.offsets[idx]:self.offsets[idx + 1]]
+
+	def token_data(self, idx):
+		# single sequences only, so attention mask and token types follow from the length
+		input_ids = self[idx]
+		return {
+			'input_ids': input_ids,
+			'attention_mask': np.ones(len(input_ids), dtype=np.int32),
+			'token_type_ids': np.zeros(len(input_ids), dtype=np.int32),
+		}
+
+	def save(self, path):
+		if not os.path.exists(path):
+			os.makedirs(path, exist_ok=True)
+		# offsets are written last and both files are moved into place atomically, so
+		# concurrent processes never load a partially written table
+		for name, values in [('input_ids', self.input_ids), ('offsets', self.offsets)]:
+			tmp_path = os.path.join(path, f'{name}.{os.getpid()}.tmp')
+			with open(tmp_path, 'wb') as f:
+				np.save(f, values)
+			os.replace(tmp_path, os.path.join(path, f'{name}.npy'))
+
+	@classmethod
+	def load(cls, path):
+		return cls(
+			np.load(os.path.join(path, 'input_ids.npy'), mmap_mode='r'),
+			np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+		)
+
+	@staticmethod
+	def exists(path):
+		return os.path.exists(os.path.join(path, 'offsets.npy'))
+
+
+def get_tweet_text(doc):
+	tweet_text = doc['full_text'].strip().replace('\r', ' ').replace('\n', ' ')
+	tweet_text = filter_tweet_text(tweet_text)
+	return tweet_text
+
+
+def tokenize_texts(tokenizer, texts, batch_size=1024):
+	# fast tokenizers encode whole batches in parallel
+	sequences = []
+	for b_start in tqdm(range(0, len(texts), batch_size), desc='tokenizing...'):
+		sequences.extend(tokenizer(texts[b_start:b_start + batch_size])['input_ids'])
+	return TokenTable.from_sequences(sequences)
+
+
+def tokenize_documents(documents, tokenizer, batch_size=1024):
+	return tokenize_texts(tokenizer, [get_tweet_text(doc) for doc in documents], batch_size)
+
+
+def token_cache_path(cache_dir, data_path, tokenizer):
+	tokenizer_name = tokenizer.name_or_path.strip('/').replace('/', '_')
+	return os.path.join(cache_dir, f'{file_hash(data_path)}-{tokenizer_name}')
+
+
+def embedding_cache_path(cache_dir, checkpoint_hash, data_path, misinfo_path, max_seq_len):
+	# extracted embeddings depend on the weights, the split, the misinfo targets and truncation
+	return os.path.join(
+		cache_dir,
+		f'{checkpoint_hash}-{file_hash(data_path)}-{file_hash(misinfo_path)}-{max_seq_len}.pt'
+	)
+
+
+def load_document_tokens(data_path, documents, tokenizer, cache_dir=None):
+	"""Tokenizes the tweets of documents read from data_path, one row per document in order.
+	With a cache_dir the table is saved once per file content and tokenizer and memory-mapped afterwards.
+	"""
+	if cache_dir is None:
+		return tokenize_documents(documents, tokenizer)
+	cache_path = token_cache_path(cache_dir, data_path, tokenizer)
+	if not TokenTable.exists(cache_path):
+		tokenize_documents(documents, tokenizer).save(cache_path)
+	tokens = TokenTable.load(cache_path)
+	if len(tokens) != len(documents):
+		raise ValueError(f'Token cache {cache_path} has {len(tokens)} rows but {data_path} has {len(documents)} documents')
+	return tokens
+
+
 class MisinfoDataset(Dataset):
 	def __init__(
 			self,
@@ -206,64 +299,95 @@ class MisinfoDataset(Dataset):
 			pos_samples=1,
 			neg_samples=1,
 			shuffle=False,
-			neg_labels=False
+			neg_labels=False,
+			tokens=None,
+			hard_neg_samples=0
 	):
 		self.generator = None
 		self.shuffle = shuffle
 		self.misinfo = misinfo
 		self.neg_samples = neg_samples
+		# up to hard_neg_samples of the neg_samples are drawn from the hard negative pool of the target,
+		# pools are mined from the model being trained by rel/negative_utils.HardNegativeMiner
+		self.hard_neg_samples = min(hard_neg_samples, neg_samples)
+		self.hard_neg_examples = None
 		self.pos_samples = pos_samples
 		self.neg_labels = neg_labels
-		for m_id, m in self.misinfo.items():
-			m['token_data'] = tokenizer(
-				m['text']
-			)
-		self.examples = []
-		self.pos_examples = defaultdict(list)
-		self.neg_examples = defaultdict(list)
+		# every tweet and misinfo target is tokenized once into a shared row, examples and
+		# sample pools only keep int32 row indices instead of a dict per (tweet, target) pair
+		self.m_ids = list(self.misinfo.keys())
+		self.m_texts = [m['text'] for m in self.misinfo.values()]
+		self.m_tokens = tokenize_texts(tokenizer, self.m_texts)
+		# tokens are rows of a TokenTable in document order, shared with other datasets of the same file
+		if tokens is None:
+			tokens = tokenize_documents(documents, tokenizer)
+		self.t_tokens = tokens
+		self.t_ids = []
+		self.t_texts = []
+		# (t_idx, m_idx, m_label)
+		examples = []
+		pos_examples = defaultdict(list)
+		neg_examples = defaultdict(list)
+		# positive misinfo targets of each tweet, so in-batch negatives can skip false negatives
+		self.t_pos_m_ids = defaultdict(list)
 
 		self.num_labels = defaultdict(int)
 		self.num_classes = defaultdict(int)
 
 		for doc in tqdm(documents, desc='loading documents...'):
-			tweet_id = doc['id']
-			tweet_text = doc['full_text'].strip().replace('\r', ' ').replace('\n', ' ')
-			tweet_text = filter_tweet_text(tweet_text)
-
-			token_data = tokenizer(
-				tweet_text
-			)
-			for m_id, m in self.misinfo.items():
-				m_ex = {
-					'm_id': m_id,
-					'text': m['text'],
-					'token_data': m['token_data']
-				}
-				t_ex = {
-					'id': tweet_id,
-					'text': tweet_text,
-					'token_data': token_data,
-				}
-				d_misinfo = doc['misinfo']
+			t_idx = len(self.t_ids)
+			self.t_ids.append(doc['id'])
+			self.t_texts.append(get_tweet_text(doc))
+			d_misinfo = doc['misinfo']
+			for m_idx, m_id in enumerate(self.m_ids):
 				if m_id in d_misinfo:
 					m_label = label_text_to_relevant_id(d_misinfo[m_id])
 					if m_label > 0:
-						self.examples.append((t_ex, m_ex, m_label))
-						self.pos_examples[m_id].append(t_ex)
+						examples.append((t_idx, m_idx, m_label))
+						pos_examples[m_idx].append(t_idx)
+						self.t_pos_m_ids[t_idx].append(m_id)
 					else:
 						# "hard" negatives created here
 						# TODO consider whether negative samples should be "hard" or "soft"
 						# TODO "hard" being annotated negatives, "soft" being sampled from all other tweets
 						if self.neg_labels:
-							self.examples.append((t_ex, m_ex, m_label))
-						self.neg_examples[m_id].append(t_ex)
+							examples.append((t_idx, m_idx, m_label))
+						neg_examples[m_idx].append(t_idx)
 					self.num_labels[m_label] += 1
 					self.num_classes[m_id] += 1
 				else:
 					# "soft" negatives created here
-					self.neg_examples[m_id].append(t_ex)
+					neg_examples[m_idx].append(t_idx)
 					if self.neg_labels:
-						self.examples.append((t_ex, m_ex, 0))
+						examples.append((t_idx, m_idx, 0))
+
+		# [num_examples, 3]
+		self.examples = np.array(examples, dtype=np.int32).reshape(-1, 3)
+		self.pos_examples = [np.array(pos_examples[m_idx], dtype=np.int32) for m_idx in range(len(self.m_ids))]
+		self.neg_examples = [np.array(neg_examples[m_idx], dtype=np.int32) for m_idx in range(len(self.m_ids))]
+
+	def lengths(self):
+		"""Length of the longest fixed sequence of every example, its tweet or misinfo target, used for bucketing.
+		A collated batch also pads to its positive and negative samples, which are drawn at random per item,
+		so bucketing cuts much less padding on triplet loaders than on the entity and rel loaders.
+		"""
+		t_lengths = self.t_tokens.lengths()[self.examples[:, 0]]
+		m_lengths = self.m_tokens.lengths()[self.examples[:, 1]]
+		return np.maximum(t_lengths, m_lengths)
+
+	def _tweet_example(self, t_idx):
+		return {
+			'id': self.t_ids[t_idx],
+			'text': self.t_texts[t_idx],
+			'token_data': self.t_tokens.token_data(t_idx),
+		}
+
+	def _misinfo_example(self, m_idx):
+		return {
+			'm_id': self.m_ids[m_idx],
+			'text': self.m_texts[m_idx],
+			'token_data': self.m_tokens.token_data(m_idx)
+		}
 
 	def __len__(self):
 		return len(self.examples)
@@ -281,43 +405,78 @@ class MisinfoDataset(Dataset):
 		if torch.is_tensor(idx):
 			idx = idx.tolist()
 
-		t_ex, m_ex, m_label = self.examples[idx]
-		m_id = m_ex['m_id']
+		t_idx, m_idx, m_label = self.examples[idx].tolist()
 
 		pos_samples = self._sample(
-			self.pos_examples[m_id],
+			self.pos_examples[m_idx],
 			self.pos_samples
 		)
 
-		neg_samples = self._sample(
-			self.neg_examples[m_id],
-			self.neg_samples
-		)
+		neg_samples = self._sample_negatives(m_idx)
 
 		subj_obj_sample = self._sample_subj_obj()
 
 		ex = {
-			't_ex': t_ex,
-			'm_ex': m_ex,
+			't_ex': self._tweet_example(t_idx),
+			'm_ex': self._misinfo_example(m_idx),
 			'label': m_label,
-			'p_samples': pos_samples,
-			'n_samples': neg_samples,
+			't_pos_m_ids': self.t_pos_m_ids.get(t_idx, []),
+			'p_samples': [self._tweet_example(s_idx) for s_idx in pos_samples],
+			'n_samples': [self._tweet_example(s_idx) for s_idx in neg_samples],
 			'subj_obj_sample': subj_obj_sample
 		}
 
 		return ex
 
+	def set_hard_negatives(self, hard_neg_examples):
+		# one int32 array of tweet rows for every misinfo target, nearest negatives first
+		self.hard_neg_examples = hard_neg_examples
+
+	def _sample_negatives(self, m_idx):
+		hard_samples = []
+		if self.hard_neg_examples is not None and self.hard_neg_samples > 0:
+			hard_samples = self._sample(self.hard_neg_examples[m_idx], self.hard_neg_samples)
+		# targets without a hard pool fall back to uniform negatives, so every example has neg_samples
+		neg_examples = self.neg_examples[m_idx]
+		if len(hard_samples) == 0 or len(neg_examples) == 0:
+			return self._sample(neg_examples, self.neg_samples)
+		# the hard pool is part of neg_examples, uniform samples are drawn from the rest so no tweet repeats.
+		# neg_examples are sorted rows, so the hard samples are excluded by position without copying the pool
+		excluded = np.searchsorted(neg_examples, hard_samples)
+		excluded = np.unique(excluded[neg_examples[np.minimum(excluded, len(neg_examples) - 1)] == hard_samples])
+		positions = self._sample_indices(len(neg_examples) - len(excluded), self.neg_samples - len(hard_samples))
+		# position j of the remaining pool is j plus the number of excluded positions at or before it
+		positions = positions + np.searchsorted(excluded - np.arange(len(excluded)), positions, side='right')
+		return hard_samples + neg_examples[positions].tolist()
+
 	def _sample(self, m_examples, m_count):
-		samples = []
-		if m_count <= 0:
-			return samples
-		m_s_indices = torch.randperm(
-			n=len(m_examples),
+		# m_count distinct examples, or all of them in random order if there are not enough
+		return m_examples[self._sample_indices(len(m_examples), m_count)].tolist()
+
+	def _sample_indices(self, num_examples, m_count):
+		# positions of m_count distinct examples out of num_examples
+		if m_count <= 0 or num_examples <= 0:
+			return np.zeros(0, dtype=np.int64)
+		if m_count >= num_examples:
+			return torch.randperm(
+				n=num_examples,
+				generator=self.generator
+			).numpy()
+		# Floyd's algorithm, O(m_count) uniform draws instead of permuting the whole pool,
+		# every subset of m_count examples is equally likely
+		draws = torch.rand(
+			size=(m_count,),
 			generator=self.generator
-		).tolist()[:m_count]
-		for s_idx in m_s_indices:
-			samples.append(m_examples[s_idx])
-		return samples
+		).tolist()
+		m_s_indices = []
+		selected = set()
+		for draw, high in zip(draws, range(num_examples - m_count + 1, num_examples + 1)):
+			s_idx = min(int(draw * high), high - 1)
+			if s_idx in selected:
+				s_idx = high - 1
+			selected.add(s_idx)
+			m_s_indices.append(s_idx)
+		return np.array(m_s_indices, dtype=np.int64)
 
 	def _sample_subj_obj(self):
 		r = torch.rand(
@@ -330,27 +489,80 @@ class MisinfoDataset(Dataset):
 			return 1
 
 
+def pad_sequences(sequences, pad_seq_len):
+	"""Copies variable length sequences of input ids into one padded buffer.
+	Args:
+		sequences (list): Input id arrays, truncated to pad_seq_len.
+		pad_seq_len (int): Padded sequence length.
+	Returns:
+		input_ids, attention_mask, token_type_ids long tensors of shape [num_sequences, pad_seq_len].
+	"""
+	lengths = np.array([min(len(seq), pad_seq_len) for seq in sequences], dtype=np.int64)
+	# [num_sequences, pad_seq_len]
+	mask = np.arange(pad_seq_len)[np.newaxis, :] < lengths[:, np.newaxis]
+	input_ids = np.zeros([len(sequences), pad_seq_len], dtype=np.int64)
+	if lengths.sum() > 0:
+		# boolean assignment fills rows in order, matching the concatenated sequences
+		input_ids[mask] = np.concatenate([seq[:length] for seq, length in zip(sequences, lengths)])
+	input_ids = torch.from_numpy(input_ids)
+	attention_mask = torch.from_numpy(mask).long()
+	# all sequences are single segments
+	token_type_ids = torch.zeros_like(input_ids)
+	return input_ids, attention_mask, token_type_ids
+
+
+def calculate_seq_padding(sequences, max_seq_len, force_max_seq_len=False):
+	if force_max_seq_len or len(sequences) == 0:
+		return max_seq_len
+	return min(max(len(seq) for seq in sequences), max_seq_len)
+
+
+def unique_sequences(sequences, max_seq_len):
+	"""De-duplicates sequences after truncation to max_seq_len.
+	Returns:
+		unique_seqs (list): First occurrence of every distinct sequence.
+		seq_index (np.ndarray): Index into unique_seqs for every sequence.
+	"""
+	seq_keys = {}
+	unique_seqs = []
+	seq_index = np.zeros(len(sequences), dtype=np.int64)
+	for seq_idx, seq in enumerate(sequences):
+		key = np.asarray(seq[:max_seq_len], dtype=np.int32).tobytes()
+		if key not in seq_keys:
+			seq_keys[key] = len(unique_seqs)
+			unique_seqs.append(seq)
+		seq_index[seq_idx] = seq_keys[key]
+	return unique_seqs, seq_index
+
+
 class MisinfoBatchCollator:
 	def __init__(
 			self, max_seq_len: int,
-			force_max_seq_len=False
+			force_max_seq_len=False,
+			unique_sequences=False,
+			in_batch_negatives=False
 	):
 		self.max_seq_len = max_seq_len
 		self.force_max_seq_len = force_max_seq_len
-
-	def _calculate_seq_padding(self, examples):
-		if self.force_max_seq_len:
-			pad_seq_len = self.max_seq_len
-		else:
-			pad_seq_len = 0
-			for ex in examples:
-				ex_seqs = [ex['t_ex'], ex['m_ex']] + ex['p_samples'] + ex['n_samples']
-				for ex_seq in ex_seqs:
-					pad_seq_len = max(pad_seq_len, min(len(ex_seq['token_data']['input_ids']), self.max_seq_len))
-		return pad_seq_len
+		# misinfo targets and sampled positives repeat within a batch, with unique_sequences
+		# every distinct sequence is encoded once and gathered back by seq_index
+		self.unique_sequences = unique_sequences
+		self.in_batch_negatives = in_batch_negatives
+
+	@staticmethod
+	def _in_batch_mask(examples):
+		# [bsize, bsize], tweet of example j is a negative for the misinfo target of example i
+		# unless it is the same tweet or annotated as relevant to that target
+		num_examples = len(examples)
+		in_batch_mask = torch.ones([num_examples, num_examples], dtype=torch.float)
+		for i, ex_i in enumerate(examples):
+			m_id = ex_i['m_ex']['m_id']
+			for j, ex_j in enumerate(examples):
+				if ex_j['t_ex']['id'] == ex_i['t_ex']['id'] or m_id in ex_j['t_pos_m_ids']:
+					in_batch_mask[i, j] = 0.0
+		return in_batch_mask
 
 	def __call__(self, examples):
-		pad_seq_len = self._calculate_seq_padding(examples)
 		num_examples = len(examples)
 		pos_samples = len(examples[0]['p_samples'])
 		neg_samples = len(examples[0]['n_samples'])
@@ -358,9 +570,7 @@ class MisinfoBatchCollator:
 		# ex + m + pos_samples + neg_samples
 		num_sequences = num_examples * num_sequences_per_example
 
-		input_ids = torch.zeros([num_examples, num_sequences_per_example, pad_seq_len], dtype=torch.long)
-		attention_mask = torch.zeros([num_examples, num_sequences_per_example, pad_seq_len], dtype=torch.long)
-		token_type_ids = torch.zeros([num_examples, num_sequences_per_example, pad_seq_len], dtype=torch.long)
+		sequences = []
 		subj_obj_mask = torch.zeros([num_examples, 2], dtype=torch.float)
 		ids = []
 		m_ids = []
@@ -371,10 +581,9 @@ class MisinfoBatchCollator:
 			labels.append(ex['label'])
 			ex_seqs = [ex['m_ex'], ex['t_ex']] + ex['p_samples'] + ex['n_samples']
 			subj_obj_mask[ex_idx, ex['subj_obj_sample']] = 1.0
-			for seq_idx, seq in enumerate(ex_seqs):
-				self.pad_and_apply(seq['token_data']['input_ids'], input_ids, ex_idx, seq_idx)
-				self.pad_and_apply(seq['token_data']['attention_mask'], attention_mask, ex_idx, seq_idx)
-				self.pad_and_apply(seq['token_data']['token_type_ids'], token_type_ids, ex_idx, seq_idx)
+			for seq in ex_seqs:
+				sequences.append(seq['token_data']['input_ids'])
+		pad_seq_len = calculate_seq_padding(sequences, self.max_seq_len, self.force_max_seq_len)
 		batch = {
 			'ids': ids,
 			'm_ids': m_ids,
@@ -384,18 +593,39 @@ class MisinfoBatchCollator:
 			'pad_seq_len': pad_seq_len,
 			'num_sequences_per_example': num_sequences_per_example,
 			'num_sequences': num_sequences,
-			'input_ids': input_ids,
-			'attention_mask': attention_mask,
-			'token_type_ids': token_type_ids,
 			'subj_obj_mask': subj_obj_mask,
 			'labels': torch.tensor(labels, dtype=torch.long),
 		}
+		if self.in_batch_negatives:
+			batch['in_batch_mask'] = self._in_batch_mask(examples)
+		if self.unique_sequences:
+			sequences, seq_index = unique_sequences(sequences, pad_seq_len)
+			# [num_unique, pad_seq_len]
+			input_ids, attention_mask, token_type_ids = pad_sequences(sequences, pad_seq_len)
+			batch['num_unique_sequences'] = len(sequences)
+			# [bsize, num_seq]
+			batch['seq_index'] = torch.from_numpy(seq_index).view(num_examples, num_sequences_per_example)
+		else:
+			input_ids, attention_mask, token_type_ids = pad_sequences(sequences, pad_seq_len)
+			input_ids = input_ids.view(num_examples, num_sequences_per_example, pad_seq_len)
+			attention_mask = attention_mask.view(num_examples, num_sequences_per_example, pad_seq_len)
+			token_type_ids = token_type_ids.view(num_examples, num_sequences_per_example, pad_seq_len)
+		batch['input_ids'] = input_ids
+		batch['attention_mask'] = attention_mask
+		batch['token_type_ids'] = token_type_ids
 
 		return batch
 
-	def pad_and_apply(self, id_list, id_tensor, ex_idx, seq_idx):
-		ex_ids = id_list[:self.max_seq_len]
-		id_tensor[ex_idx, seq_idx, :len(ex_ids)] = torch.tensor(ex_ids, dtype=torch.long)
+
+def get_m_examples(documents, misinfo):
+	# misinfo id -> ids of tweets labelled as relevant to it
+	m_examples = defaultdict(list)
+	for doc in documents:
+		d_misinfo = doc['misinfo']
+		for m_id in misinfo:
+			if m_id in d_misinfo and label_text_to_relevant_id(d_misinfo[m_id]) > 0:
+				m_examples[m_id].append(doc['id'])
+	return m_examples
 
 
 class MisinfoEntityDataset(Dataset):
@@ -403,18 +633,16 @@ class MisinfoEntityDataset(Dataset):
 			self,
 			documents,
 			tokenizer,
-			misinfo
+			misinfo,
+			tokens=None
 	):
+		if tokens is None:
+			tokens = tokenize_documents(documents, tokenizer)
+		self.tokens = tokens
 		self.m_examples = defaultdict(list)
 		self.examples = []
 		for doc in tqdm(documents, desc='loading documents...'):
 			tweet_id = doc['id']
-			tweet_text = doc['full_text'].strip().replace('\r', ' ').replace('\n', ' ')
-			tweet_text = filter_tweet_text(tweet_text)
-
-			token_data = tokenizer(
-				tweet_text
-			)
 			t_labels = []
 			for m_id, m in misinfo.items():
 				d_misinfo = doc['misinfo']
@@ -426,7 +654,6 @@ class MisinfoEntityDataset(Dataset):
 			ex = {
 				'id': tweet_id,
 				'e_type': 'entity',
-				'token_data': token_data,
 				't_labels': t_labels
 			}
 			self.examples.append(ex)
@@ -434,11 +661,16 @@ class MisinfoEntityDataset(Dataset):
 	def __len__(self):
 		return len(self.examples)
 
+	def lengths(self):
+		return self.tokens.lengths()
+
 	def __getitem__(self, idx):
 		if torch.is_tensor(idx):
 			idx = idx.tolist()
 
-		return self.examples[idx]
+		ex = dict(self.examples[idx])
+		ex['token_data'] = self.tokens.token_data(idx)
+		return ex
 
 
 class MisinfoRelDataset(Dataset):
@@ -448,27 +680,148 @@ class MisinfoRelDataset(Dataset):
 			tokenizer,
 			m_examples
 	):
+		self.tokens = tokenize_texts(tokenizer, [m['text'] for m in misinfo.values()])
 		self.examples = []
 		for m_id, m in misinfo.items():
-			m_token_data = tokenizer(
-				m['text']
-			)
 			m_ex = {
 				'id': m_id,
 				'e_type': 'rel',
 				'm_examples': m_examples[m_id],
-				'token_data': m_token_data
 			}
 			self.examples.append(m_ex)
 
 	def __len__(self):
 		return len(self.examples)
 
+	def lengths(self):
+		return self.tokens.lengths()
+
 	def __getitem__(self, idx):
 		if torch.is_tensor(idx):
 			idx = idx.tolist()
 
-		return self.examples[idx]
+		ex = dict(self.examples[idx])
+		ex['token_data'] = self.tokens.token_data(idx)
+		return ex
+
+
+class TokenRowDataset(Dataset):
+	"""Rows of a TokenTable as MisinfoPredictBatchCollator examples, e.g. the tweets of a MisinfoDataset."""
+	def __init__(self, tokens, ids, e_type):
+		self.tokens = tokens
+		self.ids = ids
+		self.e_type = e_type
+
+	def __len__(self):
+		return len(self.tokens)
+
+	def lengths(self):
+		return self.tokens.lengths()
+
+	def __getitem__(self, idx):
+		return {
+			'id': self.ids[idx],
+			'e_type': self.e_type,
+			'token_data': self.tokens.token_data(idx),
+		}
+
+
+class BucketBatchSampler(Sampler):
+	"""Groups examples of similar token length into batches to minimize padding.
+	Examples are sorted by length within buckets of bucket_size batches. With shuffle the examples
+	are shuffled before bucketing, so equal lengths are in random order within a bucket, and the
+	batch order is shuffled every epoch. Under torch.distributed every replica takes an equal
+	share of the batches, so the Trainer should not replace the sampler.
+	"""
+	def __init__(self, lengths, batch_size, shuffle=False, drop_last=False, bucket_size=100, seed=0):
+		super().__init__(None)
+		self.lengths = np.asarray(lengths)
+		self.batch_size = batch_size
+		self.shuffle = shuffle
+		self.drop_last = drop_last
+		self.bucket_size = bucket_size
+		self.seed = seed
+		self.epoch = 0
+		# the batch count only depends on the number of examples and replicas, not on the shuffle
+		self._num_batches = {}
+
+	@staticmethod
+	def _replicas():
+		if dist.is_available() and dist.is_initialized():
+			return dist.get_world_size(), dist.get_rank()
+		return 1, 0
+
+	def _batches(self):
+		rng = np.random.RandomState(self.seed + self.epoch)
+		if self.shuffle:
+			indices = rng.permutation(len(self.lengths))
+		else:
+			indices = np.arange(len(self.lengths))
+		bucket_len = self._bucket_len()
+		batches = []
+		for b_start in range(0, len(indices), bucket_len):
+			bucket = indices[b_start:b_start + bucket_len]
+			bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+			for start in range(0, len(bucket), self.batch_size):
+				batches.append(bucket[start:start + self.batch_size].tolist())
+		if self.drop_last:
+			batches = [batch for batch in batches if len(batch) == self.batch_size]
+		if self.shuffle:
+			batches = [batches[b_idx] for b_idx in rng.permutation(len(batches))]
+
+		num_replicas, rank = self._replicas()
+		if num_replicas > 1 and len(batches) > 0:
+			# repeat batches so every replica runs the same number of steps
+			num_batches = math.ceil(len(batches) / num_replicas) * num_replicas
+			while len(batches) < num_batches:
+				batches = batches + batches[:num_batches - len(batches)]
+			batches = batches[rank::num_replicas]
+		return batches
+
+	def __iter__(self):
+		batches = self._batches()
+		self.epoch += 1
+		return iter(batches)
+
+	def _bucket_len(self):
+		# without shuffling all examples form a single bucket
+		if self.shuffle:
+			return self.batch_size * self.bucket_size
+		return max(len(self.lengths), 1)
+
+	def __len__(self):
+		num_replicas, _ = self._replicas()
+		if num_replicas not in self._num_batches:
+			num_examples = len(self.lengths)
+			bucket_len = self._bucket_len()
+			num_batches = 0
+			for b_start in range(0, num_examples, bucket_len):
+				b_size = min(bucket_len, num_examples - b_start)
+				if self.drop_last:
+					num_batches += b_size // self.batch_size
+				else:
+					num_batches += math.ceil(b_size / self.batch_size)
+			self._num_batches[num_replicas] = math.ceil(num_batches / num_replicas)
+		return self._num_batches[num_replicas]
+
+
+def get_batch_args(dataset, batch_size, shuffle=False, drop_last=False, bucket_batches=False, seed=0):
+	"""DataLoader batching arguments, either a plain batch size or a length-bucketed batch sampler."""
+	if bucket_batches:
+		return {
+			'batch_sampler': BucketBatchSampler(
+				dataset.lengths(),
+				batch_size,
+				shuffle=shuffle,
+				drop_last=drop_last,
+				seed=seed
+			)
+		}
+	return {
+		'batch_size': batch_size,
+		'shuffle': shuffle,
+		'drop_last': drop_last
+	}
 
 
 class MisinfoPredictBatchCollator:
@@ -479,34 +832,22 @@ class MisinfoPredictBatchCollator:
 		self.max_seq_len = max_seq_len
 		self.force_max_seq_len = force_max_seq_len
 
-	def _calculate_seq_padding(self, examples):
-		if self.force_max_seq_len:
-			pad_seq_len = self.max_seq_len
-		else:
-			pad_seq_len = 0
-			for ex in examples:
-				pad_seq_len = max(pad_seq_len, min(len(ex['token_data']['input_ids']), self.max_seq_len))
-		return pad_seq_len
-
 	def __call__(self, examples):
-		pad_seq_len = self._calculate_seq_padding(examples)
 		num_examples = len(examples)
 
-		input_ids = torch.zeros([num_examples, pad_seq_len], dtype=torch.long)
-		attention_mask = torch.zeros([num_examples, pad_seq_len], dtype=torch.long)
-		token_type_ids = torch.zeros([num_examples, pad_seq_len], dtype=torch.long)
+		sequences = []
 		ids = []
 		m_examples = []
 		t_labels = []
-		for ex_idx, ex in enumerate(examples):
+		for ex in examples:
 			ids.append(ex['id'])
 			if 'm_examples' in ex:
 				m_examples.append(','.join(ex['m_examples']))
 			if 't_labels' in ex:
 				t_labels.append(','.join(ex['t_labels']))
-			self.pad_and_apply(ex['token_data']['input_ids'], input_ids, ex_idx)
-			self.pad_and_apply(ex['token_data']['attention_mask'], attention_mask, ex_idx)
-			self.pad_and_apply(ex['token_data']['token_type_ids'], token_type_ids, ex_idx)
+			sequences.append(ex['token_data']['input_ids'])
+		pad_seq_len = calculate_seq_padding(sequences, self.max_seq_len, self.force_max_seq_len)
+		input_ids, attention_mask, token_type_ids = pad_sequences(sequences, pad_seq_len)
 
 		batch = {
 			'ids': ids,
@@ -524,7 +865,3 @@ class MisinfoPredictBatchCollator:
 			batch['t_labels'] = t_labels
 
 		return batch
-
-	def pad_and_apply(self, id_list, id_tensor, ex_idx):
-		ex_ids = id_list[:self.max_seq_len]
-		id_tensor[ex_idx, :len(ex_ids)] = torch.tensor(ex_ids, dtype=torch.long)
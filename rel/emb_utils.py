@@ -1,8 +1,98 @@
 
-import math
 from torch import nn
+import torch.nn.functional as F
 import torch
-import numpy as np
+
+
+# Energy kernels below are scripted so the elementwise chains fuse into as few kernels as possible.
+# Broadcasting contract: head, rel and tail are [..., emb_size] tensors whose leading dims broadcast
+# against each other, and the energy has the broadcast leading shape. Pairwise scoring of
+# [n_heads, 1, d] with [1, n_tails, d] is reduced with a matmul instead of a [n_heads, n_tails, d] diff
+# wherever the relation does not depend on both sides.
+# Energies are always accumulated in fp32: embeddings may be fp16 / bf16 (reduced precision training,
+# float16 prediction shards), where squared distances overflow or cancel. .float() is a no-op for fp32.
+
+
+@torch.jit.script
+def _is_outer(a, b):
+	# [n, 1, d] against [1, m, d] with n, m > 1
+	return a.dim() == 3 and b.dim() == 3 and a.size(1) == 1 and b.size(0) == 1 \
+		and a.size(0) > 1 and b.size(1) > 1
+
+
+@torch.jit.script
+def _outer_sq_dist(a, b):
+	# [n, d] and [m, d]
+	a = a.squeeze(1)
+	b = b.squeeze(0)
+	# ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b, clamped as rounding can go slightly negative
+	sq_dist = (a * a).sum(dim=-1, keepdim=True) + (b * b).sum(dim=-1).unsqueeze(0) - 2.0 * torch.matmul(a, b.t())
+	return torch.clamp(sq_dist, min=0.0)
+
+
+@torch.jit.script
+def distance(a, b, loss_norm: int):
+	# l1 norm or l2 norm squared of a - b over the last dim
+	a = a.float()
+	b = b.float()
+	if loss_norm == 1:
+		return (a - b).abs().sum(dim=-1)
+	elif loss_norm == 2:
+		if _is_outer(a, b):
+			return _outer_sq_dist(a, b)
+		if _is_outer(b, a):
+			return _outer_sq_dist(b, a)
+		diff = a - b
+		return (diff * diff).sum(dim=-1)
+	else:
+		raise ValueError('Unknown loss norm: ' + str(loss_norm))
+
+
+@torch.jit.script
+def _transd_project(c, c_proj, r_proj):
+	c_p = c + torch.sum(c * c_proj, dim=-1, keepdim=True) * r_proj
+	# same eps as F.normalize, a zero projection stays zero instead of nan
+	return c_p * torch.rsqrt(torch.clamp(torch.sum(c_p * c_p, dim=-1, keepdim=True), min=1e-24))
+
+
+@torch.jit.script
+def transd_energy(head, rel, tail, td_emb_size: int, loss_norm: int):
+	head, rel, tail = head.float(), rel.float(), tail.float()
+	h, h_proj = head.narrow(-1, 0, td_emb_size), head.narrow(-1, td_emb_size, td_emb_size)
+	r, r_proj = rel.narrow(-1, 0, td_emb_size), rel.narrow(-1, td_emb_size, td_emb_size)
+	t, t_proj = tail.narrow(-1, 0, td_emb_size), tail.narrow(-1, td_emb_size, td_emb_size)
+	h_p = _transd_project(h, h_proj, r_proj)
+	t_p = _transd_project(t, t_proj, r_proj)
+	return distance(h_p + r, t_p, loss_norm)
+
+
+@torch.jit.script
+def rotate_energy(head, rel, tail, td_emb_size: int, loss_norm: int):
+	head, rel, tail = head.float(), rel.float(), tail.float()
+	h_re, h_im = head.narrow(-1, 0, td_emb_size), head.narrow(-1, td_emb_size, td_emb_size)
+	t_re, t_im = tail.narrow(-1, 0, td_emb_size), tail.narrow(-1, td_emb_size, td_emb_size)
+	r_phase = torch.tanh(rel) * 3.141592653589793
+	r_re = torch.cos(r_phase)
+	r_im = torch.sin(r_phase)
+	hr_re = h_re * r_re - h_im * r_im
+	hr_im = h_re * r_im + h_im * r_re
+	# real and imaginary parts are reduced separately instead of concatenated
+	return distance(hr_re, t_re, loss_norm) + distance(hr_im, t_im, loss_norm)
+
+
+@torch.jit.script
+def transms_energy(head, rel, tail, emb_size: int, loss_norm: int):
+	head, rel, tail = head.float(), rel.float(), tail.float()
+	rel = rel.narrow(-1, 0, emb_size)
+	alpha = rel.narrow(-1, emb_size - 1, 1)
+	# head and tail interact inside the tanh terms, so this stays one fused elementwise chain
+	h_r_t_diff = rel + alpha * (head * tail) - torch.tanh(tail * rel) * head - torch.tanh(head * rel) * tail
+	if loss_norm == 1:
+		return h_r_t_diff.abs().sum(dim=-1)
+	elif loss_norm == 2:
+		return (h_r_t_diff * h_r_t_diff).sum(dim=-1)
+	else:
+		raise ValueError('Unknown loss norm: ' + str(loss_norm))
 
 
 class TransDEmbedding(nn.Module):
@@ -45,36 +135,13 @@ class TransDEmbedding(nn.Module):
 
 		# [bsize * num_seq, emb_size]
 		# ex_embs = ex_embs / torch.clamp(ex_emb_norms, min=1.0)
-		ex_emb_norms = torch.norm(ex_embs, p=2, dim=-1, keepdim=True)
-		ex_embs = ex_embs / ex_emb_norms
+		ex_embs = F.normalize(ex_embs, p=2, dim=-1)
 
 		ex_embs = torch.cat([ex_embs, ex_projs], dim=-1)
 		return ex_embs
 
-	@staticmethod
-	def project(c, c_proj, r_proj):
-		c_p = c + torch.sum(c * c_proj, dim=-1, keepdim=True) * r_proj
-		c_p_norm = torch.norm(c_p, p=2, dim=-1, keepdim=True)
-		# c_p = c_p / torch.clamp(c_p_norm, min=1.0)
-		c_p = c_p / c_p_norm
-		return c_p
-
 	def energy(self, head, rel, tail):
-		h, h_proj = head[..., :self.td_emb_size], head[..., self.td_emb_size:]
-		r, r_proj = rel[..., :self.td_emb_size], rel[..., self.td_emb_size:]
-		t, t_proj = tail[..., :self.td_emb_size], tail[..., self.td_emb_size:]
-		h_p = self.project(h, h_proj, r_proj)
-		t_p = self.project(t, t_proj, r_proj)
-		h_r_t_diff = h_p + r - t_p
-		# h_r_t_energy = torch.norm(h_r_t_diff, p=2, dim=-1, keepdim=False)
-		# l2 norm squared = sum of squares
-		if self.loss_norm == 1:
-			h_r_t_energy = torch.norm(h_r_t_diff, p=1, dim=-1, keepdim=False)
-		elif self.loss_norm == 2:
-			h_r_t_energy = (h_r_t_diff * h_r_t_diff).sum(dim=-1)
-		else:
-			raise ValueError(f'Unknown loss norm: {self.loss_norm}')
-		return h_r_t_energy
+		return transd_energy(head, rel, tail, self.td_emb_size, self.loss_norm)
 
 	def loss(self, pos_energy, neg_energy):
 		margin = pos_energy - neg_energy
@@ -102,9 +169,8 @@ class TransEEmbedding(nn.Module):
 		if emb_type == 'entity':
 			# [bsize * num_seq, emb_size]
 			ex_embs = self.e_emb_layer(source_embeddings)
-			ex_emb_norms = torch.norm(ex_embs, p=2, dim=-1, keepdim=True)
-			# [bsize * num_seq, emb_size]
-			ex_embs = ex_embs / ex_emb_norms
+			# [bsize * num_seq, emb_size], eps guarded so a zero embedding does not turn into nan
+			ex_embs = F.normalize(ex_embs, p=2, dim=-1)
 		elif emb_type == 'rel':
 			# [bsize * num_seq, emb_size]
 			ex_embs = self.r_emb_layer(source_embeddings)
@@ -114,7 +180,7 @@ class TransEEmbedding(nn.Module):
 		return ex_embs
 
 	def energy(self, head, rel, tail):
-		h_r_t_diff = head + rel - tail
+		h_r_t_diff = head.float() + rel.float() - tail.float()
 		if self.loss_norm == 1:
 			h_r_t_energy = torch.norm(h_r_t_diff, p=1, dim=-1, keepdim=False)
 		elif self.loss_norm == 2:
@@ -123,6 +189,10 @@ class TransEEmbedding(nn.Module):
 			raise ValueError(f'Unknown loss norm: {self.loss_norm}')
 		return h_r_t_energy
 
+	def all_pairs_energy(self, heads, rels, tails):
+		# every head against the translated tails t - r, [num_heads, num_rels]
+		return distance(heads.unsqueeze(dim=1), (tails - rels).unsqueeze(dim=0), self.loss_norm)
+
 	def loss(self, pos_energy, neg_energy):
 		margin = pos_energy - neg_energy
 		loss = torch.clamp(self.gamma + margin, min=0.0)
@@ -140,7 +210,7 @@ class KNNEmbedding(nn.Module):
 		return source_embeddings
 
 	def energy(self, head, rel, tail):
-		h_r_t_diff = head - tail
+		h_r_t_diff = head.float() - tail.float()
 		if self.loss_norm == 1:
 			h_r_t_energy = torch.norm(h_r_t_diff, p=1, dim=-1, keepdim=False)
 		elif self.loss_norm == 2:
@@ -149,6 +219,10 @@ class KNNEmbedding(nn.Module):
 			raise ValueError(f'Unknown loss norm: {self.loss_norm}')
 		return h_r_t_energy
 
+	def all_pairs_energy(self, heads, rels, tails):
+		# [num_heads, num_rels]
+		return distance(heads.unsqueeze(dim=1), tails.unsqueeze(dim=0), self.loss_norm)
+
 	def loss(self, pos_energy, neg_energy):
 		margin = pos_energy - neg_energy
 		loss = torch.clamp(self.gamma + margin, min=0.0)
@@ -191,24 +265,7 @@ class RotatEEmbedding(nn.Module):
 			raise ValueError(f'Unknown emb type: {emb_type}')
 
 	def energy(self, head, rel, tail):
-		h_re, h_im = head[..., :self.td_emb_size], head[..., self.td_emb_size:]
-		t_re, t_im = tail[..., :self.td_emb_size], tail[..., self.td_emb_size:]
-		r_phase = torch.tanh(rel) * math.pi
-		r_re = torch.cos(r_phase)
-		r_im = torch.sin(r_phase)
-
-		re_score = (h_re * r_re - h_im * r_im) - t_re
-		im_score = (h_re * r_im + h_im * r_re) - t_im
-		h_r_t_diff = torch.cat([re_score, im_score], dim=-1)
-
-		# l2 norm squared = sum of squares
-		if self.loss_norm == 1:
-			h_r_t_energy = torch.norm(h_r_t_diff, p=1, dim=-1, keepdim=False)
-		elif self.loss_norm == 2:
-			h_r_t_energy = (h_r_t_diff * h_r_t_diff).sum(dim=-1)
-		else:
-			raise ValueError(f'Unknown loss norm: {self.loss_norm}')
-		return h_r_t_energy
+		return rotate_energy(head, rel, tail, self.td_emb_size, self.loss_norm)
 
 	def loss(self, pos_energy, neg_energy):
 		pos_loss = -torch.log(torch.sigmoid(self.gamma - pos_energy) + 1e-6)
@@ -237,9 +294,8 @@ class TransMSEmbedding(nn.Module):
 		if emb_type == 'entity':
 			# [bsize * num_seq, emb_size]
 			ex_embs = self.e_emb_layer(source_embeddings)
-			ex_emb_norms = torch.norm(ex_embs, p=2, dim=-1, keepdim=True)
-			# [bsize * num_seq, emb_size]
-			ex_embs = ex_embs / ex_emb_norms
+			# [bsize * num_seq, emb_size], eps guarded so a zero embedding does not turn into nan
+			ex_embs = F.normalize(ex_embs, p=2, dim=-1)
 		elif emb_type == 'rel':
 			# [bsize * num_seq, emb_size]
 			ex_embs = self.r_emb_layer(source_embeddings)
@@ -249,21 +305,7 @@ class TransMSEmbedding(nn.Module):
 		return ex_embs
 
 	def energy(self, head, rel, tail):
-		rel = rel[..., :self.emb_size]
-		alpha = rel[..., -1]
-		alpha = alpha.unsqueeze(dim=-1)
-		h_p = -torch.tanh(tail * rel) * head
-		r_p = rel + alpha * (head * tail)
-		t_p = torch.tanh(head * rel) * tail
-
-		h_r_t_diff = h_p + r_p - t_p
-		if self.loss_norm == 1:
-			h_r_t_energy = torch.norm(h_r_t_diff, p=1, dim=-1, keepdim=False)
-		elif self.loss_norm == 2:
-			h_r_t_energy = (h_r_t_diff * h_r_t_diff).sum(dim=-1)
-		else:
-			raise ValueError(f'Unknown loss norm: {self.loss_norm}')
-		return h_r_t_energy
+		return transms_energy(head, rel, tail, self.emb_size, self.loss_norm)
 
 	def loss(self, pos_energy, neg_energy):
 		margin = pos_energy - neg_energy
@@ -279,8 +321,9 @@ class TuckEREmbedding(nn.Module):
 		self.emb_size = emb_size
 		self.loss_norm = loss_norm
 
+		# created in the default float dtype so the core follows the model dtype
 		self.weight = nn.parameter.Parameter(
-			torch.tensor(np.random.uniform(-1, 1, (self.emb_size, self.emb_size, self.emb_size)))
+			torch.empty(self.emb_size, self.emb_size, self.emb_size).uniform_(-1, 1)
 		)
 
 		self.e_emb_layer = nn.Linear(
@@ -305,26 +348,33 @@ class TuckEREmbedding(nn.Module):
 		else:
 			raise ValueError(f'Unknown emb type: {emb_type}')
 
+	def reduced_core(self):
+		# the energy scales head, rel and tail on the first core axis and sums the other two axes,
+		# so the core reduces to one weight per dimension instead of broadcasting it
+		# [emb_size]
+		return self.weight.sum(dim=(1, 2))
+
 	def energy(self, head, rel, tail):
-		num_batch_dims = len(head.shape) - 1
-		w = self.weight
-		# [1, 1, ..., e_size, e_size, e_size]
-		for _ in range(num_batch_dims):
-			w = w.unsqueeze(dim=0)
-		head = head.unsqueeze(dim=-1)
-		head = head.unsqueeze(dim=-1)
-		# [..., emb_size, emb_size, emb_size] -> [..., emb_size, emb_size]
-		w = (w * head).sum(dim=-1)
-		# [..., emb_size, 1]
-		rel = rel.unsqueeze(dim=-1)
-		# [..., emb_size]
-		w = (w * rel).sum(dim=-1)
 		# [...]
-		w = (w * tail).sum(dim=-1)
+		w = (head.float() * rel.float() * tail.float() * self.reduced_core().float()).sum(dim=-1)
 		# this is treated as a score by TuckER, so - makes energy
 		h_r_t_energy = -w
 		return h_r_t_energy
 
+	def all_pairs_energy(self, heads, rels, tails):
+		"""Energy of every head with every (relation, tail) pair as one matmul.
+		Args:
+			heads: [num_heads, emb_size] head entity embeddings.
+			rels: [num_rels, emb_size] relation embeddings.
+			tails: [num_rels, emb_size] tail entity embeddings, one for each relation.
+		Returns:
+			[num_heads, num_rels] energies.
+		"""
+		# [num_heads, emb_size]
+		h_core = heads.float() * self.reduced_core().float()
+		# [num_heads, num_rels]
+		return -torch.matmul(h_core, (rels.float() * tails.float()).t())
+
 	def loss(self, pos_energy, neg_energy):
 
 		pos_loss = -torch.log(torch.sigmoid(-pos_energy) + 1e-6)
@@ -332,3 +382,20 @@ class TuckEREmbedding(nn.Module):
 		loss = pos_loss + neg_loss
 		accuracy = (pos_energy.lt(neg_energy)).float().mean()
 		return loss, accuracy
+
+
+def build_emb_model(emb_model, hidden_size, emb_size, gamma, emb_loss_norm):
+	if emb_model == 'transd':
+		return TransDEmbedding(hidden_size, emb_size, gamma, emb_loss_norm)
+	elif emb_model == 'transe':
+		return TransEEmbedding(hidden_size, emb_size, gamma, emb_loss_norm)
+	elif emb_model == 'knn':
+		return KNNEmbedding(gamma, emb_loss_norm)
+	elif emb_model == 'rotate':
+		return RotatEEmbedding(hidden_size, emb_size, gamma, emb_loss_norm)
+	elif emb_model == 'transms':
+		return TransMSEmbedding(hidden_size, emb_size, gamma, emb_loss_norm)
+	elif emb_model == 'tucker':
+		return TuckEREmbedding(hidden_size, emb_size, gamma, emb_loss_norm)
+	else:
+		raise ValueError(f'Unknown embedding model: {emb_model}')
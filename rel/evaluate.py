@@ -12,6 +12,7 @@ from pytorch_lightning import loggers as pl_loggers
 
 from model_utils import *
 from data_utils import *
+from inference_utils import INFERENCE_MODES, prepare_inference_model
 
 import torch
 
@@ -36,7 +37,19 @@ if __name__ == '__main__':
 	parser.add_argument('-mtl', '--model_layers', default=1, type=int)
 	parser.add_argument('-evm', '--eval_mode', default='centroid')
 	parser.add_argument('-evn', '--eval_noise', default=None, type=float)
+	parser.add_argument('-tcd', '--token_cache_dir', default=None)
+	# collated batches are copied to page-locked memory by the DataLoader for faster host to GPU transfer
+	parser.add_argument('-pin', '--pin_memory', default=False, action='store_true')
+	# batches tweets of similar token length together to reduce padding
+	parser.add_argument('-bb', '--bucket_batches', default=False, action='store_true')
+	# extracted val/test embeddings are cached per checkpoint and split, so re-running with another
+	# eval mode or noise level only redoes the threshold search
+	parser.add_argument('-ecd', '--embedding_cache_dir', default=None)
+	parser.add_argument('-nec', '--no_embedding_cache', default=False, action='store_true')
 
+	# CPU inference: int8 dynamically quantizes the model, onnx modes run the graphs exported by rel/export.py
+	parser.add_argument('-im', '--inference_mode', default='fp32', choices=INFERENCE_MODES)
+	parser.add_argument('-od', '--onnx_dir', default=None)
 	args = parser.parse_args()
 
 	pl.seed_everything(args.seed)
@@ -46,17 +59,26 @@ if __name__ == '__main__':
 		os.makedirs(save_directory)
 
 	checkpoint_path = os.path.join(save_directory, 'pytorch_model.bin')
+	onnx_dir = args.onnx_dir if args.onnx_dir is not None else os.path.join(save_directory, 'onnx')
 	results_path = os.path.join(save_directory, 'results.json')
+	# tokenized split files are cached by content hash, shared between models
+	token_cache_dir = args.token_cache_dir if args.token_cache_dir is not None else os.path.join(args.save_directory, 'token_cache')
+	embedding_cache_dir = args.embedding_cache_dir if args.embedding_cache_dir is not None else os.path.join(save_directory, 'embedding_cache')
 
 	# export TPU_IP_ADDRESS=10.155.6.34
 	# export XRT_TPU_CONFIG="tpu_worker;0;$TPU_IP_ADDRESS:8470"
 	gpus = [int(x) for x in args.gpus.split(',')]
-	is_distributed = len(gpus) > 1
+	if args.inference_mode != 'fp32':
+		# quantized and onnx models only run on CPU
+		gpus = None
+	is_distributed = gpus is not None and len(gpus) > 1
 	precision = 16 if args.use_tpus else 32
 	# precision = 32
 	tpu_cores = 8
 	num_workers = 4
 	deterministic = True
+	# sequences are always padded to max_seq_len on TPUs, so bucketing would not reduce padding
+	bucket_batches = args.bucket_batches and not args.use_tpus
 
 	# Also add the stream handler so that it logs on STD out as well
 	# Ref: https://stackoverflow.com/a/46098711/4535284
@@ -72,86 +94,18 @@ if __name__ == '__main__':
 			logging.StreamHandler()]
 	)
 
-	logging.info(f'Loading tokenizer: {args.pre_model_name}')
-	tokenizer = BertTokenizerFast.from_pretrained(args.pre_model_name)
-	logging.info(f'Loading val dataset: {args.val_path}')
-	val_data = read_jsonl(args.val_path)
-	logging.info(f'Loading test dataset: {args.test_path}')
-	test_data = read_jsonl(args.test_path)
-
-	logging.info(f'Loading misinfo: {args.misinfo_path}')
-	with open(args.misinfo_path, 'r') as f:
-		misinfo = json.load(f)
-
-		logging.info(f'Loaded misconception info.')
-
-	logging.info('Loading datasets...')
-	val_entity_dataset = MisinfoEntityDataset(
-		documents=val_data,
-		tokenizer=tokenizer,
-		misinfo=misinfo
-	)
-	val_rel_dataset = MisinfoRelDataset(
-		misinfo=misinfo,
-		tokenizer=tokenizer,
-		m_examples=val_entity_dataset.m_examples
-	)
-	val_entity_data_loader = DataLoader(
-		val_entity_dataset,
-		num_workers=num_workers,
-		batch_size=args.eval_batch_size,
-		shuffle=False,
-		collate_fn=MisinfoPredictBatchCollator(
-			args.max_seq_len,
-			force_max_seq_len=args.use_tpus,
+	embedding_cache_paths = None
+	embeddings_cached = False
+	if not args.no_embedding_cache:
+		checkpoint_hash = file_hash(checkpoint_path)
+		if args.inference_mode != 'fp32':
+			# quantized embeddings are cached apart from the fp32 ones
+			checkpoint_hash = f'{checkpoint_hash}-{args.inference_mode}'
+		embedding_cache_paths = (
+			embedding_cache_path(embedding_cache_dir, checkpoint_hash, args.val_path, args.misinfo_path, args.max_seq_len),
+			embedding_cache_path(embedding_cache_dir, checkpoint_hash, args.test_path, args.misinfo_path, args.max_seq_len),
 		)
-	)
-	val_rel_data_loader = DataLoader(
-		val_rel_dataset,
-		num_workers=num_workers,
-		batch_size=args.eval_batch_size,
-		shuffle=False,
-		collate_fn=MisinfoPredictBatchCollator(
-			args.max_seq_len,
-			force_max_seq_len=args.use_tpus,
-		)
-	)
-	test_entity_dataset = MisinfoEntityDataset(
-		documents=test_data,
-		tokenizer=tokenizer,
-		misinfo=misinfo
-	)
-	test_rel_dataset = MisinfoRelDataset(
-		misinfo=misinfo,
-		tokenizer=tokenizer,
-		m_examples=test_entity_dataset.m_examples
-	)
-	test_entity_data_loader = DataLoader(
-		test_entity_dataset,
-		num_workers=num_workers,
-		batch_size=args.eval_batch_size,
-		shuffle=False,
-		collate_fn=MisinfoPredictBatchCollator(
-			args.max_seq_len,
-			force_max_seq_len=args.use_tpus,
-		)
-	)
-	test_rel_data_loader = DataLoader(
-		test_rel_dataset,
-		num_workers=num_workers,
-		batch_size=args.eval_batch_size,
-		shuffle=False,
-		collate_fn=MisinfoPredictBatchCollator(
-			args.max_seq_len,
-			force_max_seq_len=args.use_tpus,
-		)
-	)
-
-	logging.info(f'val_entities={len(val_entity_dataset)}')
-	logging.info(f'val_rels={len(val_rel_dataset)}')
-
-	logging.info(f'test_entities={len(test_entity_dataset)}')
-	logging.info(f'test_rels={len(test_rel_dataset)}')
+		embeddings_cached = all([os.path.exists(path) for path in embedding_cache_paths])
 
 	logging.info('Loading model...')
 	model = CovidTwitterMisinfoModel(
@@ -169,60 +123,193 @@ if __name__ == '__main__':
 		eval_noise=args.eval_noise,
 		gamma=0.0,
 		load_pretrained=True,
+		embedding_cache_paths=embedding_cache_paths,
 	)
 
 	# load checkpoint
 	logging.warning(f'Loading weights from trained checkpoint: {checkpoint_path}...')
-	model.load_state_dict(torch.load(checkpoint_path))
+	model.load_state_dict(torch.load(checkpoint_path, map_location='cpu'))
+	model = prepare_inference_model(model, args.inference_mode, onnx_dir)
 
-	logger = pl_loggers.TensorBoardLogger(
-		save_dir=save_directory,
-		flush_secs=30,
-		max_queue=2
-	)
+	if embeddings_cached:
+		val_cache_path, test_cache_path = embedding_cache_paths
+		logging.info(f'Loading cached val embeddings: {val_cache_path}')
+		dev_embeddings = load_embeddings(val_cache_path)
+		logging.info(f'Loading cached test embeddings: {test_cache_path}')
+		test_embeddings = load_embeddings(test_cache_path)
+		logging.info('Evaluating...')
+		try:
+			with torch.no_grad():
+				f1, p, r, _ = model.evaluate_embeddings(dev_embeddings, test_embeddings)
+			# same format as the metrics returned by trainer.test
+			results = [{'test_f1': float(f1), 'test_p': float(p), 'test_r': float(r)}]
+			with open(results_path, 'w') as f:
+				json.dump(results, f, indent=2)
+			print(results[0])
+			print(f'P\tR\tF1')
+			print(f'{results[0]["test_p"]:.4f}\t{results[0]["test_r"]:.4f}\t{results[0]["test_f1"]:.4f}')
+		except Exception as e:
+			logging.exception('Exception during evaluation', exc_info=e)
+	else:
+		logging.info(f'Loading tokenizer: {args.pre_model_name}')
+		tokenizer = BertTokenizerFast.from_pretrained(args.pre_model_name)
+		logging.info(f'Loading val dataset: {args.val_path}')
+		val_data = read_jsonl(args.val_path)
+		logging.info(f'Loading test dataset: {args.test_path}')
+		test_data = read_jsonl(args.test_path)
+		logging.info(f'Loading tokens: {token_cache_dir}')
+		val_tokens = load_document_tokens(args.val_path, val_data, tokenizer, token_cache_dir)
+		test_tokens = load_document_tokens(args.test_path, test_data, tokenizer, token_cache_dir)
+
+		logging.info(f'Loading misinfo: {args.misinfo_path}')
+		with open(args.misinfo_path, 'r') as f:
+			misinfo = json.load(f)
 
-	if args.use_tpus:
-		logging.warning('Gradient clipping slows down TPU training drastically, disabled for now.')
-		trainer = pl.Trainer(
-			logger=logger,
-			tpu_cores=tpu_cores,
-			default_root_dir=save_directory,
-			max_epochs=0,
-			precision=precision,
-			deterministic=deterministic,
-			checkpoint_callback=False,
+			logging.info(f'Loaded misconception info.')
+
+		logging.info('Loading datasets...')
+		val_entity_dataset = MisinfoEntityDataset(
+			documents=val_data,
+			tokenizer=tokenizer,
+			misinfo=misinfo,
+			tokens=val_tokens
 		)
-	else:
-		if len(gpus) > 1:
-			backend = 'ddp' if is_distributed else 'dp'
-		else:
-			backend = None
-		trainer = pl.Trainer(
-			logger=logger,
-			gpus=gpus,
-			default_root_dir=save_directory,
-			max_epochs=0,
-			precision=precision,
-			distributed_backend=backend,
-			deterministic=deterministic,
-			checkpoint_callback=False,
+		val_rel_dataset = MisinfoRelDataset(
+			misinfo=misinfo,
+			tokenizer=tokenizer,
+			m_examples=val_entity_dataset.m_examples
+		)
+		val_entity_data_loader = DataLoader(
+			val_entity_dataset,
+			num_workers=num_workers,
+			pin_memory=args.pin_memory,
+			**get_batch_args(
+				val_entity_dataset,
+				args.eval_batch_size,
+				shuffle=False,
+				bucket_batches=bucket_batches,
+				seed=args.seed
+			),
+			collate_fn=MisinfoPredictBatchCollator(
+				args.max_seq_len,
+				force_max_seq_len=args.use_tpus,
+			)
+		)
+		val_rel_data_loader = DataLoader(
+			val_rel_dataset,
+			num_workers=num_workers,
+			pin_memory=args.pin_memory,
+			**get_batch_args(
+				val_rel_dataset,
+				args.eval_batch_size,
+				shuffle=False,
+				bucket_batches=bucket_batches,
+				seed=args.seed
+			),
+			collate_fn=MisinfoPredictBatchCollator(
+				args.max_seq_len,
+				force_max_seq_len=args.use_tpus,
+			)
+		)
+		test_entity_dataset = MisinfoEntityDataset(
+			documents=test_data,
+			tokenizer=tokenizer,
+			misinfo=misinfo,
+			tokens=test_tokens
 		)
+		test_rel_dataset = MisinfoRelDataset(
+			misinfo=misinfo,
+			tokenizer=tokenizer,
+			m_examples=test_entity_dataset.m_examples
+		)
+		test_entity_data_loader = DataLoader(
+			test_entity_dataset,
+			num_workers=num_workers,
+			pin_memory=args.pin_memory,
+			**get_batch_args(
+				test_entity_dataset,
+				args.eval_batch_size,
+				shuffle=False,
+				bucket_batches=bucket_batches,
+				seed=args.seed
+			),
+			collate_fn=MisinfoPredictBatchCollator(
+				args.max_seq_len,
+				force_max_seq_len=args.use_tpus,
+			)
+		)
+		test_rel_data_loader = DataLoader(
+			test_rel_dataset,
+			num_workers=num_workers,
+			pin_memory=args.pin_memory,
+			**get_batch_args(
+				test_rel_dataset,
+				args.eval_batch_size,
+				shuffle=False,
+				bucket_batches=bucket_batches,
+				seed=args.seed
+			),
+			collate_fn=MisinfoPredictBatchCollator(
+				args.max_seq_len,
+				force_max_seq_len=args.use_tpus,
+			)
+		)
+
+		logging.info(f'val_entities={len(val_entity_dataset)}')
+		logging.info(f'val_rels={len(val_rel_dataset)}')
 
-	logging.info('Evaluating...')
-	try:
-		results = trainer.test(
-			model,
-			test_dataloaders=[
-				val_entity_data_loader,
-				val_rel_data_loader,
-				test_entity_data_loader,
-				test_rel_data_loader,
-			]
+		logging.info(f'test_entities={len(test_entity_dataset)}')
+		logging.info(f'test_rels={len(test_rel_dataset)}')
+
+		logger = pl_loggers.TensorBoardLogger(
+			save_dir=save_directory,
+			flush_secs=30,
+			max_queue=2
 		)
-		with open(results_path, 'w') as f:
-			json.dump(results, f, indent=2)
-		print(results[0])
-		print(f'P\tR\tF1')
-		print(f'{results[0]["test_p"]:.4f}\t{results[0]["test_r"]:.4f}\t{results[0]["test_f1"]:.4f}')
-	except Exception as e:
-		logging.exception('Exception during evaluation', exc_info=e)
+
+		if args.use_tpus:
+			logging.warning('Gradient clipping slows down TPU training drastically, disabled for now.')
+			trainer = pl.Trainer(
+				logger=logger,
+				tpu_cores=tpu_cores,
+				default_root_dir=save_directory,
+				max_epochs=0,
+				precision=precision,
+				deterministic=deterministic,
+				checkpoint_callback=False,
+			)
+		else:
+			if gpus is not None and len(gpus) > 1:
+				backend = 'ddp' if is_distributed else 'dp'
+			else:
+				backend = None
+			trainer = pl.Trainer(
+				logger=logger,
+				gpus=gpus,
+				default_root_dir=save_directory,
+				max_epochs=0,
+				precision=precision,
+				distributed_backend=backend,
+				replace_sampler_ddp=not bucket_batches,
+				deterministic=deterministic,
+				checkpoint_callback=False,
+			)
+
+		logging.info('Evaluating...')
+		try:
+			results = trainer.test(
+				model,
+				test_dataloaders=[
+					val_entity_data_loader,
+					val_rel_data_loader,
+					test_entity_data_loader,
+					test_rel_data_loader,
+				]
+			)
+			with open(results_path, 'w') as f:
+				json.dump(results, f, indent=2)
+			print(results[0])
+			print(f'P\tR\tF1')
+			print(f'{results[0]["test_p"]:.4f}\t{results[0]["test_r"]:.4f}\t{results[0]["test_f1"]:.4f}')
+		except Exception as e:
+			logging.exception('Exception during evaluation', exc_info=e)
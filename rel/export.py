@@ -0,0 +1,168 @@
+import argparse
+import logging
+import copy
+
+# pytorch_lightning can cause issues if
+# torch or other torch libraries are imported first
+# noinspection PyUnresolvedReferences
+import pytorch_lightning as pl
+from transformers import BertTokenizerFast
+from torch.utils.data import DataLoader
+
+from model_utils import *
+from data_utils import *
+from inference_utils import INFERENCE_MODES, E_TYPES, onnx_encoder_path, prepare_inference_model
+from serve_utils import encode_dataset
+
+from common.export_utils import export_onnx, quantize_onnx, benchmark, onnxruntime, ONNX_OPSET_VERSION
+
+import torch
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-vp', '--val_path', required=True)
+	parser.add_argument('-mip', '--misinfo_path', required=True)
+	parser.add_argument('-pm', '--pre_model_name', default='nboost/pt-biobert-base-msmarco')
+	parser.add_argument('-mn', '--model_name', default='pt-biobert-base-msmarco')
+	parser.add_argument('-sd', '--save_directory', default='models')
+	parser.add_argument('-ebs', '--eval_batch_size', default=4, type=int)
+	parser.add_argument('-ml', '--max_seq_len', default=96, type=int)
+	parser.add_argument('-se', '--seed', default=0, type=int)
+	parser.add_argument('-es', '--emb_size', default=100, type=int)
+	parser.add_argument('-eln', '--emb_loss_norm', default=2, type=int)
+	parser.add_argument('-em', '--emb_model', default='transd')
+	parser.add_argument('-mt', '--model_type', default='bert')
+	parser.add_argument('-mtl', '--model_layers', default=1, type=int)
+	parser.add_argument('-evm', '--eval_mode', default='centroid')
+	parser.add_argument('-tcd', '--token_cache_dir', default=None)
+	parser.add_argument('-od', '--onnx_dir', default=None)
+	parser.add_argument('-ops', '--opset_version', default=ONNX_OPSET_VERSION, type=int)
+	# latency and throughput are timed over the first num_benchmark_batches val entity batches
+	parser.add_argument('-nbb', '--num_benchmark_batches', default=32, type=int)
+	parser.add_argument('-nt', '--num_threads', default=None, type=int)
+	args = parser.parse_args()
+
+	pl.seed_everything(args.seed)
+	if args.num_threads is not None:
+		torch.set_num_threads(args.num_threads)
+
+	save_directory = os.path.join(args.save_directory, args.model_name)
+	checkpoint_path = os.path.join(save_directory, 'pytorch_model.bin')
+	onnx_dir = args.onnx_dir if args.onnx_dir is not None else os.path.join(save_directory, 'onnx')
+	results_path = os.path.join(save_directory, 'export_results.json')
+	token_cache_dir = args.token_cache_dir if args.token_cache_dir is not None else os.path.join(args.save_directory, 'token_cache')
+	if not os.path.exists(onnx_dir):
+		os.makedirs(onnx_dir)
+
+	logging.basicConfig(
+		level=logging.INFO,
+		format="%(asctime)s [%(levelname)s] %(message)s",
+		handlers=[
+			logging.FileHandler(os.path.join(save_directory, 'export_output.log'), mode='w'),
+			logging.StreamHandler()]
+	)
+
+	logging.info('Loading model...')
+	model = CovidTwitterMisinfoModel(
+		pre_model_name=args.pre_model_name,
+		learning_rate=0,
+		lr_warmup=0.0,
+		updates_total=0,
+		weight_decay=0,
+		emb_model=args.emb_model,
+		emb_size=args.emb_size,
+		model_type=args.model_type,
+		model_layers=args.model_layers,
+		emb_loss_norm=args.emb_loss_norm,
+		eval_mode=args.eval_mode,
+		gamma=0.0,
+		load_pretrained=True,
+	)
+	logging.warning(f'Loading weights from trained checkpoint: {checkpoint_path}...')
+	model.load_state_dict(torch.load(checkpoint_path, map_location='cpu'))
+	model.eval()
+
+	modes = ['fp32', 'int8']
+	for e_type in E_TYPES:
+		path = onnx_encoder_path(onnx_dir, e_type)
+		logging.info(f'Exporting {e_type} encoder: {path}')
+		export_onnx(
+			RelEncoder(model.bert, model.emb_model, e_type),
+			path,
+			seq_len=args.max_seq_len,
+			opset_version=args.opset_version
+		)
+		if onnxruntime is not None:
+			quantized_path = onnx_encoder_path(onnx_dir, e_type, quantized=True)
+			logging.info(f'Quantizing {e_type} encoder: {quantized_path}')
+			quantize_onnx(path, quantized_path)
+	if onnxruntime is not None:
+		modes.extend(['onnx', 'onnx-int8'])
+	else:
+		logging.warning('onnxruntime is not installed, onnx modes are exported but not benchmarked.')
+
+	logging.info(f'Loading tokenizer: {args.pre_model_name}')
+	tokenizer = BertTokenizerFast.from_pretrained(args.pre_model_name)
+	logging.info(f'Loading val dataset: {args.val_path}')
+	val_data = read_jsonl(args.val_path)
+	val_tokens = load_document_tokens(args.val_path, val_data, tokenizer, token_cache_dir)
+	with open(args.misinfo_path, 'r') as f:
+		misinfo = json.load(f)
+	val_entity_dataset = MisinfoEntityDataset(
+		documents=val_data,
+		tokenizer=tokenizer,
+		misinfo=misinfo,
+		tokens=val_tokens
+	)
+	val_rel_dataset = MisinfoRelDataset(
+		misinfo=misinfo,
+		tokenizer=tokenizer,
+		m_examples=val_entity_dataset.m_examples
+	)
+	collator = MisinfoPredictBatchCollator(args.max_seq_len)
+	benchmark_batches = []
+	for batch in DataLoader(val_entity_dataset, batch_size=args.eval_batch_size, shuffle=False, collate_fn=collator):
+		if len(benchmark_batches) >= args.num_benchmark_batches:
+			break
+		benchmark_batches.append((batch['input_ids'], batch['attention_mask'], batch['token_type_ids']))
+
+	results = {}
+	for mode in modes:
+		logging.info(f'Benchmarking {mode}...')
+		# int8 quantization replaces modules, so every mode starts from the fp32 weights
+		mode_model = prepare_inference_model(copy.deepcopy(model), mode, onnx_dir)
+		mode_model.eval()
+
+		def encode_entities(input_ids, attention_mask, token_type_ids):
+			return mode_model.encode({
+				'e_type': 'entity',
+				'input_ids': input_ids,
+				'attention_mask': attention_mask,
+				'token_type_ids': token_type_ids,
+			})
+
+		mode_results = benchmark(encode_entities, benchmark_batches)
+		dev_embeddings = mode_model._extract_embeddings(
+			encode_dataset(mode_model, val_entity_dataset, collator, args.eval_batch_size, 'cpu'),
+			encode_dataset(mode_model, val_rel_dataset, collator, args.eval_batch_size, 'cpu'),
+			'val'
+		)
+		with torch.no_grad():
+			# thresholds tuned and evaluated on dev, the same for every mode
+			f1, p, r, _ = mode_model.evaluate_embeddings(dev_embeddings, dev_embeddings)
+		mode_results['val_f1'] = float(f1)
+		mode_results['val_p'] = float(p)
+		mode_results['val_r'] = float(r)
+		mode_results['val_f1_delta'] = mode_results['val_f1'] - results['fp32']['val_f1'] if mode != 'fp32' else 0.0
+		results[mode] = mode_results
+
+	logging.info('mode\tlatency_ms\tthroughput\tval_f1\tval_f1_delta')
+	for mode, mode_results in results.items():
+		logging.info(
+			f'{mode}\t{mode_results["latency_ms"]:.2f}\t{mode_results["throughput"]:.1f}'
+			f'\t{mode_results["val_f1"]:.4f}\t{mode_results["val_f1_delta"]:+.4f}'
+		)
+	with open(results_path, 'w') as f:
+		json.dump(results, f, indent=2)
+	logging.info(f'Wrote export results: {results_path}')
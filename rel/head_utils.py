@@ -0,0 +1,196 @@
+import os
+
+import numpy as np
+import torch
+from torch import nn
+from tqdm import tqdm
+from transformers import AdamW, get_linear_schedule_with_warmup
+
+import metric_utils
+from data_utils import pad_sequences, calculate_seq_padding, file_hash
+from emb_utils import build_emb_model
+from model_utils import triplet_energy, triplet_loss
+
+from common.precision_utils import bert_hidden_states
+
+
+def feature_cache_path(cache_dir, encoder_key, data_path, max_seq_len):
+	# CLS features depend on the encoder weights, the tokenized file and truncation
+	return os.path.join(cache_dir, f'{encoder_key}-{file_hash(data_path)}-{max_seq_len}.pt')
+
+
+def extract_cls_features(bert, tokens, hidden_size, max_seq_len, batch_size=64, device='cpu', precision='32'):
+	"""CLS outputs of every row of a TokenTable with a frozen encoder.
+	Rows are encoded in length order, so batches carry little padding.
+	Returns:
+		[num_rows, hidden_size] float32 cpu tensor in row order.
+	"""
+	bert.eval()
+	features = torch.zeros([len(tokens), hidden_size], dtype=torch.float32)
+	order = np.argsort(tokens.lengths(), kind='stable')
+	with torch.no_grad():
+		for b_start in tqdm(range(0, len(order), batch_size), desc='extracting features...'):
+			b_rows = order[b_start:b_start + batch_size]
+			sequences = [tokens[row] for row in b_rows]
+			pad_seq_len = calculate_seq_padding(sequences, max_seq_len)
+			input_ids, attention_mask, token_type_ids = pad_sequences(sequences, pad_seq_len)
+			contextualized_embeddings = bert_hidden_states(
+				bert,
+				precision,
+				input_ids.to(device),
+				attention_mask.to(device),
+				token_type_ids.to(device)
+			)
+			features[torch.from_numpy(b_rows)] = contextualized_embeddings[:, 0].cpu()
+	return features
+
+
+def load_cls_features(cache_path, bert, tokens, hidden_size, max_seq_len, batch_size=64, device='cpu', precision='32'):
+	# features are extracted once per encoder, file and max_seq_len, loaded from cache_path afterwards
+	if os.path.exists(cache_path):
+		features = torch.load(cache_path)
+		if features.shape[0] == len(tokens):
+			return features
+	features = extract_cls_features(bert, tokens, hidden_size, max_seq_len, batch_size, device, precision)
+	cache_dir = os.path.dirname(cache_path)
+	if cache_dir and not os.path.exists(cache_dir):
+		os.makedirs(cache_dir, exist_ok=True)
+	tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+	torch.save(features, tmp_path)
+	os.replace(tmp_path, cache_path)
+	return features
+
+
+def feature_triplet_batches(dataset, batch_size, generator):
+	"""Training batches of a MisinfoDataset as feature row indices instead of token sequences.
+	Positives, negatives and subject / object losses are sampled exactly like MisinfoDataset.__getitem__.
+	Returns:
+		iterator of dicts with t_rows [bsize, 1 + pos_samples + neg_samples] tweet rows,
+		m_rows [bsize] misinfo rows, pos_samples, neg_samples and subj_obj_mask [bsize, 2].
+	"""
+	dataset.generator = generator
+	perm = torch.randperm(len(dataset), generator=generator).numpy()
+	for b_start in range(0, len(perm), batch_size):
+		b_idxs = perm[b_start:b_start + batch_size]
+		t_rows = []
+		m_rows = []
+		subj_obj_mask = torch.zeros([len(b_idxs), 2], dtype=torch.float)
+		for ex_idx, idx in enumerate(b_idxs):
+			t_idx, m_idx, _ = dataset.examples[idx].tolist()
+			pos_samples = dataset._sample(dataset.pos_examples[m_idx], dataset.pos_samples)
+			neg_samples = dataset._sample_negatives(m_idx)
+			subj_obj_mask[ex_idx, dataset._sample_subj_obj()] = 1.0
+			t_rows.append([t_idx] + pos_samples + neg_samples)
+			m_rows.append(m_idx)
+		yield {
+			't_rows': torch.tensor(t_rows, dtype=torch.long),
+			'm_rows': torch.tensor(m_rows, dtype=torch.long),
+			'pos_samples': len(pos_samples),
+			'neg_samples': len(neg_samples),
+			'subj_obj_mask': subj_obj_mask,
+		}
+
+
+class FeatureHeadModel(nn.Module):
+	"""Dropout, embedding head, energies and loss of CovidTwitterMisinfoModel over cached CLS features,
+	the model trained with a frozen encoder.
+	"""
+	def __init__(self, emb_model, hidden_size, emb_size, gamma, emb_loss_norm, dropout_prob):
+		super().__init__()
+		self.hidden_size = hidden_size
+		self.f_dropout = nn.Dropout(p=dropout_prob)
+		self.emb_model = build_emb_model(emb_model, hidden_size, emb_size, gamma, emb_loss_norm)
+
+	def forward(self, t_features, m_features):
+		# [bsize, num_entities, hidden_size], [bsize, hidden_size]
+		num_examples, num_entities, _ = t_features.shape
+		e_lm_output = self.f_dropout(t_features).view(num_examples * num_entities, self.hidden_size)
+		# [bsize, num_entities, emb_size]
+		e_embs = self.emb_model(e_lm_output, 'entity').view(num_examples, num_entities, -1)
+		# [bsize, emb_size]
+		r_embs = self.emb_model(self.f_dropout(m_features), 'rel')
+		return e_embs, r_embs
+
+	def triplet_step(self, batch, t_features, m_features):
+		e_embs, r_embs = self(t_features[batch['t_rows']], m_features[batch['m_rows']])
+		pos_energy, neg_energy = triplet_energy(self.emb_model, e_embs, r_embs, batch)
+		return triplet_loss(self.emb_model, pos_energy, neg_energy, batch['subj_obj_mask'])
+
+	def embeddings(self, ids, features, e_type):
+		# {id: [emb_size]} embeddings for evaluation, in the format of CovidTwitterMisinfoModel._extract_embeddings
+		with torch.no_grad():
+			embs = self.emb_model(features, e_type)
+		return {e_id: e_emb for e_id, e_emb in zip(ids, embs)}
+
+
+def train_feature_head(
+		head, dataset, t_features, m_features, epochs, batch_size, learning_rate, lr_warmup=0.1,
+		weight_decay=0.0, gradient_clip_val=1.0, seed=0):
+	"""Trains the head with the optimizer and schedule of CovidTwitterMisinfoModel.
+	Returns:
+		float: mean training loss of the last epoch.
+	"""
+	head.train()
+	generator = torch.Generator()
+	generator.manual_seed(seed)
+	params = [p for p in head.parameters() if p.requires_grad]
+	if len(params) == 0:
+		# knn has no trainable parameters
+		return 0.0
+	updates_total = epochs * ((len(dataset) + batch_size - 1) // batch_size)
+	optimizer = AdamW(params, lr=learning_rate, weight_decay=weight_decay, correct_bias=False)
+	scheduler = get_linear_schedule_with_warmup(
+		optimizer,
+		num_warmup_steps=int(lr_warmup * updates_total),
+		num_training_steps=updates_total
+	)
+	epoch_loss = 0.0
+	for _ in range(epochs):
+		losses = []
+		for batch in feature_triplet_batches(dataset, batch_size, generator):
+			loss, _ = head.triplet_step(batch, t_features, m_features)
+			optimizer.zero_grad()
+			loss.backward()
+			if gradient_clip_val is not None and gradient_clip_val > 0:
+				torch.nn.utils.clip_grad_norm_(params, gradient_clip_val)
+			optimizer.step()
+			scheduler.step()
+			losses.append(loss.item())
+		epoch_loss = float(np.mean(losses)) if len(losses) > 0 else 0.0
+	head.eval()
+	return epoch_loss
+
+
+def evaluate_feature_head(head, dev_embeddings, test_embeddings):
+	"""Centroid eval mode of CovidTwitterMisinfoModel.evaluate_embeddings, thresholds tuned on dev.
+	Returns:
+		f1, p, r on the test embeddings.
+	"""
+	dev_entities, dev_relations, dev_m_examples, dev_t_labels = dev_embeddings
+	test_entities, test_relations, _, test_t_labels = test_embeddings
+	with torch.no_grad():
+		m_thresholds = metric_utils.find_m_thresholds(
+			head.emb_model,
+			dev_entities,
+			dev_relations,
+			dev_m_examples,
+			dev_entities,
+			dev_t_labels
+		)
+		f1, p, r, *_ = metric_utils.evaluate_m_thresholds(
+			head.emb_model,
+			test_entities,
+			test_relations,
+			dev_m_examples,
+			dev_entities,
+			test_t_labels,
+			m_thresholds
+		)
+	return float(f1), float(p), float(r)
+
+
+def head_checkpoint(bert, head):
+	# state dict of a CovidTwitterMisinfoModel, so rel/evaluate.py and rel/predict.py load it as is
+	state_dict = {f'bert.{k}': v for k, v in bert.state_dict().items()}
+	state_dict.update({f'emb_model.{k}': v for k, v in head.emb_model.state_dict().items()})
+	return state_dict
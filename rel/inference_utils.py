@@ -0,0 +1,32 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.export_utils import quantize_dynamic_int8, OnnxModule
+
+INFERENCE_MODES = ['fp32', 'int8', 'onnx', 'onnx-int8']
+E_TYPES = ['entity', 'rel']
+
+
+def onnx_encoder_path(onnx_dir, e_type, quantized=False):
+	return os.path.join(onnx_dir, f'{e_type}-int8.onnx' if quantized else f'{e_type}.onnx')
+
+
+def prepare_inference_model(model, inference_mode, onnx_dir=None):
+	"""Switches a loaded fp32 model to a CPU inference mode.
+	int8 dynamically quantizes every nn.Linear, onnx modes replace bert and the embedding head of each
+	e_type with the graphs exported by rel/export.py.
+	"""
+	if inference_mode == 'fp32':
+		return model
+	if inference_mode == 'int8':
+		return quantize_dynamic_int8(model)
+	if inference_mode in {'onnx', 'onnx-int8'}:
+		if onnx_dir is None:
+			raise ValueError(f'{inference_mode} inference needs an onnx_dir')
+		model.use_encoders({
+			e_type: OnnxModule(onnx_encoder_path(onnx_dir, e_type, quantized=inference_mode == 'onnx-int8'))
+			for e_type in E_TYPES
+		})
+		return model
+	raise ValueError(f'Unknown inference mode: {inference_mode}')
@@ -0,0 +1,89 @@
+import os
+import sys
+import argparse
+import logging
+import json
+
+import torch
+
+from data_utils import read_jsonl, get_m_examples
+from shard_utils import EmbeddingShards
+from link_utils import load_emb_model, ranked_rows, LinkIndex
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.io_utils import JsonlWriter
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	# output_path of rel/predict.py run over the tweets to search
+	parser.add_argument('-ep', '--entity_path', required=True)
+	# output_path of rel/predict.py run over the labelled split, holds the rel and positive example embeddings
+	parser.add_argument('-pp', '--positive_path', required=True)
+	parser.add_argument('-dp', '--data_path', required=True)
+	parser.add_argument('-mip', '--misinfo_path', required=True)
+	parser.add_argument('-op', '--output_path', required=True)
+	parser.add_argument('-mn', '--model_name', default='pt-biobert-base-msmarco')
+	parser.add_argument('-sd', '--save_directory', default='models')
+	parser.add_argument('-es', '--emb_size', default=100, type=int)
+	parser.add_argument('-eln', '--emb_loss_norm', default=2, type=int)
+	parser.add_argument('-em', '--emb_model', default='transd')
+	# tweets: top k tweets for every misinfo target, targets: top k misinfo targets for every tweet
+	parser.add_argument('-m', '--mode', default='tweets', choices=['tweets', 'targets'])
+	parser.add_argument('-k', '--top_k', default=100, type=int)
+	parser.add_argument('-cs', '--chunk_size', default=1024, type=int)
+	parser.add_argument('-gpu', '--gpu', default=None, type=int)
+	# faiss IVF index for the tweets mode of translational models, PQ compressed with num_subquantizers
+	parser.add_argument('-ap', '--approximate', default=False, action='store_true')
+	parser.add_argument('-nl', '--num_lists', default=1024, type=int)
+	parser.add_argument('-nsq', '--num_subquantizers', default=None, type=int)
+	parser.add_argument('-np', '--num_probes', default=16, type=int)
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+
+	checkpoint_path = os.path.join(args.save_directory, args.model_name, 'pytorch_model.bin')
+	device = 'cpu' if args.gpu is None else f'cuda:{args.gpu}'
+
+	logging.info(f'Loading misinfo: {args.misinfo_path}')
+	with open(args.misinfo_path, 'r') as f:
+		misinfo = json.load(f)
+	logging.info(f'Loading labelled dataset: {args.data_path}')
+	m_examples = get_m_examples(read_jsonl(args.data_path), misinfo)
+
+	logging.info(f'Loading embedding model: {checkpoint_path}')
+	emb_model = load_emb_model(checkpoint_path, args.emb_model, args.emb_size, args.emb_loss_norm)
+	logging.info(f'Loading embeddings: {args.entity_path}, {args.positive_path}')
+	entity_shards = EmbeddingShards(args.entity_path, 'entity')
+	link_index = LinkIndex.from_shards(
+		emb_model,
+		rel_shards=EmbeddingShards(args.positive_path, 'rel'),
+		entity_shards=EmbeddingShards(args.positive_path, 'entity'),
+		m_examples=m_examples,
+		chunk_size=args.chunk_size,
+		device=device
+	)
+	logging.info(f'targets={len(link_index)} tweets={len(entity_shards)}')
+
+	with JsonlWriter(args.output_path) as writer:
+		if args.mode == 'tweets':
+			if args.approximate:
+				energies, tweet_idxs = link_index.top_tweets_approximate(
+					entity_shards,
+					args.top_k,
+					num_lists=args.num_lists,
+					num_subquantizers=args.num_subquantizers,
+					num_probes=args.num_probes
+				)
+			else:
+				energies, tweet_idxs = link_index.top_tweets(entity_shards, args.top_k)
+			writer.write_all(
+				ranked_rows('m_id', link_index.m_ids, 'tweet_id', entity_shards.ids, energies, tweet_idxs)
+			)
+		else:
+			for c_ids, c_embs in entity_shards.iter_chunks(chunk_size=args.chunk_size):
+				energies, m_idxs = link_index.top_targets(torch.from_numpy(c_embs), args.top_k)
+				writer.write_all(
+					ranked_rows('tweet_id', c_ids, 'm_id', link_index.m_ids, energies, m_idxs)
+				)
+	logging.info(f'Wrote ranked results: {args.output_path}')
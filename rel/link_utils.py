@@ -0,0 +1,153 @@
+import numpy as np
+import torch
+
+try:
+	import faiss
+except ImportError:
+	faiss = None
+
+import metric_utils
+from emb_utils import build_emb_model, TransEEmbedding, KNNEmbedding
+
+
+def load_emb_model(checkpoint_path, emb_model, emb_size, emb_loss_norm):
+	"""Builds the embedding head of a trained rel checkpoint without its encoder.
+	Only the emb_model weights are used, the entity and relation embeddings are already predicted.
+	"""
+	state_dict = torch.load(checkpoint_path, map_location='cpu')
+	prefix = 'emb_model.'
+	emb_state_dict = {k[len(prefix):]: v for k, v in state_dict.items() if k.startswith(prefix)}
+	hidden_size = emb_state_dict['e_emb_layer.weight'].shape[1] if 'e_emb_layer.weight' in emb_state_dict else 0
+	model = build_emb_model(emb_model, hidden_size, emb_size, 0.0, emb_loss_norm)
+	model.load_state_dict(emb_state_dict)
+	model.eval()
+	return model
+
+
+def ranked_rows(query_key, query_ids, result_key, result_ids, energies, result_idxs):
+	"""Converts top-k results into one json row per query, results ordered by increasing energy."""
+	rows = []
+	for q_idx, q_id in enumerate(query_ids):
+		results = []
+		for rank, (energy, r_idx) in enumerate(zip(energies[q_idx].tolist(), result_idxs[q_idx].tolist())):
+			# approximate search pads missing results with -1
+			if r_idx < 0:
+				continue
+			results.append({result_key: result_ids[r_idx], 'energy': energy, 'rank': rank + 1})
+		rows.append({query_key: q_id, 'results': results})
+	return rows
+
+
+class LinkIndex:
+	"""Scores tweets against misinfo targets with the centroid of each target's positive tweets as tail,
+	the same link prediction as the centroid eval mode. Lower energy means a more likely link.
+	"""
+	def __init__(self, emb_model, m_ids, rels, centroids, chunk_size=1024, device='cpu'):
+		self.emb_model = emb_model.to(device)
+		self.m_ids = m_ids
+		# [num_targets, emb_size]
+		self.rels = rels.to(device)
+		self.centroids = centroids.to(device)
+		self.chunk_size = chunk_size
+		self.device = device
+
+	@classmethod
+	def from_shards(cls, emb_model, rel_shards, entity_shards, m_examples, **kwargs):
+		"""Builds the index from predicted relation and positive example entity embedding shards.
+		Targets without any embedded positive example have no centroid and are left out.
+		"""
+		m_ids = []
+		centroids = []
+		for m_id in rel_shards.ids:
+			pos_t_ids = [t_id for t_id in m_examples.get(m_id, []) if t_id in entity_shards]
+			if len(pos_t_ids) == 0:
+				continue
+			m_ids.append(m_id)
+			centroids.append(entity_shards.get_many(pos_t_ids).mean(axis=0))
+		emb_size = entity_shards.emb_size
+		rels = torch.from_numpy(rel_shards.get_many(m_ids).reshape(-1, rel_shards.emb_size))
+		centroids = torch.from_numpy(np.array(centroids, dtype=np.float32).reshape(-1, emb_size))
+		return cls(emb_model, m_ids, rels, centroids, **kwargs)
+
+	def __len__(self):
+		return len(self.m_ids)
+
+	def energies(self, heads):
+		# [num_heads, num_targets]
+		with torch.no_grad():
+			return metric_utils.pairwise_energy(
+				self.emb_model,
+				heads.to(self.device),
+				self.rels,
+				self.centroids,
+				chunk_size=self.chunk_size
+			)
+
+	def top_targets(self, heads, k):
+		"""Finds the k targets each tweet most likely links to.
+		Returns:
+			energies, target_idxs: [num_heads, k] sorted by increasing energy.
+		"""
+		k = min(k, len(self))
+		return torch.topk(self.energies(heads), k, dim=1, largest=False)
+
+	def top_tweets(self, entity_shards, k):
+		"""Finds the k tweets most likely linking to every target, streaming over the entity shards.
+		Returns:
+			energies, tweet_idxs: [num_targets, k] sorted by increasing energy, indices into entity_shards.ids.
+		"""
+		best_energies = self.rels.new_zeros((len(self), 0))
+		best_idxs = torch.zeros([len(self), 0], dtype=torch.long, device=self.device)
+		offset = 0
+		for _, c_embs in entity_shards.iter_chunks(chunk_size=self.chunk_size):
+			# [num_targets, chunk_size]
+			c_energies = self.energies(torch.from_numpy(c_embs)).t()
+			c_idxs = torch.arange(offset, offset + c_embs.shape[0], device=self.device)
+			c_idxs = c_idxs.unsqueeze(dim=0).expand(len(self), -1)
+			offset += c_embs.shape[0]
+			# only the running top-k is kept, never [num_targets, num_tweets]
+			c_energies = torch.cat([best_energies, c_energies], dim=1)
+			c_idxs = torch.cat([best_idxs, c_idxs], dim=1)
+			best_energies, top_idxs = torch.topk(c_energies, min(k, c_energies.shape[1]), dim=1, largest=False)
+			best_idxs = torch.gather(c_idxs, 1, top_idxs)
+		return best_energies, best_idxs
+
+	def translated_centroids(self):
+		"""Query vectors q with energy ||h - q|| for translational models, the centroid translated by -r.
+		Other models project or rotate the head per target and have no single query vector.
+		"""
+		if isinstance(self.emb_model, KNNEmbedding):
+			return self.centroids
+		if isinstance(self.emb_model, TransEEmbedding):
+			return self.centroids - self.rels
+		raise ValueError(f'Approximate search needs a translational model, got {type(self.emb_model).__name__}')
+
+	def top_tweets_approximate(self, entity_shards, k, num_lists=1024, num_subquantizers=None, num_probes=16, train_size=262144):
+		"""Approximate top_tweets with a faiss IVF-PQ index over the tweet embeddings.
+		Energies are faiss l2 distances, the squared l2 energy for loss_norm 2.
+		"""
+		if faiss is None:
+			raise ImportError('faiss is required for approximate link prediction')
+		if self.emb_model.loss_norm != 2:
+			raise ValueError('Approximate search only supports loss_norm 2')
+		queries = self.translated_centroids().detach().cpu().numpy().astype(np.float32)
+		emb_size = entity_shards.emb_size
+		quantizer = faiss.IndexFlatL2(emb_size)
+		if num_subquantizers is None:
+			index = faiss.IndexIVFFlat(quantizer, emb_size, num_lists)
+		else:
+			index = faiss.IndexIVFPQ(quantizer, emb_size, num_lists, num_subquantizers, 8)
+		# coarse centroids and codebooks are trained on the first train_size tweets
+		train_embs = []
+		num_train = 0
+		for _, c_embs in entity_shards.iter_chunks(chunk_size=self.chunk_size):
+			train_embs.append(c_embs)
+			num_train += c_embs.shape[0]
+			if num_train >= train_size:
+				break
+		index.train(np.concatenate(train_embs, axis=0)[:train_size])
+		for _, c_embs in entity_shards.iter_chunks(chunk_size=train_size):
+			index.add(c_embs)
+		index.nprobe = num_probes
+		energies, tweet_idxs = index.search(queries, k)
+		return torch.from_numpy(energies), torch.from_numpy(tweet_idxs)
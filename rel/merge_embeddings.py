@@ -0,0 +1,27 @@
+import argparse
+import logging
+
+from shard_utils import merge_embedding_shards
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-i', '--input_path', required=True)
+	parser.add_argument('-o', '--output_path', required=True)
+	parser.add_argument('-et', '--e_types', default='entity,rel')
+	parser.add_argument('-dt', '--dtype', default=None, choices=['float16', 'float32'])
+	parser.add_argument('-ss', '--shard_size', default=65536, type=int)
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+
+	for e_type in args.e_types.split(','):
+		logging.info(f'Merging {e_type} shards: {args.input_path}')
+		num_ids = merge_embedding_shards(
+			args.input_path,
+			args.output_path,
+			e_type,
+			dtype=args.dtype,
+			shard_size=args.shard_size
+		)
+		logging.info(f'Merged {num_ids} {e_type} embeddings into {args.output_path}')
@@ -1,6 +1,4 @@
 
-from collections import defaultdict
-
 import numpy as np
 import torch
 
@@ -33,7 +31,8 @@ def compute_threshold_f1(
 		threshold_range=None,
 		threshold_min=-1.0,
 		threshold_max=1.0,
-		threshold_step=0.05
+		threshold_step=0.05,
+		max_elements=10000000
 ):
 	if threshold is None and threshold_range is None:
 		threshold_range = np.arange(
@@ -43,154 +42,252 @@ def compute_threshold_f1(
 		)
 	elif threshold is not None:
 		threshold_range = [threshold]
-	max_f1 = float('-inf')
-	max_vals = None
-	for threshold in threshold_range:
-		f1, p, r, preds = compute_f1(scores, labels, threshold)
-		if f1 > max_f1:
-			max_f1 = f1
-			max_vals = f1, p, r, threshold, preds
+	threshold_range = np.asarray(threshold_range)
+	flat_scores = scores.reshape(-1, 1)
+	flat_positives = labels.reshape(-1, 1).eq(1)
+	# all thresholds are evaluated at once, in chunks of at most max_elements predictions
+	chunk_size = max(1, max_elements // max(flat_scores.shape[0], 1))
+	tp = []
+	fp = []
+	fn = []
+	for start in range(0, len(threshold_range), chunk_size):
+		thresholds = torch.tensor(
+			threshold_range[start:start + chunk_size],
+			dtype=scores.dtype,
+			device=scores.device
+		)
+		# [num_examples, num_thresholds]
+		predictions = flat_scores.gt(thresholds.unsqueeze(dim=0))
+		tp.append((predictions & flat_positives).float().sum(dim=0))
+		fp.append((predictions & ~flat_positives).float().sum(dim=0))
+		fn.append((~predictions & flat_positives).float().sum(dim=0))
+	tp = torch.cat(tp, dim=0)
+	fp = torch.cat(fp, dim=0)
+	fn = torch.cat(fn, dim=0)
+	precision = tp / torch.clamp(tp + fp, 1.0)
+	recall = tp / torch.clamp(tp + fn, 1.0)
+	f1 = 2.0 * (precision * recall) / (torch.clamp(precision + recall, 0.0001))
+	# argmax returns the first maximum, the same threshold a sequential sweep keeps
+	t_idx = torch.argmax(f1).item()
+	threshold = threshold_range[t_idx]
+	preds = get_predictions(scores, threshold)
+	return f1[t_idx], precision[t_idx], recall[t_idx], threshold, preds
+
+
+def compute_best_threshold_f1(scores, labels, min_f1_denominator=0.0001):
+	"""Finds the threshold with the best F1 exactly by evaluating every distinct score as a cut point.
+	Scores are sorted once and true positive counts come from a cumulative sum, so the search is O(n log n)
+	instead of recomputing the confusion counts for every threshold of a grid.
+	Returns:
+		f1, p, r, threshold, preds: Same as compute_threshold_f1, preds are scores.gt(threshold).
+	"""
+	flat_scores = scores.flatten()
+	flat_positives = labels.flatten().eq(1)
+	if flat_scores.shape[0] == 0:
+		zero = torch.tensor(0.0, device=scores.device)
+		return zero, zero, zero, 0.0, get_predictions(scores, 0.0)
+	sorted_scores, sort_idxs = torch.sort(flat_scores, descending=True)
+	# [num_examples]
+	cum_tp = torch.cumsum(flat_positives[sort_idxs].float(), dim=0)
+	# last index of every run of equal scores, predicting all scores >= that value as positive
+	is_last = torch.ones_like(sorted_scores, dtype=torch.bool)
+	is_last[:-1] = sorted_scores[:-1].ne(sorted_scores[1:])
+	cut_idxs = torch.nonzero(is_last, as_tuple=False).flatten()
+	cut_scores = sorted_scores[cut_idxs]
+	# thresholds sit halfway to the next lower distinct score, or just below the minimum score
+	next_scores = torch.cat([cut_scores[1:], cut_scores[-1:] - 1.0])
+	thresholds = next_scores + (cut_scores - next_scores) / 2.0
+	# halfway may round onto the cut score for adjacent floats, the next score is still exact
+	thresholds = torch.where(thresholds.lt(cut_scores), thresholds, next_scores)
+	tp = cum_tp[cut_idxs]
+	num_pred = (cut_idxs + 1).float()
+	num_pos = flat_positives.float().sum()
+	# predicting no positives at all, threshold at the maximum score, keeps thresholds in descending order
+	tp = torch.cat([tp.new_zeros(1), tp])
+	num_pred = torch.cat([num_pred.new_zeros(1), num_pred])
+	thresholds = torch.cat([sorted_scores[:1], thresholds])
+	fp = num_pred - tp
+	fn = num_pos - tp
+	precision = tp / torch.clamp(tp + fp, 1.0)
+	recall = tp / torch.clamp(tp + fn, 1.0)
+	f1 = 2.0 * (precision * recall) / (torch.clamp(precision + recall, min_f1_denominator))
+	# cut points are in descending threshold order, ties keep the lowest threshold like an ascending sweep
+	t_idx = len(f1) - 1 - torch.argmax(f1.flip(dims=[0])).item()
+	threshold = thresholds[t_idx].item()
+	preds = get_predictions(scores, threshold)
+	return f1[t_idx], precision[t_idx], recall[t_idx], threshold, preds
+
+
+def pairwise_energy(emb_model, heads, rels, tails, chunk_size=1024):
+	"""Computes the energy of every head with every (relation, tail) pair in one batched call per chunk.
+	Args:
+		heads: [num_heads, emb_size] head entity embeddings.
+		rels: [num_rels, emb_size] relation embeddings.
+		tails: [num_rels, emb_size] tail entity embeddings, one for each relation.
+	Returns:
+		[num_heads, num_rels] energies.
+	"""
+	# heads are scored in chunks either way, all_pairs_energy may still broadcast, e.g. l1 distances
+	all_pairs = hasattr(emb_model, 'all_pairs_energy')
+	energies = []
+	for start in range(0, heads.shape[0], chunk_size):
+		# [chunk_size, emb_size]
+		c_heads = heads[start:start + chunk_size]
+		if all_pairs:
+			energies.append(emb_model.all_pairs_energy(c_heads, rels, tails))
+		else:
+			# [chunk_size, 1, emb_size] against [1, num_rels, emb_size]
+			energies.append(
+				emb_model.energy(head=c_heads.unsqueeze(dim=1), rel=rels.unsqueeze(dim=0), tail=tails.unsqueeze(dim=0))
+			)
+	if len(energies) == 0:
+		return heads.new_zeros((0, rels.shape[0]))
+	return torch.cat(energies, dim=0)
+
 
-	return max_vals
+def label_matrix(t_ids, m_ids, t_labels):
+	# [num_tweets, num_misinfo]
+	m_index = {m_id: m_idx for m_idx, m_id in enumerate(m_ids)}
+	labels = torch.zeros([len(t_ids), len(m_ids)], dtype=torch.long)
+	for t_idx, t_id in enumerate(t_ids):
+		for m_id in t_labels[t_id]:
+			if m_id in m_index:
+				labels[t_idx, m_index[m_id]] = 1
+	return labels
+
+
+def has_positive_examples(pos_t_ids):
+	# misinfo without examples is joined and split back into ['']
+	return len(pos_t_ids) > 0 and not (len(pos_t_ids) == 1 and len(pos_t_ids[0]) == 0)
+
+
+def target_centroids(relations, m_examples, m_entities):
+	"""Centroid of the positive example embeddings of every misinfo target.
+	Returns:
+		m_ids (list), m_embs [num_misinfo, emb_size], m_centroids [num_misinfo, emb_size],
+		m_has_pos [num_misinfo] bool tensor.
+	"""
+	m_ids = list(relations.keys())
+	m_embs = torch.stack([relations[m_id] for m_id in m_ids], dim=0)
+	e_emb = next(iter(m_entities.values()))
+	m_has_pos = []
+	m_centroids = []
+	for m_id in m_ids:
+		pos_t_ids = m_examples[m_id]
+		if has_positive_examples(pos_t_ids):
+			m_centroids.append(torch.stack([m_entities[pos_t_id] for pos_t_id in pos_t_ids], dim=0).mean(dim=0))
+			m_has_pos.append(True)
+		else:
+			# placeholder, energies of misinfo without positive examples are ignored
+			m_centroids.append(torch.zeros_like(e_emb))
+			m_has_pos.append(False)
+	m_centroids = torch.stack(m_centroids, dim=0)
+	m_has_pos = torch.tensor(m_has_pos, dtype=torch.bool, device=m_centroids.device)
+	return m_ids, m_embs, m_centroids, m_has_pos
+
+
+def centroid_energies(emb_model, entities, relations, m_examples, m_entities):
+	"""Energy of every tweet with every misinfo target and the centroid of the target's positive examples.
+	Returns:
+		t_ids (list), m_ids (list), energies [num_tweets, num_misinfo], m_has_pos [num_misinfo] bool tensor.
+	"""
+	t_ids = list(entities.keys())
+	t_embs = torch.stack([entities[t_id] for t_id in t_ids], dim=0)
+	m_ids, m_embs, m_centroids, m_has_pos = target_centroids(relations, m_examples, m_entities)
+	energies = pairwise_energy(emb_model, t_embs, m_embs, m_centroids)
+	return t_ids, m_ids, energies, m_has_pos.to(energies.device)
 
 
 def find_m_thresholds(emb_model, entities, relations, m_examples, m_entities, t_labels):
-	m_energies = defaultdict(list)
-	m_labels = defaultdict(list)
 	m_thresholds = {}
-	for t_id, t_emb in entities.items():
-		for m_id, m_emb in relations.items():
-			pos_t_ids = m_examples[m_id]
-			m_label = 1 if m_id in t_labels[t_id] else 0
-			p_e_embs = []
-			if len(pos_t_ids) == 1 and len(pos_t_ids[0]) == 0:
-				# set threshold so high no classified positives
-				m_thresholds[m_id] = 1e6
-				continue
-			for pos_t_id in pos_t_ids:
-				p_e_emb = m_entities[pos_t_id]
-				p_e_embs.append(p_e_emb)
-			p_e_embs = torch.stack(p_e_embs, dim=0).mean(dim=0)
-			p_e = emb_model.energy(
-				head=t_emb,
-				rel=m_emb,
-				tail=p_e_embs
-			)
-			m_energies[m_id].append(p_e)
-			m_labels[m_id].append(m_label)
-	m_f_energies = {}
-	m_f_labels = {}
-	for m_id in m_energies:
-		m_f_energies[m_id] = torch.tensor(m_energies[m_id], dtype=torch.float)
-		m_f_labels[m_id] = torch.tensor(m_labels[m_id], dtype=torch.long)
-
-	for m_id, m_es in m_f_energies.items():
-		scores = -m_es
-		min_score = torch.min(scores).item()
-		max_score = torch.max(scores).item()
-		threshold_range = np.round(np.linspace(
-			min_score,
-			max_score,
-			num=100
-		), 4)
-		f1, p, r, threshold, m_preds = compute_threshold_f1(
-			scores,
-			m_f_labels[m_id],
-			threshold_range=threshold_range,
+	if len(entities) == 0:
+		return m_thresholds
+	t_ids, m_ids, energies, m_has_pos = centroid_energies(
+		emb_model, entities, relations, m_examples, m_entities
+	)
+	labels = label_matrix(t_ids, m_ids, t_labels).to(energies.device)
+	# [num_tweets, num_misinfo]
+	scores = -energies
+	for m_idx, m_id in enumerate(m_ids):
+		if not m_has_pos[m_idx]:
+			# set threshold so high no classified positives
+			m_thresholds[m_id] = 1e6
+			continue
+		m_scores = scores[:, m_idx]
+		f1, p, r, threshold, m_preds = compute_best_threshold_f1(
+			m_scores,
+			labels[:, m_idx],
 		)
 
 		m_thresholds[m_id] = threshold
 	return m_thresholds
 
 
-def find_mr_thresholds(emb_model, entities, relations, m_examples, m_entities, t_labels):
-	m_energies = defaultdict(list)
-	m_labels = defaultdict(list)
-	for t_id, t_emb in entities.items():
-		for m_id, m_emb in relations.items():
-			pos_t_ids = m_examples[m_id]
-			m_label = 1 if m_id in t_labels[t_id] else 0
-			p_e_embs = []
-			for pos_t_id in pos_t_ids:
-				try:
-					p_e_emb = m_entities[pos_t_id]
-				except KeyError:
-					raise Exception(f"KeyError for MisT id {m_id}. The problem may be that you need to add at least one example of this MisT to dev.jsonl and test.jsonl.")
-				p_e_embs.append(p_e_emb)
-			p_e_embs = torch.stack(p_e_embs, dim=0)
-			p_es = emb_model.energy(
-				head=t_emb.unsqueeze(dim=0),
-				rel=m_emb.unsqueeze(dim=0),
-				tail=p_e_embs
-			)
-			m_energies[m_id].extend(p_es)
-			m_labels[m_id].extend([m_label] * len(p_es))
-	m_f_energies = {}
-	m_f_labels = {}
-	for m_id in m_energies:
-		m_f_energies[m_id] = torch.tensor(m_energies[m_id], dtype=torch.float)
-		m_f_labels[m_id] = torch.tensor(m_labels[m_id], dtype=torch.long)
+def positive_energies(emb_model, entities, relations, m_examples, m_entities, chunk_size=1024):
+	"""Energy of every tweet with every positive example of each misinfo target.
+	Returns:
+		dict: m_id -> [num_tweets, num_pos] energies, tweets in entities order.
+	"""
+	t_embs = torch.stack(list(entities.values()), dim=0)
+	m_energies = {}
+	for m_id, m_emb in relations.items():
+		pos_t_ids = m_examples[m_id]
+		p_e_embs = []
+		for pos_t_id in pos_t_ids:
+			try:
+				p_e_emb = m_entities[pos_t_id]
+			except KeyError:
+				raise Exception(f"KeyError for MisT id {m_id}. The problem may be that you need to add at least one example of this MisT to dev.jsonl and test.jsonl.")
+			p_e_embs.append(p_e_emb)
+		# [num_pos, emb_size]
+		p_e_embs = torch.stack(p_e_embs, dim=0)
+		m_embs = m_emb.unsqueeze(dim=0).expand(p_e_embs.shape[0], -1)
+		m_energies[m_id] = pairwise_energy(emb_model, t_embs, m_embs, p_e_embs, chunk_size=chunk_size)
+	return m_energies
 
+
+def find_mr_thresholds(emb_model, entities, relations, m_examples, m_entities, t_labels, m_energies=None):
 	mr_thresholds = {}
-	for m_id, m_es in m_f_energies.items():
-		scores = -m_es
-		min_score = torch.min(scores).item()
-		max_score = torch.max(scores).item()
-		threshold_range = np.round(np.linspace(
-			min_score,
-			max_score,
-			num=100
-		), 4)
-		f1, p, r, threshold, m_preds = compute_threshold_f1(
+	if len(entities) == 0:
+		return mr_thresholds
+	if m_energies is None:
+		m_energies = positive_energies(emb_model, entities, relations, m_examples, m_entities)
+	m_ids = list(relations.keys())
+	labels = label_matrix(list(entities.keys()), m_ids, t_labels)
+	for m_idx, m_id in enumerate(m_ids):
+		# [num_tweets, num_pos]
+		m_es = m_energies[m_id]
+		# tweet-major, every tweet label is repeated for each positive example
+		scores = -m_es.flatten()
+		m_labels = labels[:, m_idx].to(m_es.device).unsqueeze(dim=-1).expand_as(m_es).flatten()
+		f1, p, r, threshold, m_preds = compute_best_threshold_f1(
 			scores,
-			m_f_labels[m_id],
-			threshold_range=threshold_range,
+			m_labels,
 		)
 
 		mr_thresholds[m_id] = threshold
 	return mr_thresholds
 
 
-def find_mc_thresholds(emb_model, entities, relations, m_examples, m_entities, t_labels, mr_thresholds):
-	m_energies = defaultdict(list)
-	m_labels = defaultdict(list)
-	for t_id, t_emb in entities.items():
-		for m_id, m_emb in relations.items():
-			pos_t_ids = m_examples[m_id]
-			m_label = 1 if m_id in t_labels[t_id] else 0
-			p_e_embs = []
-			for pos_t_id in pos_t_ids:
-				p_e_emb = m_entities[pos_t_id]
-				p_e_embs.append(p_e_emb)
-			p_e_embs = torch.stack(p_e_embs, dim=0)
-			p_es = emb_model.energy(
-				head=t_emb.unsqueeze(dim=0),
-				rel=m_emb.unsqueeze(dim=0),
-				tail=p_e_embs
-			)
-			p_s = ((-p_es).gt(mr_thresholds[m_id])).float().mean()
-			m_energies[m_id].append(p_s)
-			m_labels[m_id].append(m_label)
-	m_f_energies = {}
-	m_f_labels = {}
-	for m_id in m_energies:
-		m_f_energies[m_id] = torch.tensor(m_energies[m_id], dtype=torch.float)
-		m_f_labels[m_id] = torch.tensor(m_labels[m_id], dtype=torch.long)
+def positive_ratios(m_es, mr_threshold):
+	# fraction of positive examples each tweet is within the relation threshold of, [num_tweets]
+	return ((-m_es).gt(mr_threshold)).float().mean(dim=-1)
+
 
+def find_mc_thresholds(emb_model, entities, relations, m_examples, m_entities, t_labels, mr_thresholds, m_energies=None):
 	mc_thresholds = {}
-	for m_id, m_es in m_f_energies.items():
-		scores = m_es
-		min_score = torch.min(scores).item()
-		max_score = torch.max(scores).item()
-		threshold_range = np.round(np.linspace(
-			min_score,
-			max_score,
-			num=100
-		), 4)
-		f1, p, r, threshold, m_preds = compute_threshold_f1(
+	if len(entities) == 0:
+		return mc_thresholds
+	if m_energies is None:
+		m_energies = positive_energies(emb_model, entities, relations, m_examples, m_entities)
+	m_ids = list(relations.keys())
+	labels = label_matrix(list(entities.keys()), m_ids, t_labels)
+	for m_idx, m_id in enumerate(m_ids):
+		m_es = m_energies[m_id]
+		scores = positive_ratios(m_es, mr_thresholds[m_id])
+		f1, p, r, threshold, m_preds = compute_best_threshold_f1(
 			scores,
-			m_f_labels[m_id],
-			threshold_range=threshold_range,
+			labels[:, m_idx].to(m_es.device),
 		)
 
 		mc_thresholds[m_id] = threshold
@@ -198,88 +295,57 @@ def find_mc_thresholds(emb_model, entities, relations, m_examples, m_entities, t
 
 
 def evaluate_m_thresholds(emb_model, entities, relations, m_examples, m_entities, t_labels, m_thresholds):
-	scores = []
-	labels = []
-	m_ids = []
-	tweet_ids = []
-	for t_id, t_emb in entities.items():
-		for m_id, m_emb in relations.items():
-			pos_t_ids = m_examples[m_id]
-			m_label = 1 if m_id in t_labels[t_id] else 0
-			p_e_embs = []
-			if len(pos_t_ids) == 1 and len(pos_t_ids[0]) == 0:
-				# no positive examples of m_id in dev set
-				p_s = 0.0
-			else:
-				for pos_t_id in pos_t_ids:
-					p_e_emb = m_entities[pos_t_id]
-					p_e_embs.append(p_e_emb)
-				p_e_embs = torch.stack(p_e_embs, dim=0).mean(dim=0)
-				p_e = emb_model.energy(
-					head=t_emb,
-					rel=m_emb,
-					tail=p_e_embs
-				)
-				p_s = (-p_e).gt(m_thresholds[m_id]).float()
-			scores.append(p_s)
-			labels.append(m_label)
-			m_ids.append(m_id)
-			tweet_ids.append(t_id)
-	scores = torch.tensor(scores, dtype=torch.float)
-	labels = torch.tensor(labels, dtype=torch.long)
-
-	min_score = torch.min(scores).item()
-	max_score = torch.max(scores).item()
-	threshold_range = np.round(np.linspace(
-		min_score,
-		max_score,
-		num=100
-	), 4)
+	t_ids, m_ids, energies, m_has_pos = centroid_energies(
+		emb_model, entities, relations, m_examples, m_entities
+	)
+	# no positive examples of m_id in dev set predicts negative for all tweets
+	thresholds = torch.tensor(
+		[m_thresholds[m_id] if m_has_pos[m_idx] else 0.0 for m_idx, m_id in enumerate(m_ids)],
+		dtype=energies.dtype,
+		device=energies.device
+	)
+	# [num_tweets, num_misinfo]
+	scores = (-energies).gt(thresholds.unsqueeze(dim=0)) & m_has_pos.unsqueeze(dim=0)
+	# flattened tweet-major, same order as iterating tweets then misinfo
+	scores = scores.float().flatten().cpu()
+	labels = label_matrix(t_ids, m_ids, t_labels).flatten()
+	tweet_ids = [t_id for t_id in t_ids for _ in m_ids]
+	m_ids = [m_id for _ in t_ids for m_id in m_ids]
+
 	# TODO compute f1 for each misinfo target
+	# scores are the binary decisions of the dev-tuned thresholds, so they are scored as is
 	f1, p, r, threshold, preds = compute_threshold_f1(
 		scores,
 		labels,
-		threshold_range=threshold_range,
+		threshold=0.5
 	)
 	return f1, p, r, threshold, scores, preds, labels, tweet_ids, m_ids
 
 
-def evaluate_mc_thresholds(emb_model, entities, relations, m_examples, m_entities, t_labels, mr_thresholds, mc_thresholds):
-	scores = []
-	labels = []
-	misinfo = []
-	for t_id, t_emb in entities.items():
-		for m_id, m_emb in relations.items():
-			pos_t_ids = m_examples[m_id]
-			m_label = 1 if m_id in t_labels[t_id] else 0
-			p_e_embs = []
-			for pos_t_id in pos_t_ids:
-				p_e_emb = m_entities[pos_t_id]
-				p_e_embs.append(p_e_emb)
-			p_e_embs = torch.stack(p_e_embs, dim=0)
-			p_es = emb_model.energy(
-				head=t_emb.unsqueeze(dim=0),
-				rel=m_emb.unsqueeze(dim=0),
-				tail=p_e_embs
-			)
-			p_s = ((-p_es).gt(mr_thresholds[m_id])).float().mean().gt(mc_thresholds[m_id]).float()
-			scores.append(p_s)
-			labels.append(m_label)
-			misinfo.append(m_id)
-	scores = torch.tensor(scores, dtype=torch.float)
-	labels = torch.tensor(labels, dtype=torch.long)
-
-	min_score = torch.min(scores).item()
-	max_score = torch.max(scores).item()
-	threshold_range = np.round(np.linspace(
-		min_score,
-		max_score,
-		num=100
-	), 4)
+def evaluate_mc_thresholds(
+		emb_model, entities, relations, m_examples, m_entities, t_labels, mr_thresholds, mc_thresholds,
+		m_energies=None
+):
+	if m_energies is None:
+		m_energies = positive_energies(emb_model, entities, relations, m_examples, m_entities)
+	m_ids = list(relations.keys())
+	# [num_tweets, num_misinfo]
+	scores = torch.stack(
+		[
+			positive_ratios(m_energies[m_id], mr_thresholds[m_id]).gt(mc_thresholds[m_id]).float().cpu()
+			for m_id in m_ids
+		],
+		dim=-1
+	)
+	# flattened tweet-major, same order as iterating tweets then misinfo
+	scores = scores.flatten()
+	labels = label_matrix(list(entities.keys()), m_ids, t_labels).flatten()
+
 	# TODO compute f1 for each misinfo target
+	# scores are the binary decisions of the dev-tuned thresholds, so they are scored as is
 	f1, p, r, threshold, preds = compute_threshold_f1(
 		scores,
 		labels,
-		threshold_range=threshold_range,
+		threshold=0.5
 	)
 	return f1, p, r, threshold, preds
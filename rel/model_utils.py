@@ -1,5 +1,6 @@
 
 import os
+import sys
 
 import pytorch_lightning as pl
 from transformers import BertModel, BertConfig
@@ -8,6 +9,10 @@ import torch.distributed as dist
 
 import metric_utils
 from emb_utils import *
+from shard_utils import EmbeddingShardWriter
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.precision_utils import bert_hidden_states, full_precision
 
 
 class CovidTwitterMisinfoModel(pl.LightningModule):
@@ -16,7 +21,9 @@ class CovidTwitterMisinfoModel(pl.LightningModule):
 			gamma,
 			eval_mode='centroid', eval_noise=None,
 			threshold=None, model_type='bert', model_layers=1,
-			torch_cache_dir=None, predict_mode=False, predict_path=None, load_pretrained=False
+			torch_cache_dir=None, predict_mode=False, predict_path=None, load_pretrained=False,
+			in_batch_negatives=False, embedding_cache_paths=None, predict_dtype='float32', predict_shard_size=65536,
+			precision='32', gradient_checkpointing=False, encoder_chunk_size=None
 	):
 		super().__init__()
 		self.pre_model_name = pre_model_name
@@ -28,10 +35,23 @@ class CovidTwitterMisinfoModel(pl.LightningModule):
 		self.threshold = threshold
 		self.predict_mode = predict_mode
 		self.predict_path = predict_path
+		self.predict_dtype = predict_dtype
+		self.predict_shard_size = predict_shard_size
+		# e_type -> shard writer, predicted embeddings are written as they are produced
+		self.predict_writers = {}
+		# e_type -> exported encoder replacing bert and emb_model in encode, e.g. an onnx graph
+		self.encoders = None
 		self.eval_mode = eval_mode.lower()
 		self.eval_noise = eval_noise
 		self.model_type = model_type
 		self.model_layers = model_layers
+		self.in_batch_negatives = in_batch_negatives
+		# 32, 16 or bf16 autocast of the encoder, embedding heads, energies and losses always run in fp32
+		self.precision = precision
+		# training forward encodes at most encoder_chunk_size sequences per bert call, None encodes all at once
+		self.encoder_chunk_size = encoder_chunk_size
+		# (val, test) paths the extracted test embeddings are saved to for later evaluation runs
+		self.embedding_cache_paths = embedding_cache_paths
 
 		if self.predict_mode:
 			if not os.path.exists(self.predict_path):
@@ -67,6 +87,13 @@ class CovidTwitterMisinfoModel(pl.LightningModule):
 			else:
 				raise ValueError(f'Unknown model type: {model_type}')
 
+		self.gradient_checkpointing = gradient_checkpointing
+		if self.gradient_checkpointing:
+			if not hasattr(self.bert, 'gradient_checkpointing_enable'):
+				raise ValueError(f'Gradient checkpointing is not supported for model type: {model_type}')
+			# only layer inputs are kept, layer activations are recomputed during backward
+			self.bert.gradient_checkpointing_enable()
+
 		self.emb_size = emb_size
 		self.emb_loss_norm = emb_loss_norm
 		self.gamma = gamma
@@ -74,49 +101,15 @@ class CovidTwitterMisinfoModel(pl.LightningModule):
 		self.f_dropout = nn.Dropout(
 			p=self.config.hidden_dropout_prob
 		)
-		if emb_model == 'transd':
-			self.emb_model = TransDEmbedding(
-				self.config.hidden_size,
-				self.emb_size,
-				self.gamma,
-				self.emb_loss_norm
-			)
-		elif emb_model == 'transe':
-			self.emb_model = TransEEmbedding(
-				self.config.hidden_size,
-				self.emb_size,
-				self.gamma,
-				self.emb_loss_norm
-			)
-		elif emb_model == 'knn':
-			self.emb_model = KNNEmbedding(
-				self.gamma,
-				self.emb_loss_norm
-			)
+		self.emb_model = build_emb_model(
+			emb_model,
+			self.config.hidden_size,
+			self.emb_size,
+			self.gamma,
+			self.emb_loss_norm
+		)
+		if emb_model == 'knn':
 			self.emb_size = self.config.hidden_size
-		elif emb_model == 'rotate':
-			self.emb_model = RotatEEmbedding(
-				self.config.hidden_size,
-				self.emb_size,
-				self.gamma,
-				self.emb_loss_norm
-			)
-		elif emb_model == 'transms':
-			self.emb_model = TransMSEmbedding(
-				self.config.hidden_size,
-				self.emb_size,
-				self.gamma,
-				self.emb_loss_norm
-			)
-		elif emb_model == 'tucker':
-			self.emb_model = TuckEREmbedding(
-				self.config.hidden_size,
-				self.emb_size,
-				self.gamma,
-				self.emb_loss_norm
-			)
-		else:
-			raise ValueError(f'Unknown embedding model: {emb_model}')
 
 		self.save_hyperparameters()
 
@@ -126,19 +119,24 @@ class CovidTwitterMisinfoModel(pl.LightningModule):
 		num_entities = num_sequences_per_example - 1
 		pad_seq_len = batch['pad_seq_len']
 
-		# [bsize, num_seq, seq_len] -> [bsize * num_seq, seq_len]
-		input_ids = batch['input_ids'].view(num_examples * num_sequences_per_example, pad_seq_len)
-		attention_mask = batch['attention_mask'].view(num_examples * num_sequences_per_example, pad_seq_len)
-		token_type_ids = batch['token_type_ids'].view(num_examples * num_sequences_per_example, pad_seq_len)
+		if 'seq_index' in batch:
+			# de-duplicated batch, [num_unique, seq_len] is encoded once
+			input_ids = batch['input_ids']
+			attention_mask = batch['attention_mask']
+			token_type_ids = batch['token_type_ids']
+		else:
+			# [bsize, num_seq, seq_len] -> [bsize * num_seq, seq_len]
+			input_ids = batch['input_ids'].view(num_examples * num_sequences_per_example, pad_seq_len)
+			attention_mask = batch['attention_mask'].view(num_examples * num_sequences_per_example, pad_seq_len)
+			token_type_ids = batch['token_type_ids'].view(num_examples * num_sequences_per_example, pad_seq_len)
 
-		# [bsize * num_seq, seq_len, hidden_size]
-		contextualized_embeddings = self.bert(
-			input_ids,
-			attention_mask=attention_mask,
-			token_type_ids=token_type_ids
-		)[0]
 		# [bsize * num_seq, hidden_size]
-		lm_output = contextualized_embeddings[:, 0]
+		lm_output = self._cls_output(input_ids, attention_mask, token_type_ids)
+		if 'seq_index' in batch:
+			# [num_unique, hidden_size] -> [bsize, num_seq, hidden_size]
+			# gradients of repeated sequences are summed by the gather backward
+			lm_output = lm_output[batch['seq_index']]
+		# dropout after the gather so repeated sequences still get independent masks
 		lm_output = self.f_dropout(lm_output)
 		lm_output = lm_output.view(num_examples, num_sequences_per_example, self.config.hidden_size)
 		# [bsize, hidden_size]
@@ -153,59 +151,83 @@ class CovidTwitterMisinfoModel(pl.LightningModule):
 		# [bsize, num_seq, emb_size]
 		return e_embs, r_embs
 
-	def _triplet_energy(self, e_embs, m_embs, batch):
-		# all [bsize, emb_size], [bsize, emb_size], [bsize, pos_samples, emb_size], [bsize, neg_samples, emb_size]
-		t_ex_embs, pos_embs, neg_embs = self._split_embeddings(e_embs, batch)
-		# [bsize, 1, emb_size]
-		t_ex_embs = t_ex_embs.unsqueeze(dim=-2)
-		m_embs = m_embs.unsqueeze(dim=-2)
+	def _cls_output(self, input_ids, attention_mask, token_type_ids):
+		# [num_seq, hidden_size] CLS outputs, encoded in micro-batches of encoder_chunk_size sequences.
+		# Sequences are encoded independently, so chunking leaves the outputs and loss unchanged. Attention and
+		# feed-forward buffers are bounded by the chunk size, with gradient checkpointing the retained
+		# activations shrink to each layer's inputs as well
+		num_seq = input_ids.shape[0]
+		chunk_size = max(self.encoder_chunk_size if self.encoder_chunk_size is not None else num_seq, 1)
+		chunk_outputs = []
+		for start in range(0, num_seq, chunk_size):
+			end = start + chunk_size
+			# [chunk_size, seq_len, hidden_size]
+			contextualized_embeddings = bert_hidden_states(
+				self.bert,
+				self.precision,
+				input_ids[start:end],
+				attention_mask[start:end],
+				token_type_ids[start:end]
+			)
+			chunk_outputs.append(contextualized_embeddings[:, 0])
+		if len(chunk_outputs) == 1:
+			return chunk_outputs[0]
+		return torch.cat(chunk_outputs, dim=0)
 
-		# [bsize]
-		pos_subj_energy = self.emb_model.energy(t_ex_embs, m_embs, pos_embs)
-		# [bsize]
-		pos_obj_energy = self.emb_model.energy(pos_embs, m_embs, t_ex_embs)
-		# [bsize, 2]
-		pos_energy = torch.stack([pos_subj_energy, pos_obj_energy], dim=-1)
-		# [bsize]
-		neg_subj_energy = self.emb_model.energy(t_ex_embs, m_embs, neg_embs)
-		# [bsize]
-		neg_obj_energy = self.emb_model.energy(neg_embs, m_embs, t_ex_embs)
-		# [bsize, 2]
-		neg_energy = torch.stack([neg_subj_energy, neg_obj_energy], dim=-1)
-
-		return pos_energy, neg_energy
+	def _triplet_energy(self, e_embs, m_embs, batch):
+		return triplet_energy(self.emb_model, e_embs, m_embs, batch)
 
 	@staticmethod
 	def _split_embeddings(embs, batch):
-		t_ex_embs = embs[:, 0]
-		pos_samples = batch['pos_samples']
-		if pos_samples > 0:
-			pos_embs = embs[:, 1:1+pos_samples]
-		else:
-			pos_embs = None
-		neg_samples = batch['neg_samples']
-		if neg_samples > 0:
-			neg_embs = embs[:, 1+pos_samples:1+pos_samples+neg_samples]
-		else:
-			neg_embs = None
-		return t_ex_embs, pos_embs, neg_embs
+		return split_embeddings(embs, batch)
 
 	def _loss(self, pos_energy, neg_energy, subj_obj_mask):
-		# first randomly pick between subject and object losses
-		# [bsize]
-		pos_energy = (pos_energy * subj_obj_mask).sum(dim=-1)
-		# [bsize]
-		neg_energy = (neg_energy * subj_obj_mask).sum(dim=-1)
-
-		loss, accuracy = self.emb_model.loss(pos_energy, neg_energy)
+		return triplet_loss(self.emb_model, pos_energy, neg_energy, subj_obj_mask)
 
-		loss = loss.mean()
+	def _in_batch_loss(self, e_embs, m_embs, batch):
+		# [bsize, emb_size], [bsize, pos_samples, emb_size], [bsize, neg_samples, emb_size]
+		t_ex_embs, pos_embs, neg_embs = self._split_embeddings(e_embs, batch)
+		num_examples = batch['num_examples']
+		# [bsize, 1, emb_size]
+		heads = t_ex_embs.unsqueeze(dim=-2)
+		m_embs = m_embs.unsqueeze(dim=-2)
+		# tweets of the other examples are negatives for every misinfo target in the batch
+		# [1, bsize, emb_size]
+		b_neg_embs = t_ex_embs.unsqueeze(dim=0)
+		# [bsize, bsize]
+		neg_mask = batch['in_batch_mask']
+		if neg_embs is not None:
+			# explicitly sampled hard negatives on top of the in-batch negatives
+			# [bsize, bsize + neg_samples, emb_size]
+			b_neg_embs = torch.cat([b_neg_embs.expand(num_examples, -1, -1), neg_embs], dim=1)
+			# [bsize, bsize + neg_samples]
+			neg_mask = torch.cat([neg_mask, neg_mask.new_ones(num_examples, neg_embs.shape[1])], dim=1)
+		# [bsize, 1]
+		subj_mask = batch['subj_obj_mask'][:, 0:1]
+		obj_mask = batch['subj_obj_mask'][:, 1:2]
+		# [bsize, pos_samples]
+		pos_energy = subj_mask * self.emb_model.energy(heads, m_embs, pos_embs) \
+			+ obj_mask * self.emb_model.energy(pos_embs, m_embs, heads)
+		# [bsize, num_negatives]
+		neg_energy = subj_mask * self.emb_model.energy(heads, m_embs, b_neg_embs) \
+			+ obj_mask * self.emb_model.energy(b_neg_embs, m_embs, heads)
+		# [bsize, pos_samples, num_negatives]
+		pos_energy = pos_energy.unsqueeze(dim=-1)
+		neg_energy = neg_energy.unsqueeze(dim=-2)
+		neg_mask = neg_mask.unsqueeze(dim=-2)
+		loss, _ = self.emb_model.loss(pos_energy, neg_energy)
+		num_pairs = torch.clamp(neg_mask.sum() * pos_energy.shape[-2], min=1.0)
+		loss = (loss * neg_mask).sum() / num_pairs
+		accuracy = (pos_energy.lt(neg_energy).float() * neg_mask).sum() / num_pairs
 		return loss, accuracy
 
 	def _triplet_step(self, batch):
-		e_embs, r_embs = self(batch)
-		pos_energy, neg_energy = self._triplet_energy(e_embs, r_embs, batch)
-		loss, accuracy = self._loss(pos_energy, neg_energy, batch['subj_obj_mask'])
+		with full_precision(batch['input_ids'].device):
+			e_embs, r_embs = self(batch)
+			if self.in_batch_negatives and 'in_batch_mask' in batch:
+				return self._in_batch_loss(e_embs, r_embs, batch)
+			pos_energy, neg_energy = self._triplet_energy(e_embs, r_embs, batch)
+			loss, accuracy = self._loss(pos_energy, neg_energy, batch['subj_obj_mask'])
 		return loss, accuracy
 
 	def training_step(self, batch, batch_nb):
@@ -232,24 +254,37 @@ class CovidTwitterMisinfoModel(pl.LightningModule):
 			else:
 				return self._predict_step(batch, 'val')
 
-	def _predict_step(self, batch, name):
-		e_type = batch['e_type']
+	def use_encoders(self, encoders):
+		self.encoders = encoders
 
-		input_ids = batch['input_ids']
-		attention_mask = batch['attention_mask']
-		token_type_ids = batch['token_type_ids']
+	def encode(self, batch):
+		# [bsize, emb_size] embeddings of a MisinfoPredictBatchCollator batch
+		if self.encoders is not None:
+			return self.encoders[batch['e_type']](
+				batch['input_ids'],
+				batch['attention_mask'],
+				batch['token_type_ids']
+			)
+		with full_precision(batch['input_ids'].device):
+			contextualized_embeddings = bert_hidden_states(
+				self.bert,
+				self.precision,
+				batch['input_ids'],
+				batch['attention_mask'],
+				batch['token_type_ids']
+			)
+			# [bsize, hidden_size]
+			lm_output = contextualized_embeddings[:, 0]
+			return self.emb_model(lm_output, batch['e_type'])
 
-		contextualized_embeddings = self.bert(
-			input_ids,
-			attention_mask=attention_mask,
-			token_type_ids=token_type_ids
-		)[0]
-		# [bsize, hidden_size]
-		lm_output = contextualized_embeddings[:, 0]
-		b_embs = self.emb_model(lm_output, e_type)
+	def _predict_step(self, batch, name):
+		e_type = batch['e_type']
+		b_embs = self.encode(batch)
 
-		if self.eval_noise is not None and self.eval_noise > 0:
-			b_embs = b_embs + (torch.randn_like(b_embs) * self.eval_noise)
+		if self.predict_mode:
+			self._write_predictions(e_type, batch['ids'], b_embs)
+			# nothing is kept until epoch end, embeddings are already on disk
+			return {f'{name}_num_embs': len(batch['ids'])}
 
 		results = {
 			f'{name}_e_type': e_type,
@@ -329,19 +364,50 @@ class CovidTwitterMisinfoModel(pl.LightningModule):
 		m_examples = {m_id: m_e for m_id, m_e in zip(m_ids, m_examples)}
 		return entities, relations, m_examples, t_labels
 
+	def _add_eval_noise(self, embeddings):
+		if self.eval_noise is None or self.eval_noise <= 0:
+			return embeddings
+		return {e_id: e_emb + (torch.randn_like(e_emb) * self.eval_noise) for e_id, e_emb in embeddings.items()}
+
 	def _test_epoch_end(self, outputs, name):
 		val_entity_outputs, val_rel_outputs, test_entity_outputs, test_rel_outputs = outputs
 
-		dev_entities, dev_relations, dev_m_examples, dev_t_labels = self._extract_embeddings(
+		dev_embeddings = self._extract_embeddings(
 			val_entity_outputs,
 			val_rel_outputs,
 			name
 		)
-		test_entities, test_relations, _, test_t_labels = self._extract_embeddings(
+		test_embeddings = self._extract_embeddings(
 			test_entity_outputs,
 			test_rel_outputs,
 			name
 		)
+		# shards of a distributed run only hold part of the embeddings
+		if self.embedding_cache_paths is not None and self.trainer.world_size == 1:
+			val_cache_path, test_cache_path = self.embedding_cache_paths
+			save_embeddings(val_cache_path, *dev_embeddings)
+			save_embeddings(test_cache_path, *test_embeddings)
+
+		f1, p, r, results = self.evaluate_embeddings(dev_embeddings, test_embeddings)
+		self.log(f'{name}_f1', f1)
+		self.log(f'{name}_p', p)
+		self.log(f'{name}_r', r)
+		return results
+
+	def evaluate_embeddings(self, dev_embeddings, test_embeddings):
+		"""Tunes thresholds on dev and evaluates on test using only the extracted embeddings, no encoder.
+		Args:
+			dev_embeddings: (entities, relations, m_examples, t_labels) of the val split.
+			test_embeddings: (entities, relations, m_examples, t_labels) of the test split.
+		Returns:
+			f1, p, r, results: test metrics and the results of the eval mode.
+		"""
+		dev_entities, dev_relations, dev_m_examples, dev_t_labels = dev_embeddings
+		test_entities, test_relations, _, test_t_labels = test_embeddings
+		dev_entities = self._add_eval_noise(dev_entities)
+		dev_relations = self._add_eval_noise(dev_relations)
+		test_entities = self._add_eval_noise(test_entities)
+		test_relations = self._add_eval_noise(test_relations)
 
 		# TODO get misinfo level stats
 		if self.eval_mode == 'centroid':
@@ -379,13 +445,22 @@ class CovidTwitterMisinfoModel(pl.LightningModule):
 				'preds': pred_list
 			}
 		elif self.eval_mode == 'all':
+			# dev energies against all positive examples are shared by both threshold searches
+			dev_m_energies = metric_utils.positive_energies(
+				self.emb_model,
+				dev_entities,
+				dev_relations,
+				dev_m_examples,
+				dev_entities
+			)
 			mr_thresholds = metric_utils.find_mr_thresholds(
 				self.emb_model,
 				dev_entities,
 				dev_relations,
 				dev_m_examples,
 				dev_entities,
-				dev_t_labels
+				dev_t_labels,
+				m_energies=dev_m_energies
 			)
 			mc_thresholds = metric_utils.find_mc_thresholds(
 				self.emb_model,
@@ -394,7 +469,8 @@ class CovidTwitterMisinfoModel(pl.LightningModule):
 				dev_m_examples,
 				dev_entities,
 				dev_t_labels,
-				mr_thresholds
+				mr_thresholds,
+				m_energies=dev_m_energies
 			)
 
 			f1, p, r, threshold, preds = metric_utils.evaluate_mc_thresholds(
@@ -417,10 +493,7 @@ class CovidTwitterMisinfoModel(pl.LightningModule):
 		else:
 			raise ValueError(f'Unknown eval mode: {self.eval_mode}')
 
-		self.log(f'{name}_f1', f1)
-		self.log(f'{name}_p', p)
-		self.log(f'{name}_r', r)
-		return results
+		return f1, p, r, results
 
 	def validation_epoch_end(self, outputs):
 		if not self.predict_mode:
@@ -434,22 +507,22 @@ class CovidTwitterMisinfoModel(pl.LightningModule):
 		else:
 			self._predict_epoch_end(outputs, 'test')
 
-	def _predict_epoch_end(self, outputs, name):
-		for output in outputs:
-			embs = torch.cat([x[f'{name}_b_embs'] for x in output], dim=0)
-			e_ids = [e_id for x in output for e_id in x[f'{name}_ids']]
-			e_type = output[0][f'{name}_e_type']
-
-			device_id = get_device_id()
-			e_path = os.path.join(self.predict_path, f'{e_type}-{device_id}-embeddings.pt')
-			torch.save(
-				{
-					'ids': e_ids,
-					'e_type': e_type,
-					'embs': embs
-				},
-				e_path
+	def _write_predictions(self, e_type, ids, b_embs):
+		if e_type not in self.predict_writers:
+			self.predict_writers[e_type] = EmbeddingShardWriter(
+				self.predict_path,
+				e_type,
+				device_id=get_device_id(),
+				dtype=self.predict_dtype,
+				shard_size=self.predict_shard_size,
+				num_devices=get_num_devices()
 			)
+		self.predict_writers[e_type].write(ids, b_embs.detach().float().cpu().numpy())
+
+	def _predict_epoch_end(self, outputs, name):
+		for writer in self.predict_writers.values():
+			writer.close()
+		self.predict_writers = {}
 
 	def configure_optimizers(self):
 		params = self._get_optimizer_params(self.weight_decay)
@@ -476,6 +549,113 @@ class CovidTwitterMisinfoModel(pl.LightningModule):
 		return optimizer_params
 
 
+def split_embeddings(embs, batch):
+	t_ex_embs = embs[:, 0]
+	pos_samples = batch['pos_samples']
+	if pos_samples > 0:
+		pos_embs = embs[:, 1:1+pos_samples]
+	else:
+		pos_embs = None
+	neg_samples = batch['neg_samples']
+	if neg_samples > 0:
+		neg_embs = embs[:, 1+pos_samples:1+pos_samples+neg_samples]
+	else:
+		neg_embs = None
+	return t_ex_embs, pos_embs, neg_embs
+
+
+def triplet_energy(emb_model, e_embs, m_embs, batch):
+	"""Subject and object energies of the positive and negative samples of every example.
+	Args:
+		e_embs: [bsize, 1 + pos_samples + neg_samples, emb_size] tweet, positive and negative entity embeddings.
+		m_embs: [bsize, emb_size] misinfo target relation embeddings.
+		batch: only pos_samples and neg_samples are used.
+	"""
+	# all [bsize, emb_size], [bsize, emb_size], [bsize, pos_samples, emb_size], [bsize, neg_samples, emb_size]
+	t_ex_embs, pos_embs, neg_embs = split_embeddings(e_embs, batch)
+	# [bsize, 1, emb_size]
+	t_ex_embs = t_ex_embs.unsqueeze(dim=-2)
+	m_embs = m_embs.unsqueeze(dim=-2)
+
+	# [bsize]
+	pos_subj_energy = emb_model.energy(t_ex_embs, m_embs, pos_embs)
+	# [bsize]
+	pos_obj_energy = emb_model.energy(pos_embs, m_embs, t_ex_embs)
+	# [bsize, 2]
+	pos_energy = torch.stack([pos_subj_energy, pos_obj_energy], dim=-1)
+	# [bsize]
+	neg_subj_energy = emb_model.energy(t_ex_embs, m_embs, neg_embs)
+	# [bsize]
+	neg_obj_energy = emb_model.energy(neg_embs, m_embs, t_ex_embs)
+	# [bsize, 2]
+	neg_energy = torch.stack([neg_subj_energy, neg_obj_energy], dim=-1)
+
+	return pos_energy, neg_energy
+
+
+def triplet_loss(emb_model, pos_energy, neg_energy, subj_obj_mask):
+	# first randomly pick between subject and object losses
+	# [bsize]
+	pos_energy = (pos_energy * subj_obj_mask).sum(dim=-1)
+	# [bsize]
+	neg_energy = (neg_energy * subj_obj_mask).sum(dim=-1)
+
+	loss, accuracy = emb_model.loss(pos_energy, neg_energy)
+
+	loss = loss.mean()
+	return loss, accuracy
+
+
+class RelEncoder(nn.Module):
+	# bert and embedding head of one e_type as a single module for export
+	def __init__(self, bert, emb_model, e_type):
+		super().__init__()
+		self.bert = bert
+		self.emb_model = emb_model
+		self.e_type = e_type
+
+	def forward(self, input_ids, attention_mask, token_type_ids):
+		contextualized_embeddings = self.bert(
+			input_ids,
+			attention_mask=attention_mask,
+			token_type_ids=token_type_ids
+		)[0]
+		return self.emb_model(contextualized_embeddings[:, 0], self.e_type)
+
+
+def save_embeddings(path, entities, relations, m_examples, t_labels):
+	cache_dir = os.path.dirname(path)
+	if cache_dir and not os.path.exists(cache_dir):
+		os.makedirs(cache_dir)
+	e_ids = list(entities.keys())
+	m_ids = list(relations.keys())
+	# written to a temporary file first so an interrupted run never leaves a partial cache behind
+	tmp_path = path + '.tmp'
+	torch.save(
+		{
+			'e_ids': e_ids,
+			'e_embs': torch.stack([entities[e_id] for e_id in e_ids], dim=0).cpu(),
+			'm_ids': m_ids,
+			'm_embs': torch.stack([relations[m_id] for m_id in m_ids], dim=0).cpu(),
+			'm_examples': m_examples,
+			't_labels': t_labels,
+		},
+		tmp_path
+	)
+	os.replace(tmp_path, path)
+
+
+def load_embeddings(path):
+	"""Loads embeddings saved by save_embeddings in the format of _extract_embeddings.
+	Returns:
+		entities, relations, m_examples, t_labels
+	"""
+	cache = torch.load(path, map_location='cpu')
+	entities = {e_id: e_emb for e_id, e_emb in zip(cache['e_ids'], cache['e_embs'])}
+	relations = {m_id: m_emb for m_id, m_emb in zip(cache['m_ids'], cache['m_embs'])}
+	return entities, relations, cache['m_examples'], cache['t_labels']
+
+
 def get_device_id():
 	try:
 		device_id = dist.get_rank()
@@ -487,6 +667,17 @@ def get_device_id():
 	return device_id
 
 
+def get_num_devices():
+	try:
+		num_devices = dist.get_world_size()
+	except AssertionError:
+		if 'XRT_SHARD_WORLD_SIZE' in os.environ:
+			num_devices = int(os.environ['XRT_SHARD_WORLD_SIZE'])
+		else:
+			num_devices = 1
+	return num_devices
+
+
 class LstmModel(nn.Module):
 	def __init__(self, config, num_layers=1):
 		super().__init__()
@@ -0,0 +1,93 @@
+import logging
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+from torch.utils.data import DataLoader
+
+import metric_utils
+from data_utils import TokenRowDataset, MisinfoPredictBatchCollator, get_batch_args
+
+
+def encode_rows(model, dataset, collator, batch_size):
+	# [num_rows, emb_size] embeddings in row order
+	data_loader = DataLoader(dataset, collate_fn=collator, **get_batch_args(dataset, batch_size))
+	embs = []
+	with torch.no_grad():
+		for batch in data_loader:
+			batch = {k: v.to(model.device) if torch.is_tensor(v) else v for k, v in batch.items()}
+			embs.append(model.encode(batch))
+	return torch.cat(embs, dim=0)
+
+
+def hard_negative_pools(emb_model, t_embs, m_embs, pos_examples, pool_size):
+	"""Nearest non-positive tweets of every misinfo target under the centroid eval decision rule.
+	Args:
+		t_embs: [num_tweets, emb_size] tweet embeddings in MisinfoDataset row order.
+		m_embs: [num_misinfo, emb_size] misinfo target embeddings.
+		pos_examples: positive tweet rows of every misinfo target.
+	Returns:
+		list: int32 array of up to pool_size tweet rows for every target, lowest energy first.
+		Targets without positive examples have no centroid and get an empty pool.
+	"""
+	num_tweets = t_embs.shape[0]
+	m_has_pos = [len(m_pos) > 0 for m_pos in pos_examples]
+	m_centroids = torch.stack(
+		[
+			t_embs[torch.from_numpy(m_pos.astype(np.int64)).to(t_embs.device)].mean(dim=0)
+			if has_pos else torch.zeros_like(t_embs[0])
+			for m_pos, has_pos in zip(pos_examples, m_has_pos)
+		],
+		dim=0
+	)
+	# [num_tweets, num_misinfo]
+	energies = metric_utils.pairwise_energy(emb_model, t_embs, m_embs, m_centroids)
+	for m_idx, m_pos in enumerate(pos_examples):
+		energies[torch.from_numpy(m_pos.astype(np.int64)).to(energies.device), m_idx] = float('inf')
+	pool_size = min(pool_size, num_tweets)
+	# [pool_size, num_misinfo]
+	pool_energies, pool_rows = torch.topk(energies, k=pool_size, dim=0, largest=False)
+	pool_energies = pool_energies.cpu()
+	pool_rows = pool_rows.cpu()
+	pools = []
+	for m_idx, has_pos in enumerate(m_has_pos):
+		if not has_pos:
+			pools.append(np.zeros(0, dtype=np.int32))
+			continue
+		# positives are at inf, so fewer than pool_size negatives leave them at the end
+		is_neg = torch.isfinite(pool_energies[:, m_idx])
+		pools.append(pool_rows[:, m_idx][is_neg].numpy().astype(np.int32))
+	return pools
+
+
+class HardNegativeMiner(pl.Callback):
+	"""Refreshes the hard negative pools of a training MisinfoDataset from the model being trained.
+	Every refresh_epochs epochs all training tweets and targets are encoded and every target keeps its
+	pool_size nearest non-positive tweets. Pools are set at the end of an epoch, before the DataLoader
+	workers of the next epoch copy the dataset.
+	"""
+	def __init__(self, dataset, batch_size, max_seq_len, pool_size=100, refresh_epochs=1):
+		super().__init__()
+		self.dataset = dataset
+		self.batch_size = batch_size
+		self.collator = MisinfoPredictBatchCollator(max_seq_len)
+		self.pool_size = pool_size
+		self.refresh_epochs = refresh_epochs
+		self.t_dataset = TokenRowDataset(dataset.t_tokens, dataset.t_ids, 'entity')
+		self.m_dataset = TokenRowDataset(dataset.m_tokens, dataset.m_ids, 'rel')
+
+	def refresh(self, model):
+		was_training = model.training
+		model.eval()
+		t_embs = encode_rows(model, self.t_dataset, self.collator, self.batch_size)
+		m_embs = encode_rows(model, self.m_dataset, self.collator, self.batch_size)
+		with torch.no_grad():
+			pools = hard_negative_pools(model.emb_model, t_embs, m_embs, self.dataset.pos_examples, self.pool_size)
+		self.dataset.set_hard_negatives(pools)
+		if was_training:
+			model.train()
+		logging.info(f'Refreshed hard negatives: {sum(len(pool) for pool in pools)} over {len(pools)} targets')
+
+	def on_train_epoch_end(self, trainer, pl_module, *args):
+		if (trainer.current_epoch + 1) % self.refresh_epochs == 0:
+			self.refresh(pl_module)
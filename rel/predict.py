@@ -12,6 +12,7 @@ from pytorch_lightning import loggers as pl_loggers
 
 from model_utils import *
 from data_utils import *
+from inference_utils import INFERENCE_MODES, prepare_inference_model
 
 import torch
 
@@ -34,7 +35,18 @@ if __name__ == '__main__':
 	parser.add_argument('-em', '--emb_model', default='transd')
 	parser.add_argument('-mt', '--model_type', default='bert')
 	parser.add_argument('-mtl', '--model_layers', default=1, type=int)
-
+	parser.add_argument('-tcd', '--token_cache_dir', default=None)
+	# collated batches are copied to page-locked memory by the DataLoader for faster host to GPU transfer
+	parser.add_argument('-pin', '--pin_memory', default=False, action='store_true')
+	# batches tweets of similar token length together to reduce padding
+	parser.add_argument('-bb', '--bucket_batches', default=False, action='store_true')
+	# embeddings are written to output_path as .npy shards of at most predict_shard_size rows per device
+	parser.add_argument('-pdt', '--predict_dtype', default='float32', choices=['float16', 'float32'])
+	parser.add_argument('-pss', '--predict_shard_size', default=65536, type=int)
+
+	# CPU inference: int8 dynamically quantizes the model, onnx modes run the graphs exported by rel/export.py
+	parser.add_argument('-im', '--inference_mode', default='fp32', choices=INFERENCE_MODES)
+	parser.add_argument('-od', '--onnx_dir', default=None)
 	args = parser.parse_args()
 
 	pl.seed_everything(args.seed)
@@ -44,16 +56,24 @@ if __name__ == '__main__':
 		os.makedirs(save_directory)
 
 	checkpoint_path = os.path.join(save_directory, 'pytorch_model.bin')
+	onnx_dir = args.onnx_dir if args.onnx_dir is not None else os.path.join(save_directory, 'onnx')
+	# tokenized split files are cached by content hash, shared between models
+	token_cache_dir = args.token_cache_dir if args.token_cache_dir is not None else os.path.join(args.save_directory, 'token_cache')
 
 	# export TPU_IP_ADDRESS=10.155.6.34
 	# export XRT_TPU_CONFIG="tpu_worker;0;$TPU_IP_ADDRESS:8470"
 	gpus = [int(x) for x in args.gpus.split(',')]
-	is_distributed = len(gpus) > 1
+	if args.inference_mode != 'fp32':
+		# quantized and onnx models only run on CPU
+		gpus = None
+	is_distributed = gpus is not None and len(gpus) > 1
 	precision = 16 if args.use_tpus else 32
 	# precision = 32
 	tpu_cores = 8
 	num_workers = 4
 	deterministic = True
+	# sequences are always padded to max_seq_len on TPUs, so bucketing would not reduce padding
+	bucket_batches = args.bucket_batches and not args.use_tpus
 
 	# Also add the stream handler so that it logs on STD out as well
 	# Ref: https://stackoverflow.com/a/46098711/4535284
@@ -73,6 +93,8 @@ if __name__ == '__main__':
 	tokenizer = BertTokenizerFast.from_pretrained(args.pre_model_name)
 	logging.info(f'Loading val dataset: {args.val_path}')
 	val_data = read_jsonl(args.val_path)
+	logging.info(f'Loading tokens: {token_cache_dir}')
+	val_tokens = load_document_tokens(args.val_path, val_data, tokenizer, token_cache_dir)
 
 	logging.info(f'Loading misinfo: {args.misinfo_path}')
 	with open(args.misinfo_path, 'r') as f:
@@ -84,7 +106,8 @@ if __name__ == '__main__':
 	val_entity_dataset = MisinfoEntityDataset(
 		documents=val_data,
 		tokenizer=tokenizer,
-		misinfo=misinfo
+		misinfo=misinfo,
+		tokens=val_tokens
 	)
 	val_rel_dataset = MisinfoRelDataset(
 		misinfo=misinfo,
@@ -94,8 +117,14 @@ if __name__ == '__main__':
 	val_entity_data_loader = DataLoader(
 		val_entity_dataset,
 		num_workers=num_workers,
-		batch_size=args.eval_batch_size,
-		shuffle=False,
+		pin_memory=args.pin_memory,
+		**get_batch_args(
+			val_entity_dataset,
+			args.eval_batch_size,
+			shuffle=False,
+			bucket_batches=bucket_batches,
+			seed=args.seed
+		),
 		collate_fn=MisinfoPredictBatchCollator(
 			args.max_seq_len,
 			force_max_seq_len=args.use_tpus,
@@ -104,8 +133,14 @@ if __name__ == '__main__':
 	val_rel_data_loader = DataLoader(
 		val_rel_dataset,
 		num_workers=num_workers,
-		batch_size=args.eval_batch_size,
-		shuffle=False,
+		pin_memory=args.pin_memory,
+		**get_batch_args(
+			val_rel_dataset,
+			args.eval_batch_size,
+			shuffle=False,
+			bucket_batches=bucket_batches,
+			seed=args.seed
+		),
 		collate_fn=MisinfoPredictBatchCollator(
 			args.max_seq_len,
 			force_max_seq_len=args.use_tpus,
@@ -129,12 +164,15 @@ if __name__ == '__main__':
 		gamma=0.0,
 		load_pretrained=True,
 		predict_mode=True,
-		predict_path=args.output_path
+		predict_path=args.output_path,
+		predict_dtype=args.predict_dtype,
+		predict_shard_size=args.predict_shard_size
 	)
 
 	# load checkpoint
 	logging.warning(f'Loading weights from trained checkpoint: {checkpoint_path}...')
-	model.load_state_dict(torch.load(checkpoint_path))
+	model.load_state_dict(torch.load(checkpoint_path, map_location='cpu'))
+	model = prepare_inference_model(model, args.inference_mode, onnx_dir)
 
 	logger = pl_loggers.TensorBoardLogger(
 		save_dir=save_directory,
@@ -154,7 +192,7 @@ if __name__ == '__main__':
 			checkpoint_callback=False,
 		)
 	else:
-		if len(gpus) > 1:
+		if gpus is not None and len(gpus) > 1:
 			backend = 'ddp' if is_distributed else 'dp'
 		else:
 			backend = None
@@ -165,6 +203,7 @@ if __name__ == '__main__':
 			max_epochs=0,
 			precision=precision,
 			distributed_backend=backend,
+			replace_sampler_ddp=not bucket_batches,
 			deterministic=deterministic,
 			checkpoint_callback=False,
 		)
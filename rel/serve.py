@@ -0,0 +1,143 @@
+import argparse
+import logging
+
+# pytorch_lightning can cause issues if
+# torch or other torch libraries are imported first
+# noinspection PyUnresolvedReferences
+import pytorch_lightning as pl
+from transformers import BertTokenizerFast
+
+from model_utils import *
+from data_utils import *
+from inference_utils import INFERENCE_MODES, prepare_inference_model
+from serve_utils import encode_dataset, TweetScorer, DynamicBatcher, serve_http, serve_stdin
+
+import torch
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-vp', '--val_path', required=True)
+	parser.add_argument('-mip', '--misinfo_path', required=True)
+	parser.add_argument('-pm', '--pre_model_name', default='nboost/pt-biobert-base-msmarco')
+	parser.add_argument('-mn', '--model_name', default='pt-biobert-base-msmarco')
+	parser.add_argument('-sd', '--save_directory', default='models')
+	parser.add_argument('-ebs', '--eval_batch_size', default=4, type=int)
+	parser.add_argument('-ml', '--max_seq_len', default=96, type=int)
+	parser.add_argument('-se', '--seed', default=0, type=int)
+	parser.add_argument('-gpu', '--gpu', default=None, type=int)
+	parser.add_argument('-es', '--emb_size', default=100, type=int)
+	parser.add_argument('-eln', '--emb_loss_norm', default=2, type=int)
+	parser.add_argument('-em', '--emb_model', default='transd')
+	parser.add_argument('-mt', '--model_type', default='bert')
+	parser.add_argument('-mtl', '--model_layers', default=1, type=int)
+	parser.add_argument('-tcd', '--token_cache_dir', default=None)
+	# dev embeddings are shared with rel/evaluate.py through its embedding cache
+	parser.add_argument('-ecd', '--embedding_cache_dir', default=None)
+	parser.add_argument('-i', '--interface', default='http', choices=['http', 'stdin'])
+	parser.add_argument('-ho', '--host', default='127.0.0.1')
+	parser.add_argument('-po', '--port', default=8000, type=int)
+	# tweets arriving within max_wait_ms of each other are scored as one micro-batch
+	parser.add_argument('-mbs', '--max_batch_size', default=32, type=int)
+	parser.add_argument('-mw', '--max_wait_ms', default=5.0, type=float)
+
+	# CPU inference: int8 dynamically quantizes the model, onnx modes run the graphs exported by rel/export.py
+	parser.add_argument('-im', '--inference_mode', default='fp32', choices=INFERENCE_MODES)
+	parser.add_argument('-od', '--onnx_dir', default=None)
+	args = parser.parse_args()
+
+	pl.seed_everything(args.seed)
+
+	save_directory = os.path.join(args.save_directory, args.model_name)
+	checkpoint_path = os.path.join(save_directory, 'pytorch_model.bin')
+	token_cache_dir = args.token_cache_dir if args.token_cache_dir is not None else os.path.join(args.save_directory, 'token_cache')
+	embedding_cache_dir = args.embedding_cache_dir if args.embedding_cache_dir is not None else os.path.join(save_directory, 'embedding_cache')
+	onnx_dir = args.onnx_dir if args.onnx_dir is not None else os.path.join(save_directory, 'onnx')
+	# quantized and onnx models only run on CPU
+	device = 'cpu' if args.gpu is None or args.inference_mode != 'fp32' else f'cuda:{args.gpu}'
+
+	# results go to stdout in stdin mode, so logs only go to stderr
+	logging.basicConfig(
+		level=logging.INFO,
+		format="%(asctime)s [%(levelname)s] %(message)s",
+	)
+
+	logging.info(f'Loading tokenizer: {args.pre_model_name}')
+	tokenizer = BertTokenizerFast.from_pretrained(args.pre_model_name)
+
+	logging.info('Loading model...')
+	model = CovidTwitterMisinfoModel(
+		pre_model_name=args.pre_model_name,
+		learning_rate=0,
+		lr_warmup=0.0,
+		updates_total=0,
+		weight_decay=0,
+		emb_model=args.emb_model,
+		emb_size=args.emb_size,
+		model_type=args.model_type,
+		model_layers=args.model_layers,
+		emb_loss_norm=args.emb_loss_norm,
+		gamma=0.0,
+		load_pretrained=True,
+	)
+	logging.warning(f'Loading weights from trained checkpoint: {checkpoint_path}...')
+	model.load_state_dict(torch.load(checkpoint_path, map_location='cpu'))
+	model = prepare_inference_model(model, args.inference_mode, onnx_dir)
+	model.to(device)
+	model.eval()
+
+	checkpoint_hash = file_hash(checkpoint_path)
+	if args.inference_mode != 'fp32':
+		checkpoint_hash = f'{checkpoint_hash}-{args.inference_mode}'
+	val_cache_path = embedding_cache_path(
+		embedding_cache_dir,
+		checkpoint_hash,
+		args.val_path,
+		args.misinfo_path,
+		args.max_seq_len
+	)
+	if os.path.exists(val_cache_path):
+		logging.info(f'Loading cached val embeddings: {val_cache_path}')
+		dev_embeddings = load_embeddings(val_cache_path)
+	else:
+		logging.info(f'Encoding val dataset: {args.val_path}')
+		val_data = read_jsonl(args.val_path)
+		val_tokens = load_document_tokens(args.val_path, val_data, tokenizer, token_cache_dir)
+		with open(args.misinfo_path, 'r') as f:
+			misinfo = json.load(f)
+		val_entity_dataset = MisinfoEntityDataset(
+			documents=val_data,
+			tokenizer=tokenizer,
+			misinfo=misinfo,
+			tokens=val_tokens
+		)
+		val_rel_dataset = MisinfoRelDataset(
+			misinfo=misinfo,
+			tokenizer=tokenizer,
+			m_examples=val_entity_dataset.m_examples
+		)
+		collator = MisinfoPredictBatchCollator(args.max_seq_len)
+		dev_embeddings = model._extract_embeddings(
+			encode_dataset(model, val_entity_dataset, collator, args.eval_batch_size, device),
+			encode_dataset(model, val_rel_dataset, collator, args.eval_batch_size, device),
+			'val'
+		)
+		save_embeddings(val_cache_path, *dev_embeddings)
+
+	logging.info('Computing misinfo thresholds...')
+	scorer = TweetScorer.from_dev_embeddings(model, tokenizer, args.max_seq_len, dev_embeddings, device)
+	batcher = DynamicBatcher(
+		scorer.score,
+		parse_func=scorer.parse_document,
+		max_batch_size=args.max_batch_size,
+		max_wait=args.max_wait_ms / 1000.0
+	)
+	try:
+		if args.interface == 'http':
+			logging.info(f'Serving on http://{args.host}:{args.port}/score')
+			serve_http(batcher, args.host, args.port)
+		else:
+			logging.info('Scoring tweets from stdin')
+			serve_stdin(batcher)
+	finally:
+		batcher.close()
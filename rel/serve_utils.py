@@ -0,0 +1,254 @@
+import sys
+import json
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+from torch.utils.data import DataLoader
+
+import metric_utils
+from data_utils import get_tweet_text, MisinfoPredictBatchCollator
+
+
+def encode_dataset(model, dataset, collator, batch_size, device):
+	# same outputs as the model's test steps, without a Trainer
+	outputs = []
+	data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, collate_fn=collator)
+	with torch.no_grad():
+		for batch in data_loader:
+			batch = {k: v.to(device) if torch.is_tensor(v) else v for k, v in batch.items()}
+			outputs.append(model._predict_step(batch, 'val'))
+	return outputs
+
+
+class TweetScorer:
+	"""Classifies new tweets against every misinfo target with the centroid eval mode decision rule.
+	Relation embeddings, dev centroids and thresholds are computed once, scoring only encodes the tweets.
+	"""
+	def __init__(self, model, tokenizer, max_seq_len, m_ids, m_embs, m_centroids, m_thresholds, m_has_pos, device='cpu'):
+		self.model = model.to(device)
+		self.model.eval()
+		self.tokenizer = tokenizer
+		self.collator = MisinfoPredictBatchCollator(max_seq_len)
+		self.device = device
+		self.m_ids = m_ids
+		# [num_misinfo, emb_size]
+		self.m_embs = m_embs.to(device)
+		self.m_centroids = m_centroids.to(device)
+		# [num_misinfo]
+		self.m_thresholds = torch.tensor(
+			[m_thresholds[m_id] for m_id in m_ids],
+			dtype=self.m_embs.dtype,
+			device=device
+		)
+		self.m_has_pos = m_has_pos.to(device)
+
+	@classmethod
+	def from_dev_embeddings(cls, model, tokenizer, max_seq_len, dev_embeddings, device='cpu'):
+		entities, relations, m_examples, t_labels = dev_embeddings
+		m_thresholds = metric_utils.find_m_thresholds(
+			model.emb_model,
+			entities,
+			relations,
+			m_examples,
+			entities,
+			t_labels
+		)
+		m_ids, m_embs, m_centroids, m_has_pos = metric_utils.target_centroids(relations, m_examples, entities)
+		return cls(model, tokenizer, max_seq_len, m_ids, m_embs, m_centroids, m_thresholds, m_has_pos, device)
+
+	@staticmethod
+	def parse_document(document):
+		"""Validates a submitted tweet, so a malformed one is rejected alone instead of failing its micro-batch.
+		Returns:
+			dict: {'id', 'text'} with the cleaned tweet text.
+		Raises:
+			ValueError: if the document is not an object with an id and a string full_text.
+		"""
+		if not isinstance(document, dict):
+			raise ValueError('Tweet must be a json object')
+		if 'id' not in document:
+			raise ValueError('Tweet is missing id')
+		if not isinstance(document.get('full_text'), str):
+			raise ValueError(f'Tweet {document["id"]} is missing a string full_text')
+		return {'id': document['id'], 'text': get_tweet_text(document)}
+
+	def score(self, documents):
+		"""Scores a micro-batch of tweets parsed by parse_document.
+		Returns:
+			list: {'id', 'predictions': [m_id], 'scores': {m_id: score}} for every document, where a tweet
+			is predicted for m_id if its score, the negative energy, is above the m_id threshold.
+		"""
+		if len(documents) == 0:
+			return []
+		sequences = self.tokenizer([doc['text'] for doc in documents])['input_ids']
+		batch = self.collator(
+			[
+				{'id': doc['id'], 'e_type': 'entity', 'token_data': {'input_ids': seq}}
+				for doc, seq in zip(documents, sequences)
+			]
+		)
+		batch = {k: v.to(self.device) if torch.is_tensor(v) else v for k, v in batch.items()}
+		with torch.no_grad():
+			t_embs = self.model.encode(batch)
+			# [num_tweets, num_misinfo]
+			scores = -metric_utils.pairwise_energy(self.model.emb_model, t_embs, self.m_embs, self.m_centroids)
+			preds = scores.gt(self.m_thresholds.unsqueeze(dim=0)) & self.m_has_pos.unsqueeze(dim=0)
+		scores = scores.cpu().tolist()
+		preds = preds.cpu().tolist()
+		results = []
+		for doc, t_scores, t_preds in zip(documents, scores, preds):
+			results.append({
+				'id': doc['id'],
+				'predictions': [m_id for m_id, m_pred in zip(self.m_ids, t_preds) if m_pred],
+				'scores': {m_id: m_score for m_id, m_score in zip(self.m_ids, t_scores)},
+			})
+		return results
+
+
+class DynamicBatcher:
+	"""Collects concurrently submitted tweets into micro-batches for a single scoring thread.
+	A batch is scored once max_batch_size tweets are waiting or max_wait seconds after its first tweet,
+	so a lone request waits at most max_wait while bursts are scored together.
+	Documents are parsed with parse_func when submitted, so only valid documents reach a batch.
+	"""
+	def __init__(self, score_func, parse_func=None, max_batch_size=32, max_wait=0.005):
+		self.score_func = score_func
+		self.parse_func = parse_func
+		self.max_batch_size = max_batch_size
+		self.max_wait = max_wait
+		self.requests = queue.Queue()
+		self.thread = threading.Thread(target=self._run, daemon=True)
+		self.thread.start()
+
+	def submit(self, document):
+		# raises ValueError for a document parse_func rejects, nothing is queued then
+		return self.submit_all([document])[0]
+
+	def submit_all(self, documents):
+		# all documents are parsed before any is queued, so a rejected request scores nothing
+		if self.parse_func is not None:
+			documents = [self.parse_func(document) for document in documents]
+		futures = []
+		for document in documents:
+			future = Future()
+			self.requests.put((document, future))
+			futures.append(future)
+		return futures
+
+	def _next_batch(self):
+		request = self.requests.get()
+		if request is None:
+			return None
+		batch = [request]
+		deadline = time.perf_counter() + self.max_wait
+		while len(batch) < self.max_batch_size:
+			remaining = deadline - time.perf_counter()
+			if remaining <= 0:
+				break
+			try:
+				request = self.requests.get(timeout=remaining)
+			except queue.Empty:
+				break
+			if request is None:
+				# finish the current batch, then stop
+				self.requests.put(None)
+				break
+			batch.append(request)
+		return batch
+
+	def _run(self):
+		while True:
+			batch = self._next_batch()
+			if batch is None:
+				return
+			documents = [document for document, _ in batch]
+			try:
+				results = self.score_func(documents)
+			except Exception as e:
+				for _, future in batch:
+					future.set_exception(e)
+				continue
+			for (_, future), result in zip(batch, results):
+				future.set_result(result)
+
+	def close(self):
+		self.requests.put(None)
+		self.thread.join()
+
+
+def serve_http(batcher, host='127.0.0.1', port=8000):
+	"""POST /score with a tweet {"id", "full_text"} or a list of tweets, responds with their results."""
+	class ScoreHandler(BaseHTTPRequestHandler):
+		def do_POST(self):
+			if self.path != '/score':
+				self.send_error(404)
+				return
+			try:
+				request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+			except ValueError:
+				self.send_error(400, 'Invalid json')
+				return
+			documents = request if isinstance(request, list) else [request]
+			try:
+				futures = batcher.submit_all(documents)
+			except ValueError as e:
+				self.send_error(400, str(e))
+				return
+			try:
+				results = [future.result() for future in futures]
+			except Exception as e:
+				self.send_error(500, str(e))
+				return
+			body = json.dumps(results if isinstance(request, list) else results[0]).encode('utf-8')
+			self.send_response(200)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, format, *args):
+			pass
+
+	server = ThreadingHTTPServer((host, port), ScoreHandler)
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+
+
+def serve_stdin(batcher, input_file=sys.stdin, output_file=sys.stdout):
+	"""Reads one tweet json per line and writes one result json per line, in input order."""
+	pending = queue.Queue()
+
+	def write_results():
+		while True:
+			future = pending.get()
+			if future is None:
+				return
+			try:
+				result = future.result()
+			except Exception as e:
+				result = {'error': str(e)}
+			output_file.write(json.dumps(result) + '\n')
+			output_file.flush()
+
+	writer = threading.Thread(target=write_results, daemon=True)
+	writer.start()
+	# lines are submitted as they are read, so piped input is scored in full micro-batches
+	for line in input_file:
+		line = line.strip()
+		if not line:
+			continue
+		try:
+			future = batcher.submit(json.loads(line))
+		except ValueError as e:
+			# invalid json or tweet, answered with an error line in its place
+			future = Future()
+			future.set_exception(e)
+		pending.put(future)
+	pending.put(None)
+	writer.join()
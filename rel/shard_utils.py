@@ -0,0 +1,221 @@
+import os
+import json
+from glob import glob
+
+import numpy as np
+
+
+def shard_name(e_type, device_id, shard_idx):
+	return f'{e_type}-{device_id}-{shard_idx:05d}'
+
+
+def index_name(e_type, device_id):
+	return f'{e_type}-{device_id}-index.json'
+
+
+def shard_device_id(index_path):
+	# device id of an index file name, '{e_type}-{device_id}-index.json'
+	return int(os.path.basename(index_path).split('-')[-2])
+
+
+def clear_embedding_shards(path, e_type, device_id):
+	# removes the index, shards and ids files an earlier run wrote for e_type on device_id
+	index_path = os.path.join(path, index_name(e_type, device_id))
+	if os.path.exists(index_path):
+		os.remove(index_path)
+	for file_path in glob(os.path.join(path, f'{e_type}-{device_id}-*')):
+		if file_path.endswith('.npy') or file_path.endswith('.ids'):
+			os.remove(file_path)
+
+
+class EmbeddingShardWriter:
+	"""Writes embeddings incrementally as fixed size .npy shards with a text file of ids per shard.
+	At most shard_size rows are held in memory, the index written on close lists the complete shards.
+	Files of an earlier run for e_type on this device are removed on open. The first device also removes
+	those of devices at or past num_devices, so a run on fewer devices never picks up leftover shards.
+	"""
+	def __init__(self, path, e_type, device_id=0, dtype='float32', shard_size=65536, num_devices=1):
+		self.path = path
+		self.e_type = e_type
+		self.device_id = device_id
+		self.num_devices = num_devices
+		self.dtype = np.dtype(dtype)
+		self.shard_size = shard_size
+		self.emb_size = None
+		self.shards = []
+		self.buffer_ids = []
+		self.buffer_embs = []
+		self.buffer_rows = 0
+		if not os.path.exists(self.path):
+			os.makedirs(self.path, exist_ok=True)
+		clear_embedding_shards(self.path, self.e_type, self.device_id)
+		if self.device_id == 0:
+			for index_path in glob(os.path.join(self.path, index_name(self.e_type, '*'))):
+				stale_device_id = shard_device_id(index_path)
+				if stale_device_id >= self.num_devices:
+					clear_embedding_shards(self.path, self.e_type, stale_device_id)
+
+	def write(self, ids, embs):
+		# [num_ids, emb_size]
+		embs = np.asarray(embs, dtype=self.dtype)
+		if len(ids) != embs.shape[0]:
+			raise ValueError(f'Got {len(ids)} ids for {embs.shape[0]} embeddings')
+		if self.emb_size is None:
+			self.emb_size = embs.shape[1]
+		self.buffer_ids.extend([str(e_id) for e_id in ids])
+		self.buffer_embs.append(embs)
+		self.buffer_rows += embs.shape[0]
+		while self.buffer_rows >= self.shard_size:
+			self._flush(self.shard_size)
+
+	def _flush(self, num_rows):
+		embs = np.concatenate(self.buffer_embs, axis=0)
+		name = shard_name(self.e_type, self.device_id, len(self.shards))
+		np.save(os.path.join(self.path, f'{name}.npy'), embs[:num_rows])
+		with open(os.path.join(self.path, f'{name}.ids'), 'w') as f:
+			for e_id in self.buffer_ids[:num_rows]:
+				f.write(e_id + '\n')
+		self.shards.append({'name': name, 'rows': num_rows})
+		self.buffer_ids = self.buffer_ids[num_rows:]
+		self.buffer_embs = [embs[num_rows:]]
+		self.buffer_rows -= num_rows
+
+	def close(self):
+		if self.buffer_rows > 0:
+			self._flush(self.buffer_rows)
+		index = {
+			'e_type': self.e_type,
+			'device_id': self.device_id,
+			'num_devices': self.num_devices,
+			'dtype': self.dtype.name,
+			'emb_size': self.emb_size,
+			'shards': self.shards,
+		}
+		# the index is written last, so readers never see a partially written set of shards
+		index_path = os.path.join(self.path, index_name(self.e_type, self.device_id))
+		tmp_path = index_path + '.tmp'
+		with open(tmp_path, 'w') as f:
+			json.dump(index, f, indent=2)
+		os.replace(tmp_path, index_path)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+
+class EmbeddingShards:
+	"""Memory-mapped view over the embedding shards of one e_type written by every device.
+	Ids duplicated across devices, e.g. by distributed sampler padding, keep their first row.
+	Indexes of devices at or past the num_devices of the run are leftovers and are skipped.
+	"""
+	def __init__(self, path, e_type):
+		self.path = path
+		self.e_type = e_type
+		index_paths = sorted(glob(os.path.join(path, index_name(e_type, '*'))))
+		if len(index_paths) == 0:
+			raise FileNotFoundError(f'No {e_type} embedding shards found in {path}')
+		indices = []
+		for index_path in index_paths:
+			with open(index_path, 'r') as f:
+				indices.append(json.load(f))
+		# indexes written before num_devices was recorded are all read
+		num_devices = {index.get('num_devices') for index in indices}
+		if len(num_devices) > 1:
+			raise ValueError(
+				f'{e_type} embedding shards in {path} come from runs on {sorted(num_devices, key=str)} devices, '
+				f'remove the leftover shards'
+			)
+		num_devices = num_devices.pop()
+		if num_devices is not None:
+			indices = [index for index in indices if index['device_id'] < num_devices]
+		self.shards = []
+		self.ids = []
+		# id -> (shard_idx, row)
+		self.locations = {}
+		# rows of every shard which hold the first occurrence of their id
+		self.shard_rows = []
+		# devices that predicted nothing write an index without shards or emb_size
+		self.emb_size = None
+		self.dtype = None
+		for index in indices:
+			if self.emb_size is None and index.get('emb_size') is not None:
+				self.emb_size = index['emb_size']
+				self.dtype = np.dtype(index['dtype'])
+			for shard in index['shards']:
+				shard_idx = len(self.shards)
+				self.shards.append(np.load(os.path.join(path, f'{shard["name"]}.npy'), mmap_mode='r'))
+				with open(os.path.join(path, f'{shard["name"]}.ids'), 'r') as f:
+					shard_ids = [line.rstrip('\n') for line in f]
+				rows = []
+				for row, e_id in enumerate(shard_ids):
+					if e_id not in self.locations:
+						self.locations[e_id] = (shard_idx, row)
+						self.ids.append(e_id)
+						rows.append(row)
+				self.shard_rows.append(np.array(rows, dtype=np.int64))
+		if len(self.shards) > 0:
+			self.emb_size = self.shards[0].shape[1]
+			self.dtype = self.shards[0].dtype
+		if self.emb_size is None:
+			self.emb_size = 0
+		if self.dtype is None:
+			self.dtype = np.dtype('float32')
+
+	def __len__(self):
+		return len(self.ids)
+
+	def __contains__(self, e_id):
+		return e_id in self.locations
+
+	def get_many(self, ids, dtype=np.float32):
+		"""Gathers the embeddings of ids, reading only their rows from the memory-mapped shards.
+		Returns:
+			np.ndarray: [len(ids), emb_size] embeddings in the order of ids.
+		"""
+		embs = np.zeros([len(ids), self.emb_size], dtype=dtype)
+		shard_requests = {}
+		for i, e_id in enumerate(ids):
+			shard_idx, row = self.locations[e_id]
+			shard_requests.setdefault(shard_idx, ([], []))
+			shard_requests[shard_idx][0].append(i)
+			shard_requests[shard_idx][1].append(row)
+		for shard_idx, (idxs, rows) in shard_requests.items():
+			embs[idxs] = self.shards[shard_idx][rows]
+		return embs
+
+	def iter_chunks(self, chunk_size=65536, dtype=np.float32):
+		"""Yields (ids, [num_ids, emb_size] embeddings) chunks in shard order, each id once."""
+		id_offset = 0
+		for shard, rows in zip(self.shards, self.shard_rows):
+			for start in range(0, len(rows), chunk_size):
+				c_rows = rows[start:start + chunk_size]
+				c_ids = self.ids[id_offset:id_offset + len(c_rows)]
+				id_offset += len(c_rows)
+				yield c_ids, np.asarray(shard[c_rows], dtype=dtype)
+
+	def to_array(self, dtype=np.float32):
+		# [num_ids, emb_size], reads every shard into memory
+		embs = np.zeros([len(self), self.emb_size], dtype=dtype)
+		offset = 0
+		for _, c_embs in self.iter_chunks(dtype=dtype):
+			embs[offset:offset + c_embs.shape[0]] = c_embs
+			offset += c_embs.shape[0]
+		return embs
+
+
+def merge_embedding_shards(input_path, output_path, e_type, dtype=None, shard_size=65536):
+	"""Rewrites the shards of every device into one deduplicated set of shards in output_path.
+	Returns:
+		int: Number of unique ids written.
+	"""
+	if os.path.abspath(input_path) == os.path.abspath(output_path):
+		raise ValueError(f'Cannot merge shards of {input_path} in place')
+	shards = EmbeddingShards(input_path, e_type)
+	if dtype is None:
+		dtype = shards.dtype
+	with EmbeddingShardWriter(output_path, e_type, device_id=0, dtype=dtype, shard_size=shard_size) as writer:
+		for c_ids, c_embs in shards.iter_chunks(chunk_size=shard_size, dtype=dtype):
+			writer.write(c_ids, c_embs)
+	return len(shards)
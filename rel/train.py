@@ -12,6 +12,9 @@ from pytorch_lightning import loggers as pl_loggers
 
 from model_utils import *
 from data_utils import *
+from negative_utils import HardNegativeMiner
+
+from common.precision_utils import PRECISIONS, trainer_precision
 
 import torch
 
@@ -44,13 +47,46 @@ if __name__ == '__main__':
 	parser.add_argument('-wd', '--weight_decay', default=0.0, type=float)
 	parser.add_argument('-gcv', '--gradient_clip_val', default=1.0, type=float)
 	parser.add_argument('-th', '--threshold', default=None, type=float)
+	parser.add_argument('-tcd', '--token_cache_dir', default=None)
+	# collated batches are copied to page-locked memory by the DataLoader for faster host to GPU transfer
+	parser.add_argument('-pin', '--pin_memory', default=False, action='store_true')
+	# batches tweets of similar token length together to reduce padding, mostly on the val entity and rel
+	# loaders, triplet batches also pad to their randomly drawn samples
+	parser.add_argument('-bb', '--bucket_batches', default=False, action='store_true')
+	# encode repeated misinfo targets and samples once per batch
+	parser.add_argument('-us', '--unique_sequences', default=False, action='store_true')
+	# other examples in the batch are used as negatives, neg_samples adds sampled hard negatives on top
+	parser.add_argument('-ibn', '--in_batch_negatives', default=False, action='store_true')
+	parser.add_argument('-ns', '--neg_samples', default=1, type=int)
+	# 16: fp16 autocast with gradient scaling on GPUs, bf16: bf16 autocast (torch>=1.10), TPUs always use XLA bf16
+	parser.add_argument('-pr', '--precision', default='32', choices=PRECISIONS)
+	# activation memory: recompute bert layer activations during backward, encode the
+	# bsize * (2 + pos_samples + neg_samples) sequences of a batch in chunks, and accumulate gradients
+	# over several batches for a larger effective batch size
+	parser.add_argument('-gck', '--gradient_checkpointing', default=False, action='store_true')
+	parser.add_argument('-ecs', '--encoder_chunk_size', default=None, type=int)
+	parser.add_argument('-agb', '--accumulate_grad_batches', default=1, type=int)
+	# hard_neg_samples of the neg_samples are drawn from the hard_neg_pool_size nearest non-positive
+	# tweets of each target, re-mined with the model being trained every hard_neg_refresh_epochs epochs
+	parser.add_argument('-hns', '--hard_neg_samples', default=0, type=int)
+	parser.add_argument('-hnp', '--hard_neg_pool_size', default=100, type=int)
+	parser.add_argument('-hnr', '--hard_neg_refresh_epochs', default=1, type=int)
 
 	args = parser.parse_args()
+	if args.neg_samples < 0:
+		parser.error('--neg_samples must be >= 0')
+	if args.neg_samples == 0 and not args.in_batch_negatives:
+		# the triplet loss needs negatives, sampled or from the other examples of the batch
+		parser.error('--neg_samples 0 requires --in_batch_negatives')
+	if args.encoder_chunk_size is not None and args.encoder_chunk_size < 1:
+		parser.error('--encoder_chunk_size must be >= 1')
 
 	pl.seed_everything(args.seed)
 
 	save_directory = os.path.join(args.save_directory, args.model_name)
 	checkpoint_path = os.path.join(save_directory, 'pytorch_model.bin')
+	# tokenized split files are cached by content hash, shared between models
+	token_cache_dir = args.token_cache_dir if args.token_cache_dir is not None else os.path.join(args.save_directory, 'token_cache')
 
 	if not os.path.exists(save_directory):
 		os.makedirs(save_directory)
@@ -59,11 +95,14 @@ if __name__ == '__main__':
 	# export XRT_TPU_CONFIG="tpu_worker;0;$TPU_IP_ADDRESS:8470"
 	gpus = [int(x) for x in args.gpus.split(',')]
 	is_distributed = len(gpus) > 1
-	precision = 16 if args.use_tpus else 32
-	# precision = 32
+	precision = trainer_precision(args.precision, args.use_tpus)
+	# model autocast, XLA handles reduced precision on TPUs
+	model_precision = '32' if args.use_tpus else args.precision
 	tpu_cores = 8
 	num_workers = 4
 	deterministic = True
+	# sequences are always padded to max_seq_len on TPUs, so bucketing would not reduce padding
+	bucket_batches = args.bucket_batches and not args.use_tpus
 
 	# Also add the stream handler so that it logs on STD out as well
 	# Ref: https://stackoverflow.com/a/46098711/4535284
@@ -85,6 +124,9 @@ if __name__ == '__main__':
 	train_data = read_jsonl(args.train_path)
 	logging.info(f'Loading val dataset: {args.val_path}')
 	val_data = read_jsonl(args.val_path)
+	logging.info(f'Loading tokens: {token_cache_dir}')
+	train_tokens = load_document_tokens(args.train_path, train_data, tokenizer, token_cache_dir)
+	val_tokens = load_document_tokens(args.val_path, val_data, tokenizer, token_cache_dir)
 
 	logging.info('Loading misinfo')
 	with open(args.train_misinfo_path, 'r') as f:
@@ -100,18 +142,28 @@ if __name__ == '__main__':
 		tokenizer=tokenizer,
 		misinfo=train_misinfo,
 		pos_samples=1,
-		neg_samples=1,
+		neg_samples=args.neg_samples,
 		shuffle=True,
+		tokens=train_tokens,
+		hard_neg_samples=args.hard_neg_samples,
 	)
 	train_data_loader = DataLoader(
 		train_dataset,
 		num_workers=num_workers,
-		batch_size=args.batch_size,
-		shuffle=True,
-		drop_last=True,
+		pin_memory=args.pin_memory,
+		**get_batch_args(
+			train_dataset,
+			args.batch_size,
+			shuffle=True,
+			drop_last=True,
+			bucket_batches=bucket_batches,
+			seed=args.seed
+		),
 		collate_fn=MisinfoBatchCollator(
 			args.max_seq_len,
 			force_max_seq_len=args.use_tpus,
+			unique_sequences=args.unique_sequences,
+			in_batch_negatives=args.in_batch_negatives,
 		),
 		worker_init_fn=train_dataset.worker_init_fn
 	)
@@ -124,15 +176,23 @@ if __name__ == '__main__':
 		pos_samples=1,
 		neg_samples=1,
 		shuffle=False,
+		tokens=val_tokens,
 	)
 	val_triplet_data_loader = DataLoader(
 		val_triplet_dataset,
 		num_workers=num_workers,
-		batch_size=args.batch_size,
-		shuffle=False,
+		pin_memory=args.pin_memory,
+		**get_batch_args(
+			val_triplet_dataset,
+			args.batch_size,
+			shuffle=False,
+			bucket_batches=bucket_batches,
+			seed=args.seed
+		),
 		collate_fn=MisinfoBatchCollator(
 			args.max_seq_len,
 			force_max_seq_len=args.use_tpus,
+			unique_sequences=args.unique_sequences,
 		),
 		worker_init_fn=val_triplet_dataset.worker_init_fn
 	)
@@ -140,7 +200,8 @@ if __name__ == '__main__':
 	val_entity_dataset = MisinfoEntityDataset(
 		documents=val_data,
 		tokenizer=tokenizer,
-		misinfo=val_misinfo
+		misinfo=val_misinfo,
+		tokens=val_tokens
 	)
 
 	val_rel_dataset = MisinfoRelDataset(
@@ -152,8 +213,14 @@ if __name__ == '__main__':
 	val_entity_data_loader = DataLoader(
 		val_entity_dataset,
 		num_workers=num_workers,
-		batch_size=args.eval_batch_size,
-		shuffle=False,
+		pin_memory=args.pin_memory,
+		**get_batch_args(
+			val_entity_dataset,
+			args.eval_batch_size,
+			shuffle=False,
+			bucket_batches=bucket_batches,
+			seed=args.seed
+		),
 		collate_fn=MisinfoPredictBatchCollator(
 			args.max_seq_len,
 			force_max_seq_len=args.use_tpus,
@@ -162,8 +229,14 @@ if __name__ == '__main__':
 	val_rel_data_loader = DataLoader(
 		val_rel_dataset,
 		num_workers=num_workers,
-		batch_size=args.eval_batch_size,
-		shuffle=False,
+		pin_memory=args.pin_memory,
+		**get_batch_args(
+			val_rel_dataset,
+			args.eval_batch_size,
+			shuffle=False,
+			bucket_batches=bucket_batches,
+			seed=args.seed
+		),
 		collate_fn=MisinfoPredictBatchCollator(
 			args.max_seq_len,
 			force_max_seq_len=args.use_tpus,
@@ -177,7 +250,7 @@ if __name__ == '__main__':
 	logging.info(f'val_rels={len(val_rel_dataset)}')
 
 	num_batches_per_step = (len(gpus) if not args.use_tpus else tpu_cores)
-	updates_epoch = train_size // (args.batch_size * num_batches_per_step)
+	updates_epoch = train_size // (args.batch_size * num_batches_per_step * args.accumulate_grad_batches)
 	updates_total = updates_epoch * args.epochs
 
 	logging.info('Loading model...')
@@ -195,6 +268,10 @@ if __name__ == '__main__':
 		emb_loss_norm=args.emb_loss_norm,
 		gamma=args.gamma,
 		load_pretrained=args.load_checkpoint is not None,
+		in_batch_negatives=args.in_batch_negatives,
+		precision=model_precision,
+		gradient_checkpointing=args.gradient_checkpointing,
+		encoder_chunk_size=args.encoder_chunk_size,
 	)
 
 	tokenizer.save_pretrained(save_directory)
@@ -210,6 +287,18 @@ if __name__ == '__main__':
 		max_queue=2
 	)
 
+	callbacks = []
+	if args.hard_neg_samples > 0:
+		callbacks.append(
+			HardNegativeMiner(
+				train_dataset,
+				args.eval_batch_size,
+				args.max_seq_len,
+				pool_size=args.hard_neg_pool_size,
+				refresh_epochs=args.hard_neg_refresh_epochs
+			)
+		)
+
 	if args.use_tpus:
 		logging.warning('Gradient clipping slows down TPU training drastically, disabled for now.')
 		trainer = pl.Trainer(
@@ -218,8 +307,10 @@ if __name__ == '__main__':
 			default_root_dir=save_directory,
 			max_epochs=args.epochs,
 			precision=precision,
+			accumulate_grad_batches=args.accumulate_grad_batches,
 			deterministic=deterministic,
 			checkpoint_callback=False,
+			callbacks=callbacks,
 		)
 	else:
 		if len(gpus) > 1:
@@ -232,10 +323,13 @@ if __name__ == '__main__':
 			default_root_dir=save_directory,
 			max_epochs=args.epochs,
 			precision=precision,
+			accumulate_grad_batches=args.accumulate_grad_batches,
 			distributed_backend=backend,
+			replace_sampler_ddp=not bucket_batches,
 			gradient_clip_val=args.gradient_clip_val,
 			deterministic=deterministic,
 			checkpoint_callback=False,
+			callbacks=callbacks,
 		)
 	try:
 		logging.info('Training...')
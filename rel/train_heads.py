@@ -0,0 +1,234 @@
+import argparse
+import itertools
+import logging
+import time
+
+from transformers import BertTokenizerFast, BertModel
+
+from model_utils import *
+from data_utils import *
+from head_utils import feature_cache_path, load_cls_features, FeatureHeadModel, train_feature_head, \
+	evaluate_feature_head, head_checkpoint
+
+from common.precision_utils import PRECISIONS
+
+import torch
+
+
+def split_list(value, value_type=str):
+	return [value_type(x) for x in value.split(',')]
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-tp', '--train_path', required=True)
+	parser.add_argument('-vp', '--val_path', required=True)
+	# thresholds are tuned on val, test F1 is reported as well when a test split is given
+	parser.add_argument('-tep', '--test_path', default=None)
+	parser.add_argument('-tmp', '--train_misinfo_path', required=True)
+	parser.add_argument('-vmp', '--val_misinfo_path', required=True)
+	parser.add_argument('-pm', '--pre_model_name', default='nboost/pt-biobert-base-msmarco')
+	parser.add_argument('-mn', '--model_name', default='pt-biobert-base-msmarco')
+	parser.add_argument('-sd', '--save_directory', default='models')
+	# frozen encoder weights from a rel checkpoint instead of the pre-trained model
+	parser.add_argument('-lt', '--load_checkpoint', default=None)
+	parser.add_argument('-bs', '--batch_size', default=64, type=int)
+	parser.add_argument('-ebs', '--eval_batch_size', default=64, type=int)
+	parser.add_argument('-ml', '--max_seq_len', default=96, type=int)
+	parser.add_argument('-se', '--seed', default=0, type=int)
+	parser.add_argument('-eo', '--epochs', default=10, type=int)
+	parser.add_argument('-lr', '--learning_rate', default=5e-4, type=float)
+	parser.add_argument('-lrw', '--lr_warmup', default=0.1, type=float)
+	parser.add_argument('-wd', '--weight_decay', default=0.0, type=float)
+	parser.add_argument('-gcv', '--gradient_clip_val', default=1.0, type=float)
+	parser.add_argument('-ns', '--neg_samples', default=1, type=int)
+	# head sweep, comma separated values of every option are trained as a grid
+	parser.add_argument('-em', '--emb_model', default='transd')
+	parser.add_argument('-es', '--emb_size', default='100')
+	parser.add_argument('-ga', '--gamma', default='0.5')
+	parser.add_argument('-eln', '--emb_loss_norm', default='2')
+	# feature extraction only, head training runs on CPU
+	parser.add_argument('-gpu', '--gpu', default=None, type=int)
+	parser.add_argument('-pr', '--precision', default='32', choices=PRECISIONS)
+	parser.add_argument('-tcd', '--token_cache_dir', default=None)
+	parser.add_argument('-fcd', '--feature_cache_dir', default=None)
+	# saves a full model checkpoint of every config, loadable by rel/evaluate.py and rel/predict.py
+	parser.add_argument('-sc', '--save_checkpoints', default=False, action='store_true')
+	args = parser.parse_args()
+
+	torch.manual_seed(args.seed)
+
+	save_directory = os.path.join(args.save_directory, args.model_name)
+	if not os.path.exists(save_directory):
+		os.makedirs(save_directory)
+	results_path = os.path.join(save_directory, 'head_sweep.jsonl')
+	token_cache_dir = args.token_cache_dir if args.token_cache_dir is not None else os.path.join(args.save_directory, 'token_cache')
+	# features only depend on the encoder, so they are shared between models
+	feature_cache_dir = args.feature_cache_dir if args.feature_cache_dir is not None else os.path.join(args.save_directory, 'feature_cache')
+	device = 'cpu' if args.gpu is None else f'cuda:{args.gpu}'
+
+	for handler in logging.root.handlers[:]:
+		logging.root.removeHandler(handler)
+	logging.basicConfig(
+		level=logging.INFO,
+		format="%(asctime)s [%(levelname)s] %(message)s",
+		handlers=[
+			logging.FileHandler(os.path.join(save_directory, 'head_sweep_output.log'), mode='w'),
+			logging.StreamHandler()]
+	)
+
+	logging.info(f'Loading tokenizer: {args.pre_model_name}')
+	tokenizer = BertTokenizerFast.from_pretrained(args.pre_model_name)
+
+	logging.info(f'Loading encoder: {args.pre_model_name}')
+	bert = BertModel.from_pretrained(args.pre_model_name)
+	if args.load_checkpoint is not None:
+		logging.warning(f'Loading encoder weights from trained checkpoint: {args.load_checkpoint}...')
+		checkpoint = torch.load(args.load_checkpoint, map_location='cpu')
+		bert.load_state_dict({k[len('bert.'):]: v for k, v in checkpoint.items() if k.startswith('bert.')})
+		encoder_key = file_hash(args.load_checkpoint)
+	else:
+		encoder_key = args.pre_model_name.strip('/').replace('/', '_')
+	if args.precision != '32':
+		encoder_key = f'{encoder_key}-{args.precision}'
+	bert.to(device)
+	bert.eval()
+	for param in bert.parameters():
+		param.requires_grad = False
+	hidden_size = bert.config.hidden_size
+
+	def cls_features(data_path, tokens):
+		cache_path = feature_cache_path(feature_cache_dir, encoder_key, data_path, args.max_seq_len)
+		logging.info(f'Loading CLS features: {cache_path}')
+		return load_cls_features(
+			cache_path,
+			bert,
+			tokens,
+			hidden_size,
+			args.max_seq_len,
+			batch_size=args.eval_batch_size,
+			device=device,
+			precision=args.precision
+		)
+
+	def eval_split(data_path, misinfo_path):
+		# (entities, relations, m_examples, t_labels) features of a split, heads map them to embeddings
+		with open(misinfo_path, 'r') as f:
+			misinfo = json.load(f)
+		data = read_jsonl(data_path)
+		entity_dataset = MisinfoEntityDataset(
+			documents=data,
+			tokenizer=tokenizer,
+			misinfo=misinfo,
+			tokens=load_document_tokens(data_path, data, tokenizer, token_cache_dir)
+		)
+		rel_dataset = MisinfoRelDataset(
+			misinfo=misinfo,
+			tokenizer=tokenizer,
+			m_examples=entity_dataset.m_examples
+		)
+		e_ids = [ex['id'] for ex in entity_dataset.examples]
+		m_ids = [ex['id'] for ex in rel_dataset.examples]
+		return (
+			(e_ids, cls_features(data_path, entity_dataset.tokens)),
+			(m_ids, cls_features(misinfo_path, rel_dataset.tokens)),
+			{m_id: list(entity_dataset.m_examples[m_id]) for m_id in m_ids},
+			{ex['id']: set(ex['t_labels']) for ex in entity_dataset.examples},
+		)
+
+	logging.info(f'Loading train dataset: {args.train_path}')
+	train_data = read_jsonl(args.train_path)
+	with open(args.train_misinfo_path, 'r') as f:
+		train_misinfo = json.load(f)
+	train_dataset = MisinfoDataset(
+		documents=train_data,
+		tokenizer=tokenizer,
+		misinfo=train_misinfo,
+		pos_samples=1,
+		neg_samples=args.neg_samples,
+		shuffle=True,
+		tokens=load_document_tokens(args.train_path, train_data, tokenizer, token_cache_dir)
+	)
+	train_t_features = cls_features(args.train_path, train_dataset.t_tokens)
+	train_m_features = cls_features(args.train_misinfo_path, train_dataset.m_tokens)
+	logging.info(f'Loading val dataset: {args.val_path}')
+	val_split = eval_split(args.val_path, args.val_misinfo_path)
+	test_split = None
+	if args.test_path is not None:
+		logging.info(f'Loading test dataset: {args.test_path}')
+		test_split = eval_split(args.test_path, args.val_misinfo_path)
+	logging.info(f'train={len(train_dataset)} val={len(val_split[0][0])}')
+
+	def head_embeddings(head, split):
+		(e_ids, e_features), (m_ids, m_features), m_examples, t_labels = split
+		return (
+			head.embeddings(e_ids, e_features, 'entity'),
+			head.embeddings(m_ids, m_features, 'rel'),
+			m_examples,
+			t_labels
+		)
+
+	configs = itertools.product(
+		split_list(args.emb_model),
+		split_list(args.emb_size, int),
+		split_list(args.gamma, float),
+		split_list(args.emb_loss_norm, int),
+	)
+	results = []
+	for emb_model, emb_size, gamma, emb_loss_norm in configs:
+		config_name = f'{emb_model}-{emb_size}-{gamma}-{emb_loss_norm}'
+		torch.manual_seed(args.seed)
+		start = time.perf_counter()
+		head = FeatureHeadModel(
+			emb_model,
+			hidden_size,
+			emb_size,
+			gamma,
+			emb_loss_norm,
+			dropout_prob=bert.config.hidden_dropout_prob
+		)
+		train_loss = train_feature_head(
+			head,
+			train_dataset,
+			train_t_features,
+			train_m_features,
+			epochs=args.epochs,
+			batch_size=args.batch_size,
+			learning_rate=args.learning_rate,
+			lr_warmup=args.lr_warmup,
+			weight_decay=args.weight_decay,
+			gradient_clip_val=args.gradient_clip_val,
+			seed=args.seed
+		)
+		dev_embeddings = head_embeddings(head, val_split)
+		val_f1, val_p, val_r = evaluate_feature_head(head, dev_embeddings, dev_embeddings)
+		result = {
+			'emb_model': emb_model,
+			'emb_size': emb_size,
+			'gamma': gamma,
+			'emb_loss_norm': emb_loss_norm,
+			'train_loss': train_loss,
+			'val_f1': val_f1,
+			'val_p': val_p,
+			'val_r': val_r,
+		}
+		if test_split is not None:
+			test_f1, test_p, test_r = evaluate_feature_head(head, dev_embeddings, head_embeddings(head, test_split))
+			result.update({'test_f1': test_f1, 'test_p': test_p, 'test_r': test_r})
+		result['seconds'] = time.perf_counter() - start
+		results.append(result)
+		logging.info(
+			f'{config_name}\tval_f1={val_f1:.4f}'
+			+ (f'\ttest_f1={result["test_f1"]:.4f}' if test_split is not None else '')
+			+ f'\t{result["seconds"]:.1f}s'
+		)
+		if args.save_checkpoints:
+			checkpoint_directory = os.path.join(save_directory, config_name)
+			if not os.path.exists(checkpoint_directory):
+				os.makedirs(checkpoint_directory)
+			torch.save(head_checkpoint(bert, head), os.path.join(checkpoint_directory, 'pytorch_model.bin'))
+
+	write_jsonl(results, results_path)
+	best = max(results, key=lambda x: x['val_f1'])
+	logging.info(f'Best val_f1={best["val_f1"]:.4f}: {best}')
+	logging.info(f'Wrote head sweep results: {results_path}')
@@ -0,0 +1,49 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'rel'))
+
+from emb_utils import TuckEREmbedding
+
+
+def broadcast_tucker_energy(weight, head, rel, tail):
+	# energy of the original TuckEREmbedding, which broadcast the full core per example
+	w = weight
+	for _ in range(len(head.shape) - 1):
+		w = w.unsqueeze(dim=0)
+	w = (w * head.unsqueeze(dim=-1).unsqueeze(dim=-1)).sum(dim=-1)
+	w = (w * rel.unsqueeze(dim=-1)).sum(dim=-1)
+	return -(w * tail).sum(dim=-1)
+
+
+def test_tucker_energy_matches_broadcast():
+	torch.manual_seed(0)
+	emb_model = TuckEREmbedding(hidden_size=8, emb_size=6, gamma=1.0, loss_norm=2)
+	head = torch.randn(4, 3, 6)
+	rel = torch.randn(4, 3, 6)
+	tail = torch.randn(4, 3, 6)
+	with torch.no_grad():
+		expected = broadcast_tucker_energy(emb_model.weight, head, rel, tail)
+		energy = emb_model.energy(head, rel, tail)
+	assert torch.allclose(energy, expected, atol=1e-4)
+
+
+def test_tucker_all_pairs_energy_matches_broadcast():
+	torch.manual_seed(0)
+	emb_model = TuckEREmbedding(hidden_size=8, emb_size=6, gamma=1.0, loss_norm=2)
+	heads = torch.randn(5, 6)
+	rels = torch.randn(3, 6)
+	tails = torch.randn(3, 6)
+	with torch.no_grad():
+		expected = broadcast_tucker_energy(
+			emb_model.weight,
+			heads.unsqueeze(dim=1).expand(5, 3, 6),
+			rels.unsqueeze(dim=0).expand(5, 3, 6),
+			tails.unsqueeze(dim=0).expand(5, 3, 6)
+		)
+		energies = emb_model.all_pairs_energy(heads, rels, tails)
+	assert torch.allclose(energies, expected, atol=1e-4)